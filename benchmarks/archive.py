@@ -0,0 +1,247 @@
+'''
+Generators for synthetic waveform archives used in the benchmarks.
+'''
+
+import os.path as op
+
+import numpy as num
+
+from pyrocko import io, trace, util
+
+
+def make_network_archive(
+        path,
+        nstations=500,
+        channels=('HHZ', 'HHN', 'HHE'),
+        tmin=util.str_to_time('2020-01-01 00:00:00'),
+        nfiles=4,
+        file_duration=600.,
+        deltat=0.1,
+        seed=0):
+
+    '''
+    Write a continuous archive of a large network with random noise data.
+
+    For each of ``nfiles`` consecutive time spans of length
+    ``file_duration`` [s], one miniSEED file is written per channel and
+    station. Returns the number of files written.
+    '''
+
+    rstate = num.random.RandomState(seed)
+    nsamples = int(round(file_duration / deltat))
+    nwritten = 0
+    for ifile in range(nfiles):
+        trs = []
+        for istation in range(nstations):
+            for channel in channels:
+                trs.append(trace.Trace(
+                    'XX', 'S%04i' % istation, '', channel,
+                    deltat=deltat,
+                    tmin=tmin + ifile * file_duration,
+                    ydata=rstate.randint(
+                        -1000, 1000, size=nsamples).astype(num.int32)))
+
+        fns = io.save(trs, op.join(
+            path, '%(tmin)s', '%(network)s.%(station)s.%(channel)s.mseed'))
+
+        nwritten += len(fns)
+
+    return nwritten
+
+
+km = 1000.
+
+vp_bench = 6.0 * km
+vs_bench = 3.5 * km
+
+response_bench = trace.PoleZeroResponse(
+    zeros=[0., 0.],
+    poles=[-0.037-0.037j, -0.037+0.037j],
+    constant=1e9)
+
+
+def make_gf_store(path, store_id='bench', distance_max=500*km):
+    '''
+    Create a minimal GF store without Green's functions or travel-time
+    tables.
+
+    It is sufficient for feature extraction with velocity-based timings
+    (e.g. ``'{vel:6}-1'``). Returns the path to the store directory.
+    '''
+
+    from pyrocko.gf import meta, store
+
+    store_dir = op.join(path, 'gf_stores', store_id)
+    if not op.exists(store_dir):
+        config = meta.ConfigTypeA(
+            id=store_id,
+            sample_rate=1.0,
+            receiver_depth=0.,
+            source_depth_min=0.,
+            source_depth_max=30*km,
+            source_depth_delta=10*km,
+            distance_min=0.,
+            distance_max=distance_max,
+            distance_delta=distance_max/10.,
+            modelling_code_id='none')
+
+        store.Store.create(store_dir, config=config)
+
+    return store_dir
+
+
+def make_event_dataset(
+        path,
+        nevents=2,
+        nstations=10,
+        channels=('HHZ', 'HHN', 'HHE'),
+        tmin=util.str_to_time('2020-01-01 00:00:00'),
+        radius=100*km,
+        duration=120.,
+        deltat=0.01,
+        seed=0):
+
+    '''
+    Write an event-based dataset with random stations and events.
+
+    Writes station metadata with pole-zero responses to ``stations.xml``,
+    the events to ``events.pf`` and, for each event, one miniSEED file per
+    channel to ``data/<event_name>/raw``. The traces contain noise and P and
+    S wave packets with amplitudes decaying with distance, travelling with
+    ``vp_bench`` and ``vs_bench``.
+    '''
+
+    from pyrocko import model, orthodrome
+    from pyrocko.io import stationxml
+
+    rstate = num.random.RandomState(seed)
+    lat0, lon0 = 50., 10.
+
+    stations = []
+    for istation in range(nstations):
+        north, east = rstate.uniform(-radius, radius, 2)
+        lat, lon = orthodrome.ne_to_latlon(lat0, lon0, north, east)
+        station = model.Station(
+            'XX', 'S%04i' % istation, '', lat=float(lat), lon=float(lon))
+
+        station.set_channels_by_name(*channels)
+        stations.append(station)
+
+    sx = stationxml.FDSNStationXML.from_pyrocko_stations(stations)
+    for network in sx.network_list:
+        for station in network.station_list:
+            station.start_date = tmin - 365 * 24 * 3600.
+            for channel in station.channel_list:
+                channel.start_date = station.start_date
+                channel.sample_rate = stationxml.SampleRate(value=1.0/deltat)
+                channel.response = \
+                    stationxml.Response.from_pyrocko_pz_response(
+                        response_bench, 'M/S', 'COUNTS',
+                        normalization_frequency=1.0)
+
+    util.ensuredir(path)
+    sx.dump_xml(filename=op.join(path, 'stations.xml'))
+
+    events = []
+    for ievent in range(nevents):
+        north, east = rstate.uniform(-0.3*radius, 0.3*radius, 2)
+        lat, lon = orthodrome.ne_to_latlon(lat0, lon0, north, east)
+        events.append(model.Event(
+            lat=float(lat),
+            lon=float(lon),
+            depth=float(rstate.uniform(2*km, 15*km)),
+            time=tmin + ievent * 3600. + rstate.uniform(0., 100.),
+            magnitude=float(rstate.uniform(1., 4.)),
+            name='ev%04i' % ievent))
+
+    model.dump_events(events, op.join(path, 'events.pf'))
+
+    nsamples = int(round(duration / deltat))
+    for event in events:
+        trs = []
+        for station in stations:
+            dist = num.sqrt(event.distance_to(station)**2 + event.depth**2)
+            amp = 10**event.magnitude * 1000. / (dist/km + 1.)
+            for channel in channels:
+                y = rstate.normal(size=nsamples) * 100.
+                for v, n, f, tdecay in [
+                        (vp_bench, 200, 0.6, 50.),
+                        (vs_bench, 300, 0.4, 80.)]:
+
+                    i = int((dist/v + 20.) / deltat)
+                    t = num.arange(min(n, nsamples - i))
+                    y[i:i+t.size] += amp * num.sin(t*f) * num.exp(-t/tdecay)
+
+                trs.append(trace.Trace(
+                    station.network, station.station, station.location,
+                    channel,
+                    deltat=deltat,
+                    tmin=event.time - 20.,
+                    ydata=y.astype(num.int32)))
+
+        io.save(trs, op.join(
+            path, 'data', event.name, 'raw',
+            '%(network)s.%(station)s.%(channel)s.mseed'))
+
+    return events, stations
+
+
+def make_measures(nmeasures):
+    '''
+    Get a list of measures cycling through all feature methods, with P and
+    S windows for velocity-based timings and varying frequency bands.
+    '''
+
+    from pyrocko import gf
+    from wafe import measure as wmeasure
+
+    windows = [
+        ('P', '{vel:%g}-1' % (vp_bench/km), '{vel:%g}+2' % (vp_bench/km)),
+        ('S', '{vel:%g}-1' % (vs_bench/km), '{vel:%g}+4' % (vs_bench/km))]
+
+    bands = [(1., 10.), (2., 20.), (0.5, 5.)]
+
+    measures = []
+    methods = wmeasure.FeatureMethod.choices
+    for imeasure in range(nmeasures):
+        method = methods[imeasure % len(methods)]
+        phase, timing_tmin, timing_tmax = windows[imeasure % len(windows)]
+        fmin, fmax = bands[(imeasure // len(methods)) % len(bands)]
+        measures.append(wmeasure.FeatureMeasure(
+            name='%s%i' % (phase, imeasure),
+            timing_tmin=gf.Timing(timing_tmin),
+            timing_tmax=gf.Timing(timing_tmax),
+            fmin=fmin,
+            fmax=fmax,
+            nbands=8 if method == 'spectral_bands' else None,
+            components=['Z', 'N', 'E'],
+            quantity='velocity',
+            method=method))
+
+    return measures
+
+
+def make_config(path, measures, store_id='bench', output_format='text'):
+    '''
+    Get a configuration for a dataset written by :py:func:`make_event_dataset`
+    and a store written by :py:func:`make_gf_store`.
+    '''
+
+    from wafe import config as wconfig, dataset
+
+    config = wconfig.Config(
+        dataset_config=dataset.DatasetConfig(
+            stations_stationxml_paths=['stations.xml'],
+            responses_stationxml_paths=['stations.xml'],
+            events_path='events.pf',
+            waveform_paths=['data/${event_name}/raw']),
+        measures=measures,
+        store_id=store_id,
+        engine_config=wconfig.EngineConfig(
+            gf_stores_from_pyrocko_config=False,
+            gf_store_superdirs=['gf_stores']),
+        output_path='${config_name}.output',
+        output_format=output_format)
+
+    config.set_basepath(path)
+    return config
@@ -0,0 +1,259 @@
+'''
+Benchmark feature extraction on synthetic event datasets.
+
+Usage: python bench_extract.py [options] <work-dir>
+
+Datasets are generated in the work directory if they do not exist yet.
+Scenarios scale the number of events, stations and measures: the first
+value given for each of them defines the base scenario, and each further
+value gives a scenario differing from the base in that dimension only.
+
+For each scenario, the following are timed (best of --repeat runs):
+
+    get_waveform       Dataset.get_waveform for all channels of one event
+    evaluate.<method>  FeatureMeasure.evaluate with the given method at all
+                       stations of one event
+    run_extract        wafe.core.run_extract end to end
+    run_plot           wafe.plot.run_plot (skipped if matplotlib is missing)
+
+Timings are written as JSON with --output. With --baseline, they are
+compared against a previous output, and the exit status is 1 if any timing
+is slower than the baseline by more than --tolerance.
+'''
+
+import sys
+import time
+import json
+import shutil
+import platform
+import os.path as op
+from optparse import OptionParser
+
+import pyrocko
+from pyrocko import gf
+
+from wafe import core, plot, measure as wmeasure
+
+from archive import make_gf_store, make_event_dataset, make_measures, \
+    make_config
+
+
+def best_of(nrepeat, f):
+    times = []
+    for _ in range(nrepeat):
+        t0 = time.time()
+        f()
+        times.append(time.time() - t0)
+
+    return min(times)
+
+
+def get_targets(config, station, measure):
+    return [
+        gf.Target(
+            quantity='velocity',
+            codes=station.nsl() + (component,),
+            store_id=config.store_id,
+            lat=station.lat,
+            lon=station.lon,
+            depth=station.depth,
+            elevation=station.elevation)
+        for component in measure.components]
+
+
+def bench_get_waveform(config, event_name):
+    config.dataset_config.forget_dataset(event_name)
+    ds = config.get_dataset(event_name)
+    event = ds.get_event()
+    source = gf.DCSource.from_pyrocko_event(event)
+    engine = config.get_engine()
+    measure = config.measures[0]
+    for station in ds.get_stations():
+        for target in get_targets(config, station, measure):
+            tmin, tmax = measure.get_time_window(engine, source, target)
+            ds.get_waveform(
+                target.codes, tmin=tmin, tmax=tmax,
+                **measure.get_waveform_parameters(target))
+
+
+def bench_evaluate(config, event_name, measure):
+    config.dataset_config.forget_dataset(event_name)
+    ds = config.get_dataset(event_name)
+    event = ds.get_event()
+    source = gf.DCSource.from_pyrocko_event(event)
+    engine = config.get_engine()
+    for station in ds.get_stations():
+        measure.evaluate(
+            engine, source, get_targets(config, station, measure), ds)
+
+
+def run_scenario(workdir, nevents, nstations, nmeasures, nrepeat):
+    path = op.join(workdir, 'e%i-s%i' % (nevents, nstations))
+    if not op.exists(op.join(path, 'events.pf')):
+        make_event_dataset(path, nevents=nevents, nstations=nstations)
+
+    make_gf_store(path)
+
+    config = make_config(path, make_measures(nmeasures))
+    config.set_config_name('bench-m%i' % nmeasures)
+    output_path = config.expand_path(config.output_path)
+    event_name = config.get_event_names()[0]
+
+    timings = {}
+    timings['get_waveform'] = best_of(
+        nrepeat, lambda: bench_get_waveform(config, event_name))
+
+    for method in wmeasure.FeatureMethod.choices:
+        measure = wmeasure.FeatureMeasure(
+            name=method,
+            timing_tmin=config.measures[0].timing_tmin,
+            timing_tmax=config.measures[0].timing_tmax,
+            fmin=1.0,
+            fmax=10.0,
+            nbands=8 if method == 'spectral_bands' else None,
+            components=['Z', 'N', 'E'],
+            quantity='velocity',
+            method=method)
+
+        timings['evaluate.%s' % method] = best_of(
+            nrepeat, lambda: bench_evaluate(config, event_name, measure))
+
+    def extract():
+        for event_name in config.get_event_names():
+            config.dataset_config.forget_dataset(event_name)
+
+        shutil.rmtree(output_path, ignore_errors=True)
+        core.run_extract(config)
+
+    timings['run_extract'] = best_of(nrepeat, extract)
+
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        timings['run_plot'] = best_of(
+            nrepeat,
+            lambda: plot.run_plot(
+                output_path, formats=['png'], min_bin_count=1))
+
+    except ImportError:
+        pass
+
+    return dict(
+        name='events=%i stations=%i measures=%i' % (
+            nevents, nstations, nmeasures),
+        nevents=nevents,
+        nstations=nstations,
+        nmeasures=nmeasures,
+        timings=timings)
+
+
+def get_scenarios(nevents_list, nstations_list, nmeasures_list):
+    base = (nevents_list[0], nstations_list[0], nmeasures_list[0])
+    scenarios = [base]
+    for nevents in nevents_list[1:]:
+        scenarios.append((nevents, base[1], base[2]))
+
+    for nstations in nstations_list[1:]:
+        scenarios.append((base[0], nstations, base[2]))
+
+    for nmeasures in nmeasures_list[1:]:
+        scenarios.append((base[0], base[1], nmeasures))
+
+    return scenarios
+
+
+def compare(results, baseline, tolerance):
+    baseline_timings = dict(
+        (scenario['name'], scenario['timings'])
+        for scenario in baseline['scenarios'])
+
+    nslower = 0
+    for scenario in results['scenarios']:
+        if scenario['name'] not in baseline_timings:
+            continue
+
+        print(scenario['name'])
+        for key, t in sorted(scenario['timings'].items()):
+            t_base = baseline_timings[scenario['name']].get(key)
+            if t_base is None:
+                continue
+
+            ratio = t / t_base
+            slower = ratio > 1.0 + tolerance
+            nslower += slower
+            print('  %-32s %9.3f s %9.3f s %6.2f %s' % (
+                key, t_base, t, ratio, '*' if slower else ''))
+
+    return nslower
+
+
+def main(args=None):
+    parser = OptionParser(
+        usage='python bench_extract.py [options] <work-dir>')
+
+    def ints(s):
+        return [int(x) for x in s.split(',')]
+
+    parser.add_option(
+        '--events', dest='nevents', default='2',
+        help='comma-separated numbers of events (default: %default)')
+    parser.add_option(
+        '--stations', dest='nstations', default='10',
+        help='comma-separated numbers of stations (default: %default)')
+    parser.add_option(
+        '--measures', dest='nmeasures', default='5',
+        help='comma-separated numbers of measures (default: %default)')
+    parser.add_option(
+        '--repeat', dest='nrepeat', type='int', default=3,
+        help='number of runs per timing, the fastest is reported '
+             '(default: %default)')
+    parser.add_option(
+        '--output', dest='output',
+        help='write timings as JSON to this file')
+    parser.add_option(
+        '--baseline', dest='baseline',
+        help='compare timings with this JSON file from a previous run')
+    parser.add_option(
+        '--tolerance', dest='tolerance', type='float', default=0.2,
+        help='relative slowdown with respect to the baseline to tolerate '
+             '(default: %default)')
+
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error('work directory required')
+
+    workdir = args[0]
+
+    results = dict(
+        python=platform.python_version(),
+        pyrocko=pyrocko.__version__,
+        scenarios=[])
+
+    for nevents, nstations, nmeasures in get_scenarios(
+            ints(options.nevents),
+            ints(options.nstations),
+            ints(options.nmeasures)):
+
+        scenario = run_scenario(
+            workdir, nevents, nstations, nmeasures, options.nrepeat)
+
+        print(scenario['name'])
+        for key, t in sorted(scenario['timings'].items()):
+            print('  %-32s %9.3f s' % (key, t))
+
+        results['scenarios'].append(scenario)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if options.baseline:
+        with open(options.baseline, 'r') as f:
+            baseline = json.load(f)
+
+        if compare(results, baseline, options.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,96 @@
+'''
+Compare raw waveform lookups through the NSLC-keyed waveform index with
+pile lookups using a trace selector, on a synthetic large-network archive.
+
+Usage: python bench_waveform_index.py [options] <archive-dir>
+
+The archive is generated in the given directory if it does not exist yet.
+'''
+
+import sys
+import time
+import os.path as op
+from optparse import OptionParser
+
+import numpy as num
+
+from pyrocko import pile
+
+from wafe import dataset
+
+from archive import make_network_archive
+
+
+def run(path, nstations, nlookups, window, seed=0):
+    if not op.exists(path):
+        nfiles = make_network_archive(path, nstations=nstations)
+        print('generated archive with %i files' % nfiles)
+
+    p = pile.make_pile([path], show_progress=False)
+    nslc_ids = sorted(p.nslc_ids.keys())
+    print('archive: %i channels, %i traces' % (
+        len(nslc_ids), sum(1 for _ in p.iter_traces())))
+
+    rstate = num.random.RandomState(seed)
+    lookups = []
+    for _ in range(nlookups):
+        nslc = nslc_ids[rstate.randint(len(nslc_ids))]
+        tmin = rstate.uniform(p.tmin, p.tmax - window)
+        lookups.append((nslc, tmin, tmin + window))
+
+    t0 = time.time()
+    ntraces_pile = 0
+    for nslc, tmin, tmax in lookups:
+        ntraces_pile += len(p.all(
+            tmin=tmin, tmax=tmax,
+            trace_selector=lambda tr: tr.nslc_id == nslc))
+
+    t_pile = time.time() - t0
+
+    index = dataset.WaveformIndex(p)
+    t0 = time.time()
+    index.get_channels(nslc_ids[0][:3])
+    t_build = time.time() - t0
+
+    t0 = time.time()
+    ntraces_index = 0
+    for nslc, tmin, tmax in lookups:
+        ntraces_index += len(index.get_traces(nslc, tmin, tmax))
+
+    t_index = time.time() - t0
+
+    assert ntraces_pile == ntraces_index
+
+    print('pile with trace selector: %8.2f ms per lookup' % (
+        t_pile / nlookups * 1000.))
+    print('waveform index build:     %8.2f ms' % (t_build * 1000.))
+    print('waveform index:           %8.2f ms per lookup' % (
+        t_index / nlookups * 1000.))
+    print('speedup:                  %8.1f x' % (t_pile / t_index))
+
+
+def main(args=None):
+    parser = OptionParser(
+        usage='python bench_waveform_index.py [options] <archive-dir>')
+
+    parser.add_option(
+        '--nstations', dest='nstations', type='int', default=500,
+        help='number of stations with 3 channels each in the generated '
+             'archive (default: %default)')
+    parser.add_option(
+        '--nlookups', dest='nlookups', type='int', default=200,
+        help='number of random lookups (default: %default)')
+    parser.add_option(
+        '--window', dest='window', type='float', default=60.,
+        help='length of the time window of each lookup [s] '
+             '(default: %default)')
+
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error('archive directory required')
+
+    run(args[0], options.nstations, options.nlookups, options.window)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
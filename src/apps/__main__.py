@@ -6,7 +6,8 @@ from optparse import OptionParser
 
 from pyrocko import util
 
-from wafe import core, config as wconfig, meta, plot
+from wafe import core, config as wconfig, meta, plot, monitor, continuous, \
+    workqueue, serve
 
 logger = logging.getLogger('wafe.main')
 km = 1e3
@@ -21,11 +22,21 @@ def d2u(d):
 
 subcommand_descriptions = {
     'extract': 'extract features from observed waveforms',
+    'monitor': 'extract features of new events as data arrives',
+    'continuous': 'extract features on sliding windows of continuous data',
+    'merge': 'merge outputs of a sharded extraction',
+    'worker': 'process events from an extraction queue',
+    'serve': 'answer extraction requests on a local HTTP port',
     'plot': 'plot results',
 }
 
 subcommand_usages = {
     'extract': 'extract <configfile>',
+    'monitor': 'monitor <configfile>',
+    'continuous': 'continuous <configfile>',
+    'merge': 'merge <configfile>',
+    'worker': 'worker <queuefile>',
+    'serve': 'serve <configfile>',
     'plot': 'plot <results-dir>'
 }
 
@@ -41,6 +52,11 @@ usage = '''%(program_name)s <subcommand> [options] [--] <arguments> ...
 Subcommands:
 
     extract            %(extract)s
+    monitor            %(monitor)s
+    continuous         %(continuous)s
+    merge              %(merge)s
+    worker             %(worker)s
+    serve              %(serve)s
     plot               %(plot)s
 
 To get further help and a list of available options for any subcommand run:
@@ -142,20 +158,283 @@ def command_extract(args):
             dest='debug',
             help='show processing window traces for debugging')
 
+        parser.add_option(
+            '--jobs',
+            dest='nparallel',
+            type='int',
+            default=1,
+            metavar='N',
+            help='number of events to process in parallel (default: '
+                 '%default)')
+
+        parser.add_option(
+            '--resume',
+            action='store_true',
+            dest='resume',
+            help='continue a previous run, skipping events which have '
+                 'already been processed')
+
+        parser.add_option(
+            '--prefetch',
+            dest='nprefetch',
+            type='int',
+            default=0,
+            metavar='N',
+            help='prepare datasets and read waveform data of the next N '
+                 'events in the background (default: %default, cannot be '
+                 'combined with --jobs)')
+
+        parser.add_option(
+            '--prefetch-memory',
+            dest='prefetch_memory',
+            type='float',
+            metavar='MB',
+            help='maximum amount of prefetched waveform data held in memory '
+                 '[MB] (default: unlimited)')
+
+        parser.add_option(
+            '--stats',
+            action='store_true',
+            dest='stats',
+            help='report progress periodically and write timings and '
+                 'counters of the processing stages to stats.json in the '
+                 'output directory')
+
+        parser.add_option(
+            '--shard',
+            dest='shard',
+            metavar='I/N',
+            help='process only the I-th of N disjoint subsets of the events '
+                 '(1 <= I <= N), writing to a separate output directory; '
+                 'use "wafe merge" to combine the outputs of all shards')
+
+        parser.add_option(
+            '--queue',
+            dest='queue_path',
+            metavar='FILE',
+            help='instead of processing the events, add them to the queue '
+                 'in the SQLite database FILE, to be processed with '
+                 '"wafe worker FILE"')
+
     parser, options, args = cl_parse('extract', args, setup)
 
     if len(args) != 1:
         help_and_die(parser, 'argument required')
 
+    shard = None
+    if options.shard is not None:
+        try:
+            ishard, nshards = map(int, options.shard.split('/'))
+        except ValueError:
+            help_and_die(parser, 'invalid argument to --shard')
+
+        if not 1 <= ishard <= nshards:
+            help_and_die(parser, 'invalid argument to --shard')
+
+        shard = (ishard - 1, nshards)
+
+    if options.nprefetch > 0 and options.nparallel > 1:
+        help_and_die(parser, '--prefetch and --jobs cannot be combined')
+
+    if options.queue_path is not None:
+        if shard is not None:
+            help_and_die(parser, '--queue and --shard cannot be combined')
+
+        try:
+            workqueue.run_enqueue(options.queue_path, args[0])
+        except meta.WafeError as e:
+            die('command extract failed', e)
+
+        return
+
     try:
         config_path = args[0]
         config = wconfig.read_config(config_path)
-        core.run_extract(config, debug=options.debug)
+        prefetch_nbytes_max = None
+        if options.prefetch_memory is not None:
+            prefetch_nbytes_max = int(options.prefetch_memory * 1e6)
+
+        core.run_extract(
+            config, debug=options.debug, nparallel=options.nparallel,
+            resume=options.resume, nprefetch=options.nprefetch,
+            prefetch_nbytes_max=prefetch_nbytes_max,
+            stats=options.stats, shard=shard)
 
     except meta.WafeError as e:
         die('command extract failed', e)
 
 
+def command_monitor(args):
+
+    def setup(parser):
+        parser.add_option(
+            '--interval',
+            dest='interval',
+            type='float',
+            default=10.,
+            metavar='SECONDS',
+            help='time between checks for new events and data (default: '
+                 '%default)')
+
+        parser.add_option(
+            '--max-wait',
+            dest='max_wait',
+            type='float',
+            default=3600.,
+            metavar='SECONDS',
+            help='stop waiting for missing data of an event this long after '
+                 'it was first seen (default: %default)')
+
+    parser, options, args = cl_parse('monitor', args, setup)
+
+    if len(args) != 1:
+        help_and_die(parser, 'argument required')
+
+    try:
+        config_path = args[0]
+        config = wconfig.read_config(config_path)
+        monitor.run_monitor(
+            config, interval=options.interval, max_wait=options.max_wait)
+
+    except meta.WafeError as e:
+        die('command monitor failed', e)
+
+
+def command_continuous(args):
+
+    def setup(parser):
+        pass
+
+    parser, options, args = cl_parse('continuous', args, setup)
+
+    if len(args) != 1:
+        help_and_die(parser, 'argument required')
+
+    try:
+        config_path = args[0]
+        config = wconfig.read_config(config_path)
+        continuous.run_continuous(config)
+
+    except meta.WafeError as e:
+        die('command continuous failed', e)
+
+
+def command_merge(args):
+
+    def setup(parser):
+        parser.add_option(
+            '--allow-incomplete',
+            action='store_true',
+            dest='allow_incomplete',
+            help='merge even if some events have not been processed')
+
+    parser, options, args = cl_parse('merge', args, setup)
+
+    if len(args) != 1:
+        help_and_die(parser, 'argument required')
+
+    try:
+        config_path = args[0]
+        config = wconfig.read_config(config_path)
+        core.run_merge(config, allow_incomplete=options.allow_incomplete)
+
+    except meta.WafeError as e:
+        die('command merge failed', e)
+
+
+def command_worker(args):
+
+    def setup(parser):
+        parser.add_option(
+            '--lease',
+            dest='lease',
+            type='float',
+            default=600.,
+            metavar='SECONDS',
+            help='duration of claims on events; claims are renewed while a '
+                 'worker is alive and taken over by other workers when they '
+                 'expire (default: %default)')
+
+        parser.add_option(
+            '--max-attempts',
+            dest='max_attempts',
+            type='int',
+            default=3,
+            metavar='N',
+            help='give up on an event after N failed attempts (default: '
+                 '%default)')
+
+    parser, options, args = cl_parse('worker', args, setup)
+
+    if len(args) != 1:
+        help_and_die(parser, 'argument required')
+
+    try:
+        workqueue.run_worker(
+            args[0], lease=options.lease, max_attempts=options.max_attempts)
+
+    except meta.WafeError as e:
+        die('command worker failed', e)
+
+
+def command_serve(args):
+
+    def setup(parser):
+        parser.add_option(
+            '--host',
+            dest='host',
+            default='127.0.0.1',
+            help='address to listen on (default: %default)')
+
+        parser.add_option(
+            '--port',
+            dest='port',
+            type='int',
+            default=8765,
+            help='port to listen on (default: %default)')
+
+        parser.add_option(
+            '--workers',
+            dest='nworkers',
+            type='int',
+            default=4,
+            metavar='N',
+            help='number of requests processed concurrently (default: '
+                 '%default)')
+
+        parser.add_option(
+            '--no-update',
+            action='store_false',
+            dest='update',
+            default=True,
+            help='do not look for new waveform files')
+
+        parser.add_option(
+            '--update-interval',
+            dest='update_interval',
+            type='float',
+            default=10.,
+            metavar='SECONDS',
+            help='time between looks for new waveform files (default: '
+                 '%default)')
+
+    parser, options, args = cl_parse('serve', args, setup)
+
+    if len(args) != 1:
+        help_and_die(parser, 'argument required')
+
+    try:
+        config_path = args[0]
+        config = wconfig.read_config(config_path)
+        serve.run_serve(
+            config, host=options.host, port=options.port,
+            nworkers=options.nworkers, update=options.update,
+            update_interval=options.update_interval)
+
+    except meta.WafeError as e:
+        die('command serve failed', e)
+
+
 def command_plot(args):
 
     def setup(parser):
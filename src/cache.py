@@ -0,0 +1,136 @@
+'''
+In-memory caches shared between events.
+
+All caches are registered here and share one size limit, which is set from
+the ``memory_cache_size_max`` setting of the dataset configuration with
+:py:func:`set_memory_cache_size_max` and divided among the caches.
+'''
+
+import threading
+from collections import OrderedDict
+
+from wafe import stats as wstats
+
+memory_cache_size_max_default = 1e9
+
+g_memory_caches = []
+g_memory_cache_size_max = memory_cache_size_max_default
+g_memory_caches_lock = threading.Lock()
+
+
+class MemoryCache(object):
+    '''
+    In-memory cache shared between events, limited in total size.
+
+    When the size of the entries exceeds ``nbytes_max``, least recently used
+    entries are evicted. The most recently used entry is kept even if it
+    alone exceeds the limit, so that, e.g., a large pile is still shared
+    between the datasets of consecutive events. Access is thread-safe.
+    '''
+
+    def __init__(self, name, nbytes_max):
+        self.name = name
+        self.nbytes_max = nbytes_max
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''
+        Get an entry or ``None`` if it is not in the cache.
+        '''
+
+        with self._lock:
+            if key not in self._entries:
+                wstats.count('%s.miss' % self.name)
+                return None
+
+            wstats.count('%s.hit' % self.name)
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value, nbytes):
+        with self._lock:
+            if key in self._entries:
+                self._nbytes -= self._entries.pop(key)[1]
+
+            self._entries[key] = (value, nbytes)
+            self._nbytes += nbytes
+            self._evict()
+
+    def _evict(self):
+        while len(self._entries) > 1 and self._nbytes > self.nbytes_max:
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self._nbytes -= nbytes
+            wstats.count('%s.evicted' % self.name)
+
+    def set_nbytes_max(self, nbytes_max):
+        with self._lock:
+            self.nbytes_max = nbytes_max
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def get_nbytes(self):
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_report(self):
+        with self._lock:
+            return dict(
+                nentries=len(self._entries),
+                nbytes=self._nbytes,
+                nbytes_max=self.nbytes_max)
+
+
+def _update_limits():
+    for cache in g_memory_caches:
+        cache.set_nbytes_max(g_memory_cache_size_max / len(g_memory_caches))
+
+
+def register_memory_cache(cache):
+    '''
+    Add a cache to those sharing the size limit and return it.
+    '''
+
+    with g_memory_caches_lock:
+        g_memory_caches.append(cache)
+        _update_limits()
+
+    return cache
+
+
+def set_memory_cache_size_max(nbytes_max):
+    '''
+    Set the size limit of the in-memory caches shared between events.
+
+    The limit is divided among the caches.
+    '''
+
+    global g_memory_cache_size_max
+
+    with g_memory_caches_lock:
+        g_memory_cache_size_max = nbytes_max
+        _update_limits()
+
+
+def get_cache_report():
+    '''
+    Get number of entries, size and size limit of the in-memory caches.
+    '''
+
+    return dict(
+        (cache.name, cache.get_report()) for cache in g_memory_caches)
+
+
+__all__ = '''
+    MemoryCache
+    register_memory_cache
+    set_memory_cache_size_max
+    get_cache_report
+'''.split()
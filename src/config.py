@@ -1,6 +1,9 @@
+import copy
+import hashlib
 import os.path as op
 from pyrocko import gf
-from pyrocko.guts import Bool, List, load, dump
+from pyrocko.guts import Object, Bool, Float, List, StringChoice, \
+    Timestamp, load, dump
 
 from wafe import dataset, meta, measure
 
@@ -27,12 +30,53 @@ class EngineConfig(meta.HasPaths):
         return self._engine
 
 
+class OutputFormat(StringChoice):
+    choices = ['text', 'binary']
+
+
+class ContinuousConfig(Object):
+    tmin = Timestamp.T(help='start of the time span to process')
+    tmax = Timestamp.T(help='end of the time span to process')
+    window_length = Float.T(help='length of the sliding windows [s]')
+    window_step = Float.T(
+        optional=True,
+        help='time between the starts of consecutive windows [s] '
+             '(default: window_length)')
+    chunk_length = Float.T(
+        default=3600.,
+        help='approximate length of the chunks of data processed at once '
+             '[s]')
+    tpad = Float.T(
+        optional=True,
+        help='padding on both sides of each chunk [s] (default: five times '
+             'the longest restitution taper of the measures)')
+
+    def get_window_step(self):
+        if self.window_step is None:
+            return self.window_length
+
+        return self.window_step
+
+
+performance_settings = [
+    'trace_cache_path',
+    'trace_cache_size_max',
+    'memory_cache_size_max']
+
+
 class Config(meta.HasPaths):
     dataset_config = dataset.DatasetConfig.T()
     measures = List.T(measure.FeatureMeasure.T())
     store_id = gf.StringID.T()
     engine_config = EngineConfig.T()
     output_path = meta.Path.T()
+    output_format = OutputFormat.T(
+        default='text',
+        help='format of the results: "text" writes measures.txt, "binary" '
+             'writes columnar arrays to the directory measures')
+    continuous_config = ContinuousConfig.T(
+        optional=True,
+        help='sliding windows for continuous extraction')
 
     def __init__(self, *args, **kwargs):
         meta.HasPaths.__init__(self, *args, **kwargs)
@@ -48,15 +92,65 @@ class Config(meta.HasPaths):
 
         return meta.HasPaths.expand_path(self, path, extra=extra)
 
+    def get_events(self):
+        return self.dataset_config.get_events()
+
     def get_event_names(self):
         return self.dataset_config.get_event_names()
 
+    def get_event(self, event_name):
+        return self.dataset_config.get_event(event_name)
+
     def get_dataset(self, event_name):
         return self.dataset_config.get_dataset(event_name)
 
     def get_engine(self):
         return self.engine_config.get_engine()
 
+    def get_value_names(self):
+        '''
+        Get names of the output columns of all measures.
+
+        Raises :py:exc:`~wafe.meta.WafeError` if names are not unique.
+        '''
+
+        names = []
+        for feature_measure in self.measures:
+            names.extend(feature_measure.get_value_names())
+
+        seen = set()
+        duplicates = []
+        for name in names:
+            if name in seen and name not in duplicates:
+                duplicates.append(name)
+
+            seen.add(name)
+
+        if duplicates:
+            raise meta.WafeError(
+                'output column names are not unique, check names and bands '
+                'of the measures: %s' % ', '.join(duplicates))
+
+        return names
+
+    def get_extraction_hash(self):
+        '''
+        Get digest of the settings which determine the extraction results.
+        '''
+
+        # cache settings affect only the performance
+        dataset_config = copy.copy(self.dataset_config)
+        for name in performance_settings:
+            setattr(dataset_config, name, None)
+
+        h = hashlib.sha1()
+        for obj in [dataset_config] + self.measures:
+            h.update(dump(obj).encode('utf8'))
+
+        h.update(self.store_id.encode('utf8'))
+        h.update(self.output_format.encode('utf8'))
+        return h.hexdigest()
+
 
 def read_config(path):
     try:
@@ -69,6 +163,7 @@ def read_config(path):
 
     config.set_basepath(op.dirname(path) or '.')
     config.set_config_name(op.splitext(op.basename(path))[0])
+    config.get_value_names()
 
     return config
 
@@ -0,0 +1,248 @@
+from __future__ import print_function
+import logging
+import os.path as op
+
+import numpy as num
+
+from pyrocko import gf, model, trace, util
+
+from wafe import measure as wmeasure, dataset, config as wconfig, \
+    meta as wmeta, results as wresults
+
+
+logger = logging.getLogger('wafe.continuous')
+
+
+def get_window_tmins(continuous_config):
+    cc = continuous_config
+    step = cc.get_window_step()
+    nwindows = int(num.floor(
+        (cc.tmax - cc.tmin - cc.window_length) / step + 1e-6)) + 1
+
+    return cc.tmin + num.arange(max(nwindows, 0)) * step
+
+
+def get_chunks(continuous_config):
+    '''
+    Split the windows of a continuous run into chunks.
+
+    Yields arrays with the start times of the windows of each chunk.
+    '''
+
+    cc = continuous_config
+    window_tmins = get_window_tmins(cc)
+    nwindows_chunk = max(1, int(round(cc.chunk_length / cc.get_window_step())))
+    for i in range(0, window_tmins.size, nwindows_chunk):
+        yield window_tmins[i:i+nwindows_chunk]
+
+
+def get_padding(config):
+    '''
+    Get time padding needed to keep filter transients out of the windows.
+    '''
+
+    if config.continuous_config.tpad is not None:
+        return config.continuous_config.tpad
+
+    # transients of the band-pass filters decay over a few periods of the
+    # lower corner frequency, which is the restitution taper length
+    return 5.0 * max(
+        [measure.get_restitution_parameters()[1]
+         for measure in config.measures] + [0.0])
+
+
+def process_windows(
+        engine, measure, station, ds, window_tmins, window_length, tpad,
+        graph):
+
+    '''
+    Process a span of consecutive windows of a station for one measure.
+
+    The span is restituted and filtered at once, with padding on both
+    sides, before it is cut into the windows. Returns a list with the
+    processed traces of each window, ``None`` for windows without usable
+    data.
+    '''
+
+    targets = [
+        gf.Target(
+            quantity='velocity',
+            codes=station.nsl() + (component,),
+            lat=station.lat,
+            lon=station.lon,
+            depth=station.depth,
+            elevation=station.elevation)
+
+        for component in measure.components]
+
+    tmin = window_tmins[0] - tpad
+    tmax = window_tmins[-1] + window_length + tpad
+
+    _, trs_processed = measure.process(
+        engine, None, targets, ds,
+        windows=[(tmin, tmax)] * len(targets),
+        graph=graph)
+
+    window_traces = []
+    for window_tmin in window_tmins:
+        try:
+            trs = [
+                tr.chop(
+                    window_tmin, window_tmin + window_length,
+                    inplace=False)
+                for tr in trs_processed]
+
+            measure.check_traces(trs)
+
+        except (trace.NoData, wmeasure.FeatureMeasurementFailed):
+            trs = None
+
+        window_traces.append(trs)
+
+    return window_traces
+
+
+def extract_chunk(config, ds, stations, window_tmins):
+    '''
+    Extract features on sliding windows of one chunk of continuous data.
+
+    For each station, the whole chunk is restituted and filtered once per
+    distinct processing chain, with padding on both sides, before it is cut
+    into the windows. If this fails, e.g. because of a gap in the data, the
+    windows are processed separately, so that only the windows affected
+    are lost. Returns a list of ``(window_tmin, station, values)`` rows.
+    '''
+
+    engine = config.get_engine()
+    window_length = config.continuous_config.window_length
+    tpad = get_padding(config)
+
+    def station_str(station):
+        return '.'.join(x for x in station.nsl())
+
+    def span_str(tmins):
+        return '%s - %s' % (
+            util.time_to_str(tmins[0]),
+            util.time_to_str(tmins[-1] + window_length))
+
+    rows = []
+    for station in stations:
+        graph = wmeasure.ProcessingGraph()
+        measure_window_traces = []
+        for measure in config.measures:
+            try:
+                window_traces = process_windows(
+                    engine, measure, station, ds, window_tmins,
+                    window_length, tpad, graph)
+
+            except (wmeasure.FeatureMeasurementFailed,
+                    dataset.NotFound) as e:
+
+                logger.warn(
+                    'processing failed for %s, %s, processing windows '
+                    'separately:\n   %s' % (
+                        station_str(station), span_str(window_tmins), e))
+
+                window_traces = []
+                for window_tmin in window_tmins:
+                    try:
+                        window_traces.extend(process_windows(
+                            engine, measure, station, ds, [window_tmin],
+                            window_length, tpad, graph))
+
+                    except (wmeasure.FeatureMeasurementFailed,
+                            dataset.NotFound) as e:
+
+                        logger.debug(
+                            'processing failed for %s, %s:\n   %s' % (
+                                station_str(station),
+                                span_str([window_tmin]), e))
+
+                        window_traces.append(None)
+
+            measure_window_traces.append(window_traces)
+
+        # like in event extraction, a window is used only if all measures
+        # could be processed
+        iwindows = [
+            iwindow for iwindow in range(len(window_tmins))
+            if all(window_traces[iwindow] is not None
+                   for window_traces in measure_window_traces)]
+
+        if len(iwindows) < len(window_tmins):
+            logger.warn(
+                'feature extraction failed for %s, %s in %i of %i '
+                'windows' % (
+                    station_str(station), span_str(window_tmins),
+                    len(window_tmins) - len(iwindows), len(window_tmins)))
+
+        if not iwindows:
+            continue
+
+        measure_values = []
+        for measure, window_traces in zip(
+                config.measures, measure_window_traces):
+
+            values, _ = measure.evaluate_batch(
+                [window_traces[iwindow] for iwindow in iwindows])
+
+            measure_values.append(values)
+
+        for i, iwindow in enumerate(iwindows):
+            rows.append((
+                window_tmins[iwindow], station,
+                [float(value)
+                 for values in measure_values
+                 for value in num.atleast_1d(values[i])]))
+
+    rows.sort(key=lambda row: row[0])
+    return rows
+
+
+def get_window_name(window_tmin):
+    return util.time_to_str(window_tmin, format='%Y-%m-%dT%H:%M:%S.3FRAC')
+
+
+def run_continuous(config):
+    '''
+    Extract features on sliding windows over continuous data.
+
+    The time span is processed in chunks of consecutive windows, so memory
+    use does not depend on its length. Results are written like those of
+    :py:func:`wafe.core.run_extract`, with the start time of the window in
+    place of the event name. Event and station are co-located, so the
+    distance column is zero.
+    '''
+
+    if config.continuous_config is None:
+        raise wmeta.WafeError(
+            'continuous_config is required for continuous extraction')
+
+    output_path = config.expand_path(config.output_path)
+    util.ensuredir(output_path)
+    wconfig.write_config(config, op.join(output_path, 'config.yaml'))
+
+    ds = config.get_dataset(None)
+    stations = ds.get_stations()
+    window_length = config.continuous_config.window_length
+
+    with wresults.get_results_writer(
+            config.output_format, output_path,
+            config.get_value_names()) as writer:
+
+        for window_tmins in get_chunks(config.continuous_config):
+            logger.info('processing %s - %s' % (
+                util.time_to_str(window_tmins[0]),
+                util.time_to_str(window_tmins[-1] + window_length)))
+
+            rows = extract_chunk(config, ds, stations, window_tmins)
+            for window_tmin, station, values in rows:
+                event = model.Event(
+                    lat=station.lat,
+                    lon=station.lon,
+                    time=window_tmin,
+                    name=get_window_name(window_tmin))
+
+                writer.write(event, station, values)
+
+            writer.flush()
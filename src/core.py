@@ -1,10 +1,19 @@
 from __future__ import print_function
+import os
+import json
+import hashlib
 import logging
+import multiprocessing
+import threading
 import os.path as op
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as num
 
 from pyrocko import gf, trace, util
 
-from wafe import measure as wmeasure, dataset, config as wconfig
+from wafe import measure as wmeasure, dataset, config as wconfig, \
+    meta as wmeta, results as wresults, stats as wstats
 
 
 logger = logging.getLogger('wafe.core')
@@ -14,84 +23,710 @@ class NoData(Exception):
     pass
 
 
-def run_extract(config, debug=False):
+class StationWindowPlanner(object):
+    '''
+    Read the raw waveform data of a station once for all measures.
+
+    Time windows of all measures are registered with :py:meth:`plan` before
+    any data is requested. On first access, the waveform files overlapping
+    with the union of the planned windows, padded by the taper lengths, are
+    loaded and held until :py:meth:`release` is called. Each request is
+    still restituted over its own window and taper length, so that the
+    result of a measure does not depend on the other measures.
+    :py:meth:`get_waveform` mimics
+    :py:meth:`wafe.dataset.Dataset.get_waveform`.
+    '''
+
+    def __init__(self, ds):
+        self._ds = ds
+        self._spans = {}
+        self._files = {}
+
+    def plan(
+            self, codes, tmin, tmax, quantity='displacement',
+            freqlimits=None, tfade=0.0, extra_responses=None):
+
+        nsl = tuple(codes[:3])
+        tmin, tmax = tmin - tfade, tmax + tfade
+        if nsl in self._spans:
+            span_tmin, span_tmax = self._spans[nsl]
+            self._spans[nsl] = min(span_tmin, tmin), max(span_tmax, tmax)
+        else:
+            self._spans[nsl] = tmin, tmax
+
+    def _load(self, nsl):
+        if nsl in self._files or nsl not in self._spans:
+            return
+
+        # station delays shift the raw data requested
+        tpad = max([
+            abs(sc.delay)
+            for (codes, sc) in self._ds.station_corrections.items()
+            if codes[:3] == nsl] + [0.0])
+
+        tmin, tmax = self._spans[nsl]
+        tmin -= tpad
+        tmax += tpad
+
+        index = self._ds.get_waveform_index()
+        files = set()
+        for cha in index.get_channels(nsl, tmin, tmax):
+            for tr in index.relevant(nsl + (cha,), tmin, tmax):
+                if tr.file is not None:
+                    files.add(tr.file)
+
+        held = self._files[nsl] = []
+        for file in files:
+            dataset.use_file_data(file)
+            held.append(file)
+
+    def get_waveform(
+            self, codes, quantity='displacement', tmin=None, tmax=None,
+            freqlimits=None, tfade=0.0, extra_responses=None):
+
+        self._load(tuple(codes[:3]))
+        return self._ds.get_waveform(
+            codes, quantity=quantity, tmin=tmin, tmax=tmax,
+            freqlimits=freqlimits, tfade=tfade,
+            extra_responses=extra_responses)
+
+    def release(self):
+        '''
+        Free the raw waveform data held.
+        '''
+
+        for held in self._files.values():
+            dataset.drop_file_data(held)
+
+        self._files = {}
+
+
+def get_station_windows(config, source, stations):
+    '''
+    Get time windows of all measures at all stations.
+
+    Returns an array of shape ``(len(config.measures), len(stations), 2)``,
+    see :py:func:`wafe.measure.get_time_windows`.
+    '''
+
+    station_targets = [
+        gf.Target(
+            quantity='velocity',
+            codes=station.nsl() + ('',),
+            store_id=config.store_id,
+            lat=station.lat,
+            lon=station.lon,
+            depth=station.depth,
+            elevation=station.elevation)
+
+        for station in stations]
+
+    return wmeasure.get_time_windows(
+        config.get_engine(), source, config.measures, station_targets)
+
+
+def extract_event(config, event_name, debug=False):
+    try:
+        ds = config.get_dataset(event_name)
+    except OSError as e:
+        logger.warn(
+            'could not get dataset for event %s: %s' % (event_name, e))
+        return []
+
+    return extract_stations(
+        config, ds, ds.get_event(), ds.get_stations(), debug=debug)
+
+
+def extract_stations(
+        config, ds, event, stations, station_windows=None, debug=False):
+
+    '''
+    Extract features of an event at the given stations.
+
+    Returns a list of ``(event, station, values)`` rows for the stations
+    where all measures succeeded.
+    '''
+
     engine = config.get_engine()
+    source = gf.DCSource.from_pyrocko_event(event)
+
+    # time windows of all measures at all stations in one go, before any
+    # waveform is read
+    if station_windows is None:
+        with wstats.timer('travel_times'):
+            station_windows = get_station_windows(config, source, stations)
+
+    debug_traces = []
+    ok_stations = []
+    measure_station_traces = [[] for measure in config.measures]
+    nrequested = 0
+    ndeduplicated = 0
+    for istation, station in enumerate(stations):
+
+        planner = StationWindowPlanner(ds)
+        try:
+            graph = wmeasure.ProcessingGraph()
+            measure_targets = []
+            measure_windows = []
+            for imeasure, measure in enumerate(config.measures):
+                tmin, tmax = station_windows[imeasure, istation]
+                if not (num.isfinite(tmin) and num.isfinite(tmax)):
+                    raise wmeasure.FeatureMeasurementFailed(
+                        'timing determination failed (phase unavailable?)')
+
+                targets = [
+                    gf.Target(
+                        quantity='velocity',
+                        codes=station.nsl() + (component,),
+                        store_id=config.store_id,
+                        lat=station.lat,
+                        lon=station.lon,
+                        depth=station.depth,
+                        elevation=station.elevation)
+
+                    for component in measure.components]
+
+                windows = []
+                for target in targets:
+                    planner.plan(
+                        target.codes, tmin, tmax,
+                        **measure.get_waveform_parameters(target))
+
+                    windows.append((tmin, tmax))
+
+                measure_targets.append(targets)
+                measure_windows.append(windows)
+
+            station_traces = []
+            for measure, targets, windows in zip(
+                    config.measures, measure_targets, measure_windows):
+
+                trs_orig, trs_processed = measure.process(
+                    engine, source, targets, planner,
+                    windows=windows,
+                    graph=graph)
+
+                measure.check_traces(trs_processed)
+
+                if debug:
+                    trs_orig, trs_processed = measure.get_debug_traces(
+                        trs_orig, trs_processed)
+
+                    debug_traces.extend(trs_orig)
+                    debug_traces.extend(trs_processed)
+
+                station_traces.append(trs_processed)
+
+            for imeasure, trs_processed in enumerate(station_traces):
+                measure_station_traces[imeasure].append(trs_processed)
+
+            ok_stations.append(station)
+            nrequested += graph.nrequested
+            ndeduplicated += graph.ndeduplicated
+
+        except (wmeasure.FeatureMeasurementFailed,
+                dataset.NotFound,
+                gf.OutOfBounds) as e:
+
+            wstats.count('failures.%s' % e.__class__.__name__)
+            logger.warn(
+                'feature extraction failed for %s, %s:\n   %s' % (
+                    event.name,
+                    '.'.join(x for x in station.nsl()),
+                    e))
+
+        finally:
+            planner.release()
+
+    logger.info(
+        'processing of %s: %i of %i nodes shared between measures' % (
+            event.name, ndeduplicated, nrequested))
+
+    # each measure is computed for all stations of the event at once
+    measure_values = []
+    debug_markers = []
+    for measure, station_traces in zip(
+            config.measures, measure_station_traces):
+
+        with wstats.timer('measurement'):
+            values, debug_infos = measure.evaluate_batch(
+                station_traces, debug=debug)
+
+        measure_values.append(values)
+        for traces_this, markers_this in debug_infos:
+            debug_traces.extend(traces_this)
+            debug_markers.extend(markers_this)
+
+    rows = []
+    for istation, station in enumerate(ok_stations):
+        rows.append((
+            event, station,
+            [float(value)
+             for values in measure_values
+             for value in num.atleast_1d(values[istation])]))
+
+    if debug:
+        trace.snuffle(
+            debug_traces, markers=debug_markers,
+            events=[event],
+            stations=stations)
+
+    return rows
+
+
+class Prefetcher(object):
+    '''
+    Prepare datasets of upcoming events in a background thread.
+
+    While one event is processed, the datasets of the next ``nahead``
+    events are set up, which indexes their waveform files, and the raw data
+    of the files overlapping with their time windows is loaded and held in
+    memory, up to ``nbytes_max`` bytes in total. Call :py:meth:`wait` before
+    processing an event and :py:meth:`release` after it.
+    '''
+
+    def __init__(self, config, event_names, nahead=1, nbytes_max=None):
+        self._config = config
+        self._event_names = list(event_names)
+        self._positions = dict(
+            (name, i) for (i, name) in enumerate(self._event_names))
+        self._nahead = nahead
+        self._nbytes_max = nbytes_max
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._futures = {}
+
+        # guards _held and _nbytes, which are changed by both threads
+        self._lock = threading.Lock()
+        self._held = {}
+        self._nbytes = 0
+
+    def _schedule(self, event_name):
+        i = self._positions[event_name]
+        for event_name in self._event_names[i:i+self._nahead+1]:
+            if event_name not in self._futures:
+                self._futures[event_name] = self._executor.submit(
+                    self._prefetch, event_name)
+
+    def _prefetch(self, event_name):
+        config = self._config
+        try:
+            ds = config.get_dataset(event_name)
+            event = ds.get_event()
+            stations = ds.get_stations()
+            index = ds.get_waveform_index()
+
+            source = gf.DCSource.from_pyrocko_event(event)
+            windows = get_station_windows(config, source, stations)
+            tpad = max(
+                [measure.get_restitution_parameters()[1]
+                 for measure in config.measures] + [0.0])
+
+            files = set()
+            for istation, station in enumerate(stations):
+                tmin = num.nanmin(windows[:, istation, 0]) - tpad
+                tmax = num.nanmax(windows[:, istation, 1]) + tpad
+                if not (num.isfinite(tmin) and num.isfinite(tmax)):
+                    continue
+
+                nsl = station.nsl()
+                for cha in index.get_channels(nsl, tmin, tmax):
+                    for tr in index.relevant(nsl + (cha,), tmin, tmax):
+                        if tr.file is not None:
+                            files.add(tr.file)
+
+            with self._lock:
+                held = self._held.setdefault(event_name, [])
+
+            for file in sorted(files, key=lambda file: file.abspath or ''):
+                if self._nbytes_max is not None \
+                        and self._nbytes >= self._nbytes_max:
+
+                    logger.debug(
+                        'prefetch memory limit reached, not prefetching '
+                        'further data for event %s' % event_name)
+                    break
+
+                dataset.use_file_data(file)
+                nbytes = sum(
+                    tr.ydata.nbytes for tr in file.traces
+                    if tr.ydata is not None)
+
+                with self._lock:
+                    held.append((file, nbytes))
+                    self._nbytes += nbytes
+
+        except Exception as e:
+            # errors are reported when the event is processed
+            logger.debug(
+                'prefetching data for event %s failed: %s' % (event_name, e))
+
+    def wait(self, event_name):
+        '''
+        Wait until prefetching for an event has finished and start
+        prefetching for the following events.
+        '''
+
+        self._schedule(event_name)
+        self._futures[event_name].result()
+
+    def release(self, event_name):
+        '''
+        Free the prefetched data of a processed event.
+        '''
+
+        self._futures.pop(event_name).result()
+        with self._lock:
+            held = self._held.pop(event_name, [])
+            self._nbytes -= sum(nbytes for (_, nbytes) in held)
+
+        dataset.drop_file_data([file for (file, _) in held])
+
+        self._config.dataset_config.forget_dataset(event_name)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        for event_name in list(self._futures):
+            self.release(event_name)
+
+
+def log_cache_report(report):
+    for name, entry in sorted(report.items()):
+        if 'nbytes' in entry:
+            logger.info('cache %s: %i entries, %.1f of %.1f MB' % (
+                name, entry['nentries'],
+                entry['nbytes'] / 1e6, entry['nbytes_max'] / 1e6))
+        else:
+            logger.info('cache %s: %i entries' % (name, entry['nentries']))
+
+
+def get_shard(event_name, nshards):
+    '''
+    Get the shard an event belongs to when a run is split into ``nshards``.
+
+    The assignment depends only on the event name, so it is the same on all
+    hosts and in all runs.
+    '''
+
+    digest = hashlib.sha1(event_name.encode('utf8')).hexdigest()
+    return int(digest, 16) % nshards
+
+
+def get_shard_path(output_path, ishard, nshards):
+    return op.join(output_path, 'shards', '%i-of-%i' % (ishard+1, nshards))
+
+
+def get_shard_paths(output_path):
+    '''
+    Find the shard output directories of a run.
+
+    Returns a list with the directories of all shards, ordered by shard
+    index. Raises :py:exc:`wafe.meta.WafeError` if shards are missing or if
+    shards of runs with different numbers of shards are present.
+    '''
+
+    shards_path = op.join(output_path, 'shards')
+    if not op.isdir(shards_path):
+        raise wmeta.WafeError('no shard outputs found in %s' % shards_path)
+
+    shards = set()
+    for entry in os.listdir(shards_path):
+        try:
+            ishard, nshards = map(int, entry.split('-of-'))
+        except ValueError:
+            continue
+
+        shards.add((ishard-1, nshards))
+
+    nshards_set = set(nshards for (_, nshards) in shards)
+    if len(nshards_set) != 1:
+        raise wmeta.WafeError(
+            'shard outputs for different numbers of shards found in %s'
+            % shards_path)
+
+    nshards = nshards_set.pop()
+    missing = sorted(
+        set(range(nshards)) - set(ishard for (ishard, _) in shards))
+
+    if missing:
+        raise wmeta.WafeError(
+            'outputs of shards missing: %s' % ', '.join(
+                '%i/%i' % (ishard+1, nshards) for ishard in missing))
+
+    return [
+        get_shard_path(output_path, ishard, nshards)
+        for ishard in range(nshards)]
+
+
+g_worker_config = None
+
+
+def _init_worker(config, stats_enabled):
+    global g_worker_config
+    g_worker_config = config
+    wstats.enable(stats_enabled)
+
+
+def _extract_event_worker(event_name):
+    logger.info('processing event %s' % event_name)
+    try:
+        rows = extract_event(g_worker_config, event_name)
+    finally:
+        g_worker_config.dataset_config.forget_dataset(event_name)
+
+    # statistics of each event are handed over to the main process
+    return rows, wstats.g_stats.pop()
+
+
+def run_extract(
+        config, debug=False, nparallel=1, resume=False, nprefetch=0,
+        prefetch_nbytes_max=None, stats=False, shard=None):
+
+    '''
+    Extract features of all events of a configuration.
+
+    With ``shard=(ishard, nshards)``, only the events assigned to the given
+    shard by :py:func:`get_shard` are processed and results go to the
+    shard's own output directory, see :py:func:`get_shard_path`. Use
+    :py:func:`run_merge` to combine the outputs of all shards.
+    '''
+
+    if debug and nparallel > 1:
+        raise wmeta.WafeError(
+            'debug mode cannot be used with parallel processing')
+
+    if nprefetch > 0 and nparallel > 1:
+        raise wmeta.WafeError(
+            'prefetching cannot be used with parallel processing')
 
     output_path = config.expand_path(config.output_path)
+    if shard is not None:
+        ishard, nshards = shard
+        output_path = get_shard_path(output_path, ishard, nshards)
 
     util.ensuredir(output_path)
 
-    output_measures_path = op.join(output_path, 'measures.txt')
     output_config_path = op.join(output_path, 'config.yaml')
 
+    manifest = wresults.ProgressManifest(
+        output_path, config.get_extraction_hash())
+
+    if resume and manifest.load():
+        logger.info(
+            'resuming, %i events already done' % len(manifest.checkpoints))
+
+        checkpoint = manifest.last_checkpoint
+        manifest.open(append=True)
+    else:
+        checkpoint = None
+        manifest.open()
+
     wconfig.write_config(config, output_config_path)
 
-    with open(output_measures_path, 'w') as out:
+    event_names = [
+        event_name for event_name in config.get_event_names()
+        if not manifest.is_done(event_name)]
 
-        out.write('# event station %s\n' % ' '.join(
-            measure.name for measure in config.measures))
+    if shard is not None:
+        event_names = [
+            event_name for event_name in event_names
+            if get_shard(event_name, nshards) == ishard]
 
-        event_names = config.get_event_names()
-        for event_name in event_names:
-            logger.info('processing event %s' % event_name)
+        logger.info(
+            'shard %i of %i: %i events to process'
+            % (ishard+1, nshards, len(event_names)))
 
-            try:
-                ds = config.get_dataset(event_name)
-            except OSError as e:
-                logger.warn('could not get dataset for event %s' % event_name)
-                continue
+    if stats:
+        wstats.enable()
+        progress = wstats.Progress(len(event_names))
+    else:
+        progress = None
 
-            event = ds.get_event()
-            source = gf.DCSource.from_pyrocko_event(event)
-            stations = ds.get_stations()
+    try:
+        with wresults.get_results_writer(
+                config.output_format, output_path,
+                config.get_value_names(),
+                checkpoint=checkpoint) as writer:
 
-            debug_infos = []
-            for station in stations:
+            def write(event_name, rows):
+                for event, station, values in rows:
+                    writer.write(event, station, values)
+
+                manifest.mark_done(event_name, writer.commit())
+                if progress is not None:
+                    progress.update(len(rows))
+
+            if nparallel > 1:
+                # each worker process gets its own copy of the configuration,
+                # so that the engine and GF stores are set up once per worker.
+                # imap keeps the results in the order of event_names.
+                pool = multiprocessing.Pool(
+                    processes=nparallel,
+                    initializer=_init_worker,
+                    initargs=(config, stats))
+
+                try:
+                    for event_name, (rows, stats_worker) in zip(
+                            event_names,
+                            pool.imap(_extract_event_worker, event_names)):
+
+                        wstats.g_stats.merge(stats_worker)
+                        write(event_name, rows)
+
+                finally:
+                    pool.terminate()
+                    pool.join()
+
+            elif nprefetch > 0:
+                prefetcher = Prefetcher(
+                    config, event_names,
+                    nahead=nprefetch,
+                    nbytes_max=prefetch_nbytes_max)
 
-                values = []
                 try:
-                    for measure in config.measures:
-                        targets = [
-                            gf.Target(
-                                quantity='velocity',
-                                codes=station.nsl() + (component,),
-                                store_id=config.store_id,
-                                lat=station.lat,
-                                lon=station.lon,
-                                depth=station.depth,
-                                elevation=station.elevation)
-
-                            for component in measure.components]
-
-                        value, debug_info = measure.evaluate(
-                            engine, source, targets, ds, debug=debug)
-
-                        values.append(value)
-                        debug_infos.append(debug_info)
-
-                    out.write('%s %s %s\n' % (
-                        event.name,
-                        '.'.join(x for x in station.nsl()),
-                        ' '.join('%g' % value for value in values)))
-
-                except (wmeasure.FeatureMeasurementFailed,
-                        dataset.NotFound,
-                        gf.OutOfBounds) as e:
-
-                    logger.warn(
-                        'feature extraction failed for %s, %s:\n   %s' % (
-                            event.name,
-                            '.'.join(x for x in station.nsl()),
-                            e))
-
-            if debug:
-                traces = []
-                markers = []
-                for traces_this, markers_this in debug_infos:
-                    traces.extend(traces_this)
-                    markers.extend(markers_this)
-
-                trace.snuffle(
-                    traces, markers=markers,
-                    events=[event],
-                    stations=stations)
+                    for event_name in event_names:
+                        prefetcher.wait(event_name)
+                        logger.info('processing event %s' % event_name)
+                        write(
+                            event_name,
+                            extract_event(config, event_name, debug=debug))
+
+                        prefetcher.release(event_name)
+
+                finally:
+                    prefetcher.close()
+
+            else:
+                for event_name in event_names:
+                    logger.info('processing event %s' % event_name)
+                    try:
+                        rows = extract_event(config, event_name, debug=debug)
+                    finally:
+                        config.dataset_config.forget_dataset(event_name)
+
+                    write(event_name, rows)
+
+    finally:
+        manifest.close()
+
+        # with worker processes, the caches of the main process are unused
+        if nparallel > 1:
+            caches = None
+        else:
+            caches = config.dataset_config.get_cache_report()
+            log_cache_report(caches)
+
+        if progress is not None:
+            stats_path = op.join(output_path, 'stats.json')
+            wstats.write_report(stats_path, progress, caches=caches)
+            logger.info('statistics written to %s' % stats_path)
+
+
+def run_merge(config, allow_incomplete=False):
+    '''
+    Combine the outputs of a sharded extraction run.
+
+    The results of all shards are written to the output directory of the
+    configuration, as if the run had not been sharded, along with a progress
+    manifest, so that the merged output can be completed with
+    ``run_extract(..., resume=True)``. The shards must have been run with
+    the given configuration and their ``config.yaml`` files must agree.
+    Unless ``allow_incomplete`` is set, every event of the configuration
+    must have been completed by its shard. An event completed by more than
+    one shard is always an error.
+    '''
+
+    output_path = config.expand_path(config.output_path)
+    shard_paths = get_shard_paths(output_path)
+    config_hash = config.get_extraction_hash()
+
+    config_texts = []
+    manifests = []
+    for shard_path in shard_paths:
+        manifest = wresults.ProgressManifest(shard_path, config_hash)
+        if not manifest.load():
+            raise wmeta.WafeError(
+                'no progress manifest found in %s' % shard_path)
+
+        with open(op.join(shard_path, 'config.yaml'), 'r') as f:
+            config_texts.append(f.read())
+
+        manifests.append(manifest)
+
+    if any(text != config_texts[0] for text in config_texts):
+        raise wmeta.WafeError(
+            'configurations of the shards in %s do not agree'
+            % op.join(output_path, 'shards'))
+
+    event_shards = {}
+    for ishard, manifest in enumerate(manifests):
+        for event_name in manifest.checkpoints:
+            event_shards.setdefault(event_name, []).append(ishard)
+
+    duplicates = sorted(
+        event_name for (event_name, ishards) in event_shards.items()
+        if len(ishards) > 1)
+
+    if duplicates:
+        raise wmeta.WafeError(
+            'events processed by more than one shard: %s'
+            % ', '.join(duplicates))
+
+    event_names = config.get_event_names()
+    missing = [
+        event_name for event_name in event_names
+        if event_name not in event_shards]
+
+    if missing:
+        message = '%i events have not been processed: %s' % (
+            len(missing), ', '.join(missing))
+
+        if not allow_incomplete:
+            raise wmeta.WafeError(message)
+
+        logger.warn(message)
+
+    unknown = set(event_shards) - set(event_names)
+    if unknown:
+        logger.warn(
+            'ignoring results of %i events not in the configuration'
+            % len(unknown))
+
+    event_order = [
+        (event_name, event_shards[event_name][0])
+        for event_name in event_names
+        if event_name in event_shards]
+
+    wconfig.write_config(config, op.join(output_path, 'config.yaml'))
+
+    manifest = wresults.ProgressManifest(output_path, config_hash)
+    manifest.open()
+    try:
+        checkpoints = wresults.merge_results(
+            config.output_format,
+            [(shard_path, shard_manifest.last_checkpoint)
+             for (shard_path, shard_manifest)
+             in zip(shard_paths, manifests)],
+            event_order,
+            output_path,
+            config.get_value_names())
+
+        for (event_name, _), checkpoint in zip(event_order, checkpoints):
+            manifest.mark_done(event_name, checkpoint)
+
+    finally:
+        manifest.close()
+
+    reports = []
+    for shard_path in shard_paths:
+        stats_path = op.join(shard_path, 'stats.json')
+        if op.exists(stats_path):
+            with open(stats_path, 'r') as f:
+                reports.append(json.load(f))
+
+    if reports:
+        with open(op.join(output_path, 'stats.json'), 'w') as f:
+            json.dump(wstats.merge_reports(reports), f, indent=2)
+
+    logger.info(
+        'merged results of %i events from %i shards'
+        % (len(event_order), len(shard_paths)))
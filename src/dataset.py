@@ -1,39 +1,436 @@
+import os
 import glob
 import copy
+import bisect
+import weakref
+import threading
+import hashlib
+import uuid
 import logging
+import pickle
+import tempfile
 import numpy as num
 
 from collections import defaultdict
+from contextlib import contextmanager
 from pyrocko import util, pile, model, config, trace, \
     marker as pmarker
-from pyrocko.fdsn import enhanced_sacpz, station as fs
-from pyrocko.guts import (Object, Tuple, String, Float, List, Bool, dump_all,
-                          load_all)
+from pyrocko.fdsn import enhanced_sacpz
+from pyrocko.guts import (Object, Tuple, String, Float, List, Bool, dump,
+                          dump_all, load_all)
 
-from .meta import Path, HasPaths, expand_template
+from .meta import Path, HasPaths, expand_template, get_template_placeholders
+from . import stats as wstats, index as windex
+from .cache import MemoryCache, register_memory_cache, \
+    set_memory_cache_size_max, get_cache_report, \
+    memory_cache_size_max_default
 
 guts_prefix = 'wafe'
 logger = logging.getLogger('wafe.dataset')
 
 
-g_sx_cache = {}
+class TaperedCoeffsCache(MemoryCache):
+    '''
+    Bounded replacement of the cache of tapered transfer coefficients of
+    Pyrocko.
 
+    :py:meth:`pyrocko.trace.Trace.transfer` keeps the tapered coefficients
+    for each response, FFT length and sampling interval in a module-level
+    dict, which grows without limit. Within :py:func:`transfer`, this cache
+    is used instead, so that the coefficients are subject to the size limit
+    of the in-memory caches.
+    '''
 
-def cached_load_stationxml(fn):
-    if fn not in g_sx_cache:
-        g_sx_cache[fn] = fs.load_xml(filename=fn)
+    def __init__(self, name, nbytes_max):
+        MemoryCache.__init__(self, name, nbytes_max)
+        self._found = threading.local()
 
-    return g_sx_cache[fn]
+    def __contains__(self, key):
+        # Pyrocko checks for the key before fetching the entry; the entry is
+        # kept, so that another thread cannot evict it in between
+        value = self.get(key)
+        self._found.entry = (key, value)
+        return value is not None
 
+    def __getitem__(self, key):
+        entry = getattr(self._found, 'entry', None)
+        self._found.entry = None
+        if entry is not None and entry[0] == key and entry[1] is not None:
+            return entry[1]
 
-g_events_cache = {}
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+
+        return value
+
+    def __setitem__(self, key, value):
+        self.put(key, value, value.nbytes)
+
+
+g_tapered_coeffs_cache = register_memory_cache(TaperedCoeffsCache(
+    'tapered_coeffs_cache', memory_cache_size_max_default))
+
+g_transfer_lock = threading.Lock()
+g_transfer_state = dict(ntransfers=0, pyrocko_cache=None)
+
+
+@contextmanager
+def bounded_tapered_coeffs_cache():
+    '''
+    Let Pyrocko use :py:data:`g_tapered_coeffs_cache` within the context.
+
+    The override is counted, so that it stays in place until the last of
+    several concurrent transfers has finished. Outside of it, the cache of
+    Pyrocko is left as it is.
+    '''
+
+    with g_transfer_lock:
+        if g_transfer_state['ntransfers'] == 0:
+            g_transfer_state['pyrocko_cache'] = trace.g_tapered_coeffs_cache
+            trace.g_tapered_coeffs_cache = g_tapered_coeffs_cache
+
+        g_transfer_state['ntransfers'] += 1
+
+    try:
+        yield
+
+    finally:
+        with g_transfer_lock:
+            g_transfer_state['ntransfers'] -= 1
+            if g_transfer_state['ntransfers'] == 0:
+                trace.g_tapered_coeffs_cache = \
+                    g_transfer_state['pyrocko_cache']
+
+                g_transfer_state['pyrocko_cache'] = None
+
+
+def transfer(tr, **kwargs):
+    '''
+    Like :py:meth:`pyrocko.trace.Trace.transfer`, caching the tapered
+    coefficients in :py:data:`g_tapered_coeffs_cache`.
+    '''
+
+    with bounded_tapered_coeffs_cache():
+        return tr.transfer(**kwargs)
+
+
+g_responses_cache = register_memory_cache(MemoryCache(
+    'response_cache', memory_cache_size_max_default))
+
+
+class StationXMLResponses(object):
+    '''
+    Per-NSLC epoch index of the responses in a StationXML document.
+
+    Responses are read from the persistent index of the document and
+    memoized per channel epoch and quantity in
+    :py:data:`g_responses_cache`.
+    '''
+
+    def __init__(self, sx_index):
+        self.sx_index = sx_index
+
+    def get_epochs(self, nslc, tmin, tmax):
+        return self.sx_index.get_epochs(nslc, tmin, tmax)
+
+    def get_response(self, nslc, tmin, tmax, quantity='displacement'):
+        '''
+        Get response of a channel for a time span.
+
+        Returns ``None`` if the document has no response or multiple
+        responses matching the given channel and time span.
+        '''
+
+        iepochs = self.get_epochs(nslc, tmin, tmax)
+        if len(iepochs) != 1:
+            return None
+
+        # the index is part of the key, so that responses of an outdated
+        # index are not used
+        k = (self.sx_index, iepochs[0], quantity)
+        resp = g_responses_cache.get(k)
+        if resp is None:
+            resp = self.sx_index.get_response(iepochs[0], quantity)
+            g_responses_cache.put(k, resp, len(dump(resp)))
+
+        return resp
+
+
+def cached_load_stationxml_responses(fn):
+    return StationXMLResponses(windex.load_stationxml_index(fn))
 
 
 def cached_load_events(fn):
-    if fn not in g_events_cache:
-        g_events_cache[fn] = model.load_events(fn)
+    return windex.load_event_catalog(fn).get_events()
+
+
+def load_pile_files(p, paths, regex=None, fileformat='detect',
+                    show_progress=False):
+
+    logger.debug('Loading waveform data from %s' % paths)
+
+    cachedirname = config.config().cache_dir
+    fns = util.select_files(paths, regex=regex,
+                            show_progress=show_progress)
+    cache = pile.get_cache(cachedirname)
+    p.load_files(sorted(fns), cache=cache,
+                 fileformat=fileformat,
+                 show_progress=show_progress)
+
+
+def update_pile_files(p, paths, regex=None, fileformat='detect'):
+    '''
+    Add new files and reload modified files of a waveform archive.
+
+    Returns ``True`` if the contents of the pile changed.
+    '''
+
+    changed = p.reload_modified()
+
+    fns = [
+        fn for fn in util.select_files(paths, regex=regex, show_progress=False)
+        if os.path.abspath(fn) not in p.abspaths]
+
+    if fns:
+        load_pile_files(p, fns, fileformat=fileformat)
+        changed = True
+
+    return changed
+
+
+g_pile_cache = register_memory_cache(MemoryCache(
+    'pile_cache', memory_cache_size_max_default))
+
+# approximate memory used by the header of a trace in a pile [bytes]
+pile_trace_nbytes = 1000
+
+# serializes indexing of waveform files, which may happen concurrently when
+# datasets are prepared in a background thread
+g_pile_lock = threading.RLock()
+
+# serializes the bookkeeping of waveform file data use, which may happen
+# concurrently when data is prefetched in a background thread; the data
+# itself is read without holding the lock
+g_file_data_lock = threading.Lock()
+g_file_data_loading = {}
+
+
+def get_shared_pile(paths, regex=None, fileformat='detect',
+                    show_progress=False):
+
+    k = (tuple(paths), regex, fileformat)
+    with g_pile_lock:
+        p = g_pile_cache.get(k)
+        if p is None:
+            p = pile.Pile()
+            load_pile_files(
+                p, paths, regex=regex, fileformat=fileformat,
+                show_progress=show_progress)
+
+            g_pile_cache.put(k, p, pile_trace_nbytes * sum(
+                len(file.traces) for file in p.iter_files()))
 
-    return g_events_cache[fn]
+        return p
+
+
+def use_file_data(file):
+    '''
+    Load the data of a waveform file, if needed, and mark it as in use.
+
+    The data must be released with :py:func:`drop_file_data`. A file is
+    read by one thread at a time, other threads wanting the same file wait
+    for it. Returns ``True`` if the traces of the file have changed.
+    '''
+
+    while True:
+        with g_file_data_lock:
+            loading = g_file_data_loading.get(file)
+            if loading is None:
+                if file.data_loaded:
+                    file.use_data()
+                    return False
+
+                loading = threading.Lock()
+                loading.acquire()
+                g_file_data_loading[file] = loading
+                break
+
+        with loading:
+            pass
+
+    try:
+        if file.abspath is not None:
+            wstats.count('bytes_read', os.path.getsize(file.abspath))
+
+        changed = file.load_data()
+
+    finally:
+        with g_file_data_lock:
+            del g_file_data_loading[file]
+            if file.data_loaded:
+                file.use_data()
+
+        loading.release()
+
+    return changed
+
+
+def drop_file_data(files):
+    '''
+    Release waveform file data marked as in use by :py:func:`use_file_data`.
+    '''
+
+    with g_file_data_lock:
+        for file in files:
+            file.drop_data()
+
+
+class WaveformIndex(object):
+    '''
+    NSLC-keyed index of the trace headers in a pile.
+
+    For each channel, traces are kept sorted by start time, so that lookups
+    of the traces overlapping a given time span take logarithmic time in
+    the number of segments of that channel, independent of the number of
+    other channels in the pile. The index is rebuilt when the pile is
+    modified.
+    '''
+
+    def __init__(self, p):
+        self._pile = p
+        self._update_count = None
+        self._channels = {}
+        self._nsl_channels = {}
+        self._lock = threading.Lock()
+
+    def _update(self):
+        if self._update_count == self._pile.get_update_count():
+            return
+
+        with self._lock:
+            self._rebuild()
+
+    def _rebuild(self):
+        if self._update_count == self._pile.get_update_count():
+            return
+
+        update_count = self._pile.get_update_count()
+        by_nslc = defaultdict(list)
+        for tr in self._pile.iter_traces(load_data=False):
+            by_nslc[tr.nslc_id].append(tr)
+
+        # the new index is swapped in when complete, so that concurrent
+        # readers see either the old or the new one
+        channels = {}
+        nsl_channels = defaultdict(set)
+        for nslc, traces in by_nslc.items():
+            traces.sort(key=lambda tr: tr.tmin)
+            tmins = [tr.tmin for tr in traces]
+            tlenmax = max(tr.tmax - tr.tmin for tr in traces)
+            channels[nslc] = (tmins, traces, tlenmax)
+            nsl_channels[nslc[:3]].add(nslc[3])
+
+        self._channels, self._nsl_channels = channels, nsl_channels
+        self._update_count = update_count
+
+    def relevant(self, nslc, tmin, tmax):
+        '''
+        Get trace headers of a channel overlapping with a time span.
+        '''
+
+        self._update()
+        channels = self._channels
+        if nslc not in channels:
+            return []
+
+        tmins, traces, tlenmax = channels[nslc]
+        ifirst = bisect.bisect_left(tmins, tmin - tlenmax)
+        ilast = bisect.bisect_right(tmins, tmax)
+        return [
+            tr for tr in traces[ifirst:ilast] if tr.is_relevant(tmin, tmax)]
+
+    def get_channels(self, nsl, tmin=None, tmax=None):
+        '''
+        Get channel codes of a station, optionally restricted to channels
+        with data in a given time span.
+        '''
+
+        self._update()
+        channels = sorted(self._nsl_channels.get(nsl, ()))
+        if tmin is not None and tmax is not None:
+            channels = [
+                cha for cha in channels
+                if self.relevant(nsl + (cha,), tmin, tmax)]
+
+        return channels
+
+    def get_traces(
+            self, nslc, tmin, tmax, tpad=0., want_incomplete=True,
+            maxgap=5, maxlap=None):
+
+        '''
+        Get degapped waveforms of a channel, like :py:meth:`pile.Pile.all`.
+        '''
+
+        wmin, wmax = tmin, tmax
+        tmin, tmax = wmin - tpad, wmax + tpad
+
+        traces = self.relevant(nslc, tmin, tmax)
+        files = set(tr.file for tr in traces if tr.file is not None)
+        files_used = []
+        files_changed = False
+        try:
+            with wstats.timer('waveform_reading'):
+                for file in files:
+                    if use_file_data(file):
+                        files_changed = True
+
+                    files_used.append(file)
+
+            if files_changed:
+                traces = self.relevant(nslc, tmin, tmax)
+
+            chopped = []
+            for tr in traces:
+                try:
+                    chopped.append(tr.chop(tmin, tmax, inplace=False))
+                except trace.NoData:
+                    pass
+
+        finally:
+            drop_file_data(files_used)
+
+        chopped.sort(key=lambda tr: tr.full_id)
+        chopped = trace.degapper(chopped, maxgap=maxgap, maxlap=maxlap)
+
+        if not want_incomplete:
+            chopped_weeded = []
+            for tr in chopped:
+                emin = tr.tmin - tmin
+                emax = tr.tmax + tr.deltat - tmax
+                if abs(emin) <= 0.5*tr.deltat and abs(emax) <= 0.5*tr.deltat:
+                    chopped_weeded.append(tr)
+
+                elif (0. < emin <= 5. * tr.deltat and
+                        -5. * tr.deltat <= emax < 0.):
+
+                    tr.extend(tmin, tmax-tr.deltat, fillmethod='repeat')
+                    chopped_weeded.append(tr)
+
+            chopped = chopped_weeded
+
+        return chopped
+
+
+g_waveform_indexes = weakref.WeakKeyDictionary()
+
+
+def get_waveform_index(p):
+    if p not in g_waveform_indexes:
+        g_waveform_indexes[p] = WaveformIndex(p)
+
+    return g_waveform_indexes[p]
 
 
 class InvalidObject(Exception):
@@ -81,15 +478,172 @@ def dump_station_corrections(station_corrections, filename):
     return dump_all(station_corrections, filename=filename)
 
 
+class TraceDiskCache(object):
+    '''
+    Persistent cache of restituted traces.
+
+    Entries are pickled trace lists stored under the hex digest of their key.
+    Keys identify the raw data by the waveform files it was read from, see
+    :py:meth:`Dataset.get_waveform_restituted`.
+    When the total size of the cache exceeds ``size_max`` [bytes], least
+    recently used entries are removed. Access times are tracked through the
+    modification times of the entry files, so that the cache can be shared
+    between processes.
+    '''
+
+    def __init__(self, path, size_max=None):
+        self.path = path
+        self.size_max = size_max
+        self.nhits = 0
+        self.nmisses = 0
+        util.ensuredir(self.path)
+        self._size = self._get_entries_size()
+        if self.size_max is not None and self._size > self.size_max:
+            self.evict()
+
+    def _iter_entries(self):
+        for dirpath, _, filenames in os.walk(self.path):
+            for fn in filenames:
+                if fn.endswith('.pickle'):
+                    yield os.path.join(dirpath, fn)
+
+    def _get_entries_size(self):
+        size = 0
+        for fn in self._iter_entries():
+            try:
+                size += os.stat(fn).st_size
+            except OSError:
+                pass
+
+        return size
+
+    def _entry_path(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf8')).hexdigest()
+        return os.path.join(self.path, digest[:2], digest + '.pickle')
+
+    def get(self, key):
+        fn = self._entry_path(key)
+        try:
+            with open(fn, 'rb') as f:
+                traces = pickle.load(f)
+
+            os.utime(fn, None)
+
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.nmisses += 1
+            return None
+
+        self.nhits += 1
+        return traces
+
+    def put(self, key, traces):
+        fn = self._entry_path(key)
+        util.ensuredirs(fn)
+        fd, fn_temp = tempfile.mkstemp(
+            dir=os.path.dirname(fn), suffix='.temp')
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(traces, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+            try:
+                size_old = os.stat(fn).st_size
+            except OSError:
+                size_old = 0
+
+            os.replace(fn_temp, fn)
+
+        except BaseException:
+            os.unlink(fn_temp)
+            raise
+
+        self._size += os.stat(fn).st_size - size_old
+
+        if self.size_max is not None and self._size > self.size_max:
+            self.evict()
+
+    def evict(self):
+        entries = []
+        for fn in self._iter_entries():
+            try:
+                st = os.stat(fn)
+                entries.append((st.st_mtime, st.st_size, fn))
+            except OSError:
+                pass
+
+        entries.sort()
+        self._size = sum(entry[1] for entry in entries)
+        while entries and self._size > self.size_max:
+            _, size, fn = entries.pop(0)
+            try:
+                os.unlink(fn)
+            except OSError:
+                pass
+
+            self._size -= size
+
+        logger.debug('trace cache size after eviction: %i bytes' % self._size)
+
+
+def hash_response(resp):
+    return hashlib.sha1(dump(resp).encode('utf8')).hexdigest()
+
+
+class FusedResponse(trace.FrequencyResponse):
+    '''
+    Inverse instrument response combined with further responses.
+
+    Applying this response with a single non-inverting transfer is equivalent
+    to restitution followed by convolution with each of ``responses``.
+
+    Like the inverting transfer of Pyrocko, evaluation raises
+    :py:exc:`pyrocko.trace.InfiniteResponse` if the instrument response
+    cannot be inverted at any of the given frequencies.
+    '''
+
+    instrument = trace.FrequencyResponse.T()
+    responses = List.T(trace.FrequencyResponse.T())
+
+    def __init__(self, *args, **kwargs):
+        trace.FrequencyResponse.__init__(self, *args, **kwargs)
+
+        # equal combinations get the same identifier, so that their tapered
+        # coefficients are computed once by Pyrocko
+        self.uuid = uuid.uuid5(
+            self.instrument.uuid,
+            hashlib.sha1(''.join(
+                dump(resp) for resp in self.responses).encode(
+                    'utf8')).hexdigest())
+
+    def evaluate(self, freqs):
+        coeffs = num.ones(freqs.size, dtype=complex)
+        for resp in self.responses:
+            coeffs *= resp.evaluate(freqs)
+
+        with num.errstate(divide='ignore', invalid='ignore'):
+            coeffs /= self.instrument.evaluate(freqs)
+
+        if not num.all(num.isfinite(coeffs)):
+            raise trace.InfiniteResponse(
+                'instrument response cannot be inverted within the '
+                'frequency limits')
+
+        return coeffs
+
+
 class Dataset(object):
 
     def __init__(self, event_name=None):
         self.events = []
+        self._event_catalogs = []
         self._pile = pile.Pile()
         self._pile_update_args = []
+        self._waveform_sources = []
         self.stations = {}
         self.responses = defaultdict(list)
         self.responses_stationxml = []
+        self._responses_stationxml_index = []
+        self._resolved_responses = {}
         self.clippings = {}
         self.blacklist = set()
         self.whitelist_nslc = None
@@ -103,11 +657,68 @@ class Dataset(object):
         self.clip_handling = 'by_nsl'
         self._picks = None
         self._cache = {}
+        self._trace_cache = None
         self._event_name = event_name
 
     def empty_cache(self):
         self._cache = {}
 
+    def release(self):
+        '''
+        Free cached traces and responses of the dataset.
+
+        Waveform samples are freed with the dataset itself, once it is no
+        longer referenced.
+        '''
+
+        self.empty_cache()
+        self._resolved_responses = {}
+
+    def set_trace_cache(self, trace_cache):
+        self._trace_cache = trace_cache
+
+    def _get_trace_cache_key(
+            self, tr, quantity, resp, tfade, freqlimits,
+            toffset_noise_extract, extend_incomplete):
+
+        sc = self.station_corrections.get(tr.nslc_id, None)
+        if sc is not None:
+            sc_state = (
+                sc.delay if self.apply_correction_delays else None,
+                sc.factor if self.apply_correction_factors else None)
+        else:
+            sc_state = None
+
+        # the raw samples are identified by the files they were read from,
+        # so that they need not be hashed
+        tmin = tr.tmin + toffset_noise_extract
+        tmax = tr.tmax + toffset_noise_extract
+        paths = set(
+            tr_file.file.abspath if tr_file.file is not None else None
+            for tr_file in self.get_waveform_index().relevant(
+                tr.nslc_id, tmin, tmax))
+
+        data_key = None
+        if paths and None not in paths:
+            try:
+                data_key = []
+                for path in sorted(paths):
+                    st = os.stat(path)
+                    data_key.append((path, st.st_mtime, st.st_size))
+
+                data_key = tuple(data_key)
+
+            except OSError:
+                data_key = None
+
+        if data_key is None:
+            data_key = hashlib.sha1(tr.get_ydata().tobytes()).hexdigest()
+
+        return (
+            tr.nslc_id, tr.tmin, tr.tmax, tr.deltat, toffset_noise_extract,
+            extend_incomplete, data_key, quantity, freqlimits, tfade,
+            hash_response(resp), sc_state)
+
     def add_stations(
             self,
             stations=None,
@@ -133,8 +744,8 @@ class Dataset(object):
                     'Loading stations from StationXML file %s' %
                     stationxml_filename)
 
-                sx = cached_load_stationxml(stationxml_filename)
-                for station in sx.get_pyrocko_stations():
+                sx_index = windex.load_stationxml_index(stationxml_filename)
+                for station in sx_index.get_stations():
                     self.stations[station.nsl()] = station
 
     def add_events(self, events=None, filename=None):
@@ -143,47 +754,93 @@ class Dataset(object):
 
         if filename is not None:
             logger.debug('Loading events from file %s' % filename)
-            self.events.extend(cached_load_events(filename))
+            self._event_catalogs.append(
+                windex.load_event_catalog(filename))
 
     def add_waveforms(self, paths, regex=None, fileformat='detect',
-                      show_progress=False):
+                      show_progress=False, shared=False):
+
+        '''
+        Add waveform files to the dataset.
+
+        Files are indexed on first access to the waveform data. If
+        ``shared`` is ``True``, the index is shared process-wide among all
+        datasets using the same ``paths``, e.g. when the datasets of many
+        events use a common continuous archive. A shared index replaces any
+        other waveform sources of the dataset.
+        '''
 
         self._pile_update_args.append(
-            [paths, regex, fileformat, show_progress])
+            [paths, regex, fileformat, show_progress, shared])
 
     def _update_pile(self):
+        if self._pile_update_args:
+            with wstats.timer('pile_loading'), g_pile_lock:
+                self._load_pile_files()
+
+    def _load_pile_files(self):
         while self._pile_update_args:
-            paths, regex, fileformat, show_progress = \
+            paths, regex, fileformat, show_progress, shared = \
                 self._pile_update_args.pop(0)
 
-            logger.debug('Loading waveform data from %s' % paths)
+            self._waveform_sources.append((paths, regex, fileformat))
 
-            cachedirname = config.config().cache_dir
-            fns = util.select_files(paths, regex=regex,
-                                    show_progress=show_progress)
-            cache = pile.get_cache(cachedirname)
-            self._pile.load_files(sorted(fns), cache=cache,
-                                 fileformat=fileformat,
-                                 show_progress=show_progress)
+            if shared:
+                self._pile = get_shared_pile(
+                    paths, regex=regex, fileformat=fileformat,
+                    show_progress=show_progress)
+            else:
+                load_pile_files(
+                    self._pile, paths, regex=regex, fileformat=fileformat,
+                    show_progress=show_progress)
 
     def get_pile(self):
         self._update_pile()
         return self._pile
 
+    def update_waveforms(self):
+        '''
+        Look for new and modified files in the waveform paths.
+
+        Returns ``True`` if the waveform data has changed.
+        '''
+
+        self._update_pile()
+        changed = False
+        with g_pile_lock:
+            for paths, regex, fileformat in self._waveform_sources:
+                if update_pile_files(
+                        self._pile, paths, regex=regex,
+                        fileformat=fileformat):
+                    changed = True
+
+        if changed:
+            self.empty_cache()
+
+        return changed
+
+    def get_waveform_index(self):
+        return get_waveform_index(self.get_pile())
+
     def add_responses(self, sacpz_dirname=None, stationxml_filenames=None):
         if sacpz_dirname:
             logger.debug('Loading SAC PZ responses from %s' % sacpz_dirname)
             for x in enhanced_sacpz.iload_dirname(sacpz_dirname):
                 self.responses[x.codes].append(x)
 
+            self._resolved_responses = {}
+
         if stationxml_filenames:
             for stationxml_filename in stationxml_filenames:
                 logger.debug(
                     'Loading StationXML responses from %s' %
                     stationxml_filename)
 
-                self.responses_stationxml.append(
-                    cached_load_stationxml(stationxml_filename))
+                sx_responses = cached_load_stationxml_responses(
+                    stationxml_filename)
+
+                self.responses_stationxml.append(sx_responses.sx_index)
+                self._responses_stationxml_index.append(sx_responses)
 
     def add_clippings(self, markers_filename):
         markers = pmarker.load_markers(markers_filename)
@@ -344,6 +1001,27 @@ class Dataset(object):
                 if not self.is_blacklisted(self.stations[k])
                 and self.is_whitelisted(self.stations[k])]
 
+    def _get_sacpz_response(self, codes, ix, quantity):
+        k = (codes, ix, quantity)
+        if k not in self._resolved_responses:
+            x = self.responses[codes][ix]
+            if quantity == 'displacement':
+                resp = x.response
+            elif quantity == 'velocity':
+                resp = trace.MultiplyResponse([
+                    x.response,
+                    trace.DifferentiationResponse()])
+            elif quantity == 'acceleration':
+                resp = trace.MultiplyResponse([
+                    x.response,
+                    trace.DifferentiationResponse(2)])
+            else:
+                assert False
+
+            self._resolved_responses[k] = resp
+
+        return self._resolved_responses[k]
+
     def get_response(self, obj, quantity='displacement'):
         if (self.responses is None or len(self.responses) == 0) \
                 and (self.responses_stationxml is None
@@ -351,11 +1029,6 @@ class Dataset(object):
 
             raise NotFound('no response information available')
 
-        quantity_to_unit = {
-            'displacement': 'M',
-            'velocity': 'M/S',
-            'acceleration': 'M/S**2'}
-
         if self.is_blacklisted(obj):
             raise NotFound('response is blacklisted', self.get_nslc(obj))
 
@@ -376,31 +1049,17 @@ class Dataset(object):
         candidates = []
         for k in keys:
             if k in self.responses:
-                for x in self.responses[k]:
+                for ix, x in enumerate(self.responses[k]):
                     if x.tmin < tmin and (x.tmax is None or tmax < x.tmax):
-                        if quantity == 'displacement':
-                            candidates.append(x.response)
-                        elif quantity == 'velocity':
-                            candidates.append(trace.MultiplyResponse([
-                                x.response,
-                                trace.DifferentiationResponse()]))
-                        elif quantity == 'acceleration':
-                            candidates.append(trace.MultiplyResponse([
-                                x.response,
-                                trace.DifferentiationResponse(2)]))
-                        else:
-                            assert False
-
-        for sx in self.responses_stationxml:
-            try:
-                candidates.append(
-                    sx.get_pyrocko_response(
-                        (net, sta, loc, cha),
-                        timespan=(tmin, tmax),
-                        fake_input_units=quantity_to_unit[quantity]))
+                        candidates.append(
+                            self._get_sacpz_response(k, ix, quantity))
 
-            except (fs.NoResponseInformation, fs.MultipleResponseInformation):
-                pass
+        for sx_responses in self._responses_stationxml_index:
+            resp = sx_responses.get_response(
+                (net, sta, loc, cha), tmin, tmax, quantity=quantity)
+
+            if resp is not None:
+                candidates.append(resp)
 
         if len(candidates) == 1:
             return candidates[0]
@@ -439,12 +1098,11 @@ class Dataset(object):
                 raise NotFound(
                     'waveform clipped', (net, sta, loc, cha))
 
-        p = self.get_pile()
-        trs = p.all(
+        trs = self.get_waveform_index().get_traces(
+            (net, sta, loc, cha),
             tmin=tmin+toffset_noise_extract,
             tmax=tmax+toffset_noise_extract,
             tpad=tpad,
-            trace_selector=lambda tr: tr.nslc_id == (net, sta, loc, cha),
             want_incomplete=want_incomplete or extend_incomplete)
 
         if toffset_noise_extract != 0.0:
@@ -479,7 +1137,13 @@ class Dataset(object):
             tfade=0., freqlimits=None, deltat=None,
             toffset_noise_extract=0.,
             want_incomplete=False,
-            extend_incomplete=False):
+            extend_incomplete=False,
+            extra_responses=None):
+
+        if extra_responses and freqlimits is None:
+            raise DatasetError(
+                'freqlimits are required when applying extra responses '
+                'during restitution')
 
         trs_raw = self.get_waveform_raw(
             obj, tmin=tmin, tmax=tmax, tpad=tpad+tfade,
@@ -493,11 +1157,36 @@ class Dataset(object):
                 tr.downsample_to(deltat, snap=True, allow_upsample_max=5)
                 tr.deltat = deltat
 
-            resp = self.get_response(tr, quantity=quantity)
-            trs_restituted.append(
-                tr.transfer(
-                    tfade=tfade, freqlimits=freqlimits,
-                    transfer_function=resp, invert=True))
+            with wstats.timer('response_lookup'):
+                resp = self.get_response(tr, quantity=quantity)
+
+            invert = True
+            if extra_responses:
+                resp = FusedResponse(
+                    instrument=resp, responses=list(extra_responses))
+                invert = False
+
+            if self._trace_cache is not None:
+                key = self._get_trace_cache_key(
+                    tr, quantity, resp, tfade, freqlimits,
+                    toffset_noise_extract, extend_incomplete)
+
+                tr_restituted = self._trace_cache.get(key)
+                wstats.count('trace_cache.%s' % (
+                    'miss' if tr_restituted is None else 'hit'))
+            else:
+                tr_restituted = None
+
+            if tr_restituted is None:
+                with wstats.timer('restitution'):
+                    tr_restituted = transfer(
+                        tr, tfade=tfade, freqlimits=freqlimits,
+                        transfer_function=resp, invert=invert)
+
+                if self._trace_cache is not None:
+                    self._trace_cache.put(key, tr_restituted)
+
+            trs_restituted.append(tr_restituted)
 
         return trs_restituted, trs_raw
 
@@ -509,14 +1198,8 @@ class Dataset(object):
         if not station.get_channels():
             station = copy.deepcopy(station)
 
-            nsl = station.nsl()
-            p = self.get_pile()
-            trs = p.all(
-                tmin=tmin, tmax=tmax,
-                trace_selector=lambda tr: tr.nslc_id[:3] == nsl,
-                load_data=False)
-
-            channels = list(set(tr.channel for tr in trs))
+            channels = self.get_waveform_index().get_channels(
+                station.nsl(), tmin, tmax)
             station.set_channels_by_name(*channels)
 
         projections = []
@@ -546,6 +1229,7 @@ class Dataset(object):
             backazimuth=None,
             source=None,
             target=None,
+            extra_responses=None,
             debug=False):
 
         assert not debug or (debug and cache is None)
@@ -553,6 +1237,11 @@ class Dataset(object):
         if cache is True:
             cache = self._cache
 
+        if extra_responses:
+            extra_key = hash_response(trace.MultiplyResponse(extra_responses))
+        else:
+            extra_key = None
+
         _, _, _, channel = self.get_nslc(obj)
         station = self.get_station(self.get_nsl(obj))
 
@@ -572,8 +1261,8 @@ class Dataset(object):
         if tmax is not None:
             tmax = float(tmax)
 
-        if cache is not None and (nslc, tmin, tmax) in cache:
-            obj = cache[nslc, tmin, tmax]
+        if cache is not None and (nslc, tmin, tmax, extra_key) in cache:
+            obj = cache[nslc, tmin, tmax, extra_key]
             if isinstance(obj, Exception):
                 raise obj
             else:
@@ -615,15 +1304,17 @@ class Dataset(object):
                                 freqlimits=freqlimits,
                                 deltat=deltat,
                                 want_incomplete=debug,
-                                extend_incomplete=self.extend_incomplete)
+                                extend_incomplete=self.extend_incomplete,
+                                extra_responses=extra_responses)
 
                         trs_restituted_group.extend(trs_restituted_this)
                         trs_raw_group.extend(trs_raw_this)
 
-                    trs_projected.extend(
-                        trace.project(
-                            trs_restituted_group, matrix,
-                            in_channels, out_channels))
+                    with wstats.timer('projection'):
+                        trs_projected.extend(
+                            trace.project(
+                                trs_restituted_group, matrix,
+                                in_channels, out_channels))
 
                     trs_restituted.extend(trs_restituted_group)
                     trs_raw.extend(trs_raw_group)
@@ -642,7 +1333,7 @@ class Dataset(object):
 
             if cache is not None:
                 for tr in trs_projected:
-                    cache[tr.nslc_id, tmin, tmax] = tr
+                    cache[tr.nslc_id, tmin, tmax, extra_key] = tr
 
             if debug:
                 return trs_projected, trs_restituted, trs_raw
@@ -656,18 +1347,26 @@ class Dataset(object):
 
         except NotFound as e:
             if cache is not None:
-                cache[nslc, tmin, tmax] = e
+                cache[nslc, tmin, tmax, extra_key] = e
             raise
 
     def get_events(self, magmin=None, event_names=None):
         evs = []
-        for ev in self.events:
+        for ev in self.iter_events():
             if ((magmin is None or ev.magnitude >= magmin) and
                     (event_names is None or ev.name in event_names)):
                 evs.append(ev)
 
         return evs
 
+    def iter_events(self):
+        for ev in self.events:
+            yield ev
+
+        for catalog in self._event_catalogs:
+            for ev in catalog.get_events():
+                yield ev
+
     def get_event_by_time(self, t, magmin=None):
         evs = self.get_events(magmin=magmin)
         ev_x = None
@@ -690,6 +1389,11 @@ class Dataset(object):
             if ev.name == self._event_name:
                 return ev
 
+        for catalog in self._event_catalogs:
+            ev = catalog.get_event(self._event_name)
+            if ev is not None:
+                return ev
+
         raise NotFound('no such event: %s' % self._event_name)
 
     def get_picks(self):
@@ -737,6 +1441,11 @@ class Dataset(object):
         return self.get_picks().get((nsl, phasename, eventname), None)
 
 
+# guards the datasets held by dataset configurations, which may be set up
+# in a background thread
+g_datasets_lock = threading.RLock()
+
+
 class DatasetConfig(HasPaths):
 
     stations_path = Path.T(optional=True)
@@ -752,6 +1461,19 @@ class DatasetConfig(HasPaths):
     apply_correction_delays = Bool.T(optional=True,
                                      default=True)
     extend_incomplete = Bool.T(default=False)
+    trace_cache_path = Path.T(
+        optional=True,
+        help='if given, restituted traces are cached in this directory')
+    trace_cache_size_max = Float.T(
+        optional=True,
+        help='maximum size of the restituted trace cache [bytes]; least '
+             'recently used entries are removed when it is exceeded')
+    memory_cache_size_max = Float.T(
+        optional=True,
+        help='maximum size of the in-memory caches shared between events, '
+             'e.g. of evaluated instrument responses [bytes]; least '
+             'recently used entries are removed when it is exceeded '
+             '(default: %g)' % memory_cache_size_max_default)
     picks_paths = List.T(Path.T())
     blacklist_paths = List.T(Path.T())
     blacklist = List.T(
@@ -770,8 +1492,31 @@ class DatasetConfig(HasPaths):
     def __init__(self, *args, **kwargs):
         HasPaths.__init__(self, *args, **kwargs)
         self._ds = {}
+        self._trace_cache = None
 
-    def get_event_names(self):
+    def get_trace_cache(self):
+        if self.trace_cache_path is None:
+            return None
+
+        if self._trace_cache is None:
+            self._trace_cache = TraceDiskCache(
+                self.expand_path(self.trace_cache_path),
+                size_max=self.trace_cache_size_max)
+
+        return self._trace_cache
+
+    def has_event_waveform_paths(self):
+        '''
+        Check if waveform paths depend on the event name.
+
+        If they do not, all events share the same waveform archive.
+        '''
+
+        return any(
+            'event_name' in get_template_placeholders(path)
+            for path in self.waveform_paths)
+
+    def get_event_catalogs(self):
         def extra(path):
             return expand_template(path, dict(
                 event_name='*'))
@@ -779,15 +1524,45 @@ class DatasetConfig(HasPaths):
         def fp(path):
             return self.expand_path(path, extra=extra)
 
+        return [
+            windex.load_event_catalog(fn)
+            for fn in glob.glob(fp(self.events_path))]
+
+    def get_events(self):
         events = []
-        for fn in glob.glob(fp(self.events_path)):
-            events.extend(cached_load_events(fn))
+        for catalog in self.get_event_catalogs():
+            events.extend(catalog.get_events())
+
+        return events
+
+    def get_event_names(self):
+        names = []
+        for catalog in self.get_event_catalogs():
+            names.extend(catalog.get_names())
 
-        event_names = [ev.name for ev in events]
-        return event_names
+        return names
+
+    def get_event(self, event_name):
+        '''
+        Get an event by name or ``None`` if there is no such event.
+        '''
+
+        for catalog in self.get_event_catalogs():
+            ev = catalog.get_event(event_name)
+            if ev is not None:
+                return ev
+
+        return None
 
     def get_dataset(self, event_name):
+        with g_datasets_lock:
+            return self._get_dataset(event_name)
+
+    def _get_dataset(self, event_name):
         if event_name not in self._ds:
+            if self.memory_cache_size_max is not None:
+                set_memory_cache_size_max(self.memory_cache_size_max)
+
             def extra(path):
                 return expand_template(path, dict(
                     event_name=event_name))
@@ -803,7 +1578,9 @@ class DatasetConfig(HasPaths):
             ds.add_events(filename=fp(self.events_path))
 
             if self.waveform_paths:
-                ds.add_waveforms(paths=fp(self.waveform_paths))
+                ds.add_waveforms(
+                    paths=fp(self.waveform_paths),
+                    shared=not self.has_event_waveform_paths())
 
             if self.clippings_path:
                 ds.add_clippings(markers_filename=fp(self.clippings_path))
@@ -823,6 +1600,7 @@ class DatasetConfig(HasPaths):
             ds.apply_correction_factors = self.apply_correction_factors
             ds.apply_correction_delays = self.apply_correction_delays
             ds.extend_incomplete = self.extend_incomplete
+            ds.set_trace_cache(self.get_trace_cache())
 
             for picks_path in self.picks_paths:
                 ds.add_picks(
@@ -839,14 +1617,43 @@ class DatasetConfig(HasPaths):
 
         return self._ds[event_name]
 
+    def forget_dataset(self, event_name):
+        '''
+        Drop the dataset of an event, so that it is set up anew on next
+        access.
+
+        Call this when an event is done, so that the memory held by its
+        dataset is freed.
+        '''
+
+        with g_datasets_lock:
+            ds = self._ds.pop(event_name, None)
+
+        if ds is not None:
+            ds.release()
+
+    def get_cache_report(self):
+        '''
+        Get number of datasets held and state of the in-memory caches.
+        '''
+
+        report = get_cache_report()
+        report['datasets'] = dict(nentries=len(self._ds))
+        return report
+
 
 __all__ = '''
     Dataset
     DatasetConfig
+    MemoryCache
     DatasetError
+    FusedResponse
     InvalidObject
     NotFound
     StationCorrection
+    StationXMLResponses
+    TraceDiskCache
+    WaveformIndex
     load_station_corrections
     dump_station_corrections
 '''.split()
@@ -0,0 +1,468 @@
+'''
+Persistent indexes of StationXML files and event catalogs.
+
+Parsing large StationXML files and event catalogs takes a long time, and
+without an index it is repeated in every process. The first time a file is
+used, the information needed by Wafe is extracted and stored in a compact
+binary index file in the cache directory of Pyrocko. Later runs and other
+processes load the index instead of the original file. An index is rebuilt
+when the modification time or size of the original file changes.
+
+Index files start with a header of NumPy arrays in ``.npz`` format,
+followed by YAML documents which are read on demand. Neither is loaded
+with :py:mod:`pickle`, so that reading an index cannot execute code:
+
+* for StationXML files, the header holds the codes and time spans of all
+  channel epochs with a response, the documents hold the Pyrocko stations
+  and the StationXML response of each channel epoch, which is converted
+  for the requested quantity when used;
+* for event catalogs, the header holds the event names and arrays with
+  time, location and magnitude, the documents hold the individual events.
+'''
+
+import io
+import os
+import struct
+import hashlib
+import logging
+import zipfile
+import tempfile
+import threading
+import os.path as op
+from collections import defaultdict
+
+import numpy as num
+
+from pyrocko import model, config, util
+from pyrocko.guts import Object, String, dump, dump_all, load_string, \
+    load_all
+from pyrocko.fdsn import station as fs
+
+from wafe.cache import MemoryCache, register_memory_cache, \
+    memory_cache_size_max_default
+
+logger = logging.getLogger('wafe.index')
+
+index_version = 2
+
+quantity_to_unit = {
+    'displacement': 'M',
+    'velocity': 'M/S',
+    'acceleration': 'M/S**2'}
+
+g_index_cache = register_memory_cache(MemoryCache(
+    'index_cache', memory_cache_size_max_default))
+
+# serializes the building of indexes
+g_index_cache_lock = threading.Lock()
+
+
+def get_index_dir():
+    return op.join(config.config().cache_dir, 'wafe-index')
+
+
+def get_index_filename(fn, kind):
+    digest = hashlib.sha1(op.abspath(fn).encode('utf8')).hexdigest()
+    return op.join(get_index_dir(), '%s.%s' % (digest, kind))
+
+
+def get_signature(fn):
+    '''
+    Get the modification time and size of a file.
+    '''
+
+    st = os.stat(fn)
+    return num.array([index_version, st.st_mtime, st.st_size], dtype=float)
+
+
+def _str_array(strings, shape):
+    # fixed-width unicode arrays are stored without pickling
+    return num.array(strings, dtype=str).reshape(shape)
+
+
+class IndexFile(object):
+    '''
+    Reader for the blobs of an index, from a file or from memory.
+
+    Blobs are ``(offset, length)`` pairs locating YAML documents.
+    '''
+
+    def __init__(self, header, path=None, data_offset=None, data=None):
+        self.header = header
+        self._data = data
+        self._data_offset = data_offset
+        self._fd = None
+        if data is None:
+            self._fd = os.open(path, os.O_RDONLY)
+
+    def read(self, blob):
+        offset, length = map(int, blob)
+        if self._data is not None:
+            data = self._data[offset:offset+length]
+        else:
+            data = os.pread(self._fd, length, self._data_offset + offset)
+
+        return data.decode('utf8')
+
+    def load(self, blob):
+        return load_string(self.read(blob))
+
+    def load_all(self, blob):
+        return load_all(string=self.read(blob))
+
+    def get_nbytes(self):
+        '''
+        Get the size of the header and of the blobs held in memory.
+        '''
+
+        return sum(a.nbytes for a in self.header.values()) \
+            + (len(self._data) if self._data is not None else 0)
+
+    def __del__(self):
+        if self._fd is not None:
+            os.close(self._fd)
+
+
+class BlobWriter(object):
+    '''
+    Collects YAML documents of objects for an index file.
+    '''
+
+    def __init__(self):
+        self._chunks = []
+        self._size = 0
+
+    def _add(self, data):
+        data = data.encode('utf8')
+        blob = (self._size, len(data))
+        self._chunks.append(data)
+        self._size += len(data)
+        return blob
+
+    def add(self, obj):
+        return self._add(dump(obj))
+
+    def add_all(self, objs):
+        return self._add(dump_all(objs))
+
+    def get_data(self):
+        return b''.join(self._chunks)
+
+
+def write_index(path, header, blobs):
+    '''
+    Write an index file and return a reader for it.
+
+    The file is written to a temporary file and renamed, so that concurrent
+    readers and writers never see a partially written index. If the index
+    cannot be written, the reader works from memory.
+    '''
+
+    data = blobs.get_data()
+    f_header = io.BytesIO()
+    num.savez(f_header, **header)
+    header_data = f_header.getvalue()
+    try:
+        util.ensuredirs(path)
+        fd, path_temp = tempfile.mkstemp(
+            dir=op.dirname(path), suffix='.temp')
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(struct.pack('<Q', len(header_data)))
+                f.write(header_data)
+                f.write(data)
+
+            os.replace(path_temp, path)
+
+        except BaseException:
+            os.unlink(path_temp)
+            raise
+
+    except OSError as e:
+        logger.warn('cannot write index file %s: %s' % (path, e))
+        return IndexFile(header, data=data)
+
+    return IndexFile(
+        header, path=path, data_offset=8 + len(header_data))
+
+
+def read_index(path, signature):
+    '''
+    Open an existing index file.
+
+    Returns ``None`` if there is no index or if it is outdated.
+    '''
+
+    try:
+        with open(path, 'rb') as f:
+            nheader, = struct.unpack('<Q', f.read(8))
+            with num.load(
+                    io.BytesIO(f.read(nheader)), allow_pickle=False) as npz:
+
+                header = dict(npz)
+
+    except (OSError, EOFError, ValueError, struct.error,
+            zipfile.BadZipFile):
+        return None
+
+    if 'signature' not in header \
+            or not num.array_equal(header['signature'], signature):
+        return None
+
+    return IndexFile(header, path=path, data_offset=8 + nheader)
+
+
+class StationXMLIndex(object):
+    '''
+    Stations and channel responses of a StationXML file.
+    '''
+
+    def __init__(self, index_file):
+        self._file = index_file
+        header = index_file.header
+        self.nslcs = [tuple(nslc) for nslc in header['nslcs'].tolist()]
+        self.spans = header['spans']
+        self._response_blobs = header['responses']
+        self._epochs = defaultdict(list)
+        for iepoch, nslc in enumerate(self.nslcs):
+            self._epochs[nslc].append(iepoch)
+
+        self._stations = None
+
+    @staticmethod
+    def build(fn, path):
+        logger.info('building index of StationXML file %s' % fn)
+        signature = get_signature(fn)
+        sx = fs.load_xml(filename=fn)
+        blobs = BlobWriter()
+
+        nslcs = []
+        spans = []
+        responses = []
+        for network in sx.network_list:
+            for station in network.station_list:
+                for channel in station.channel_list:
+                    if not channel.response:
+                        continue
+
+                    nslc = (
+                        network.code,
+                        station.code,
+                        channel.location_code.strip(),
+                        channel.code)
+
+                    nslcs.append(nslc)
+                    spans.append([
+                        (num.inf if node.end_date is None
+                         else node.end_date,
+                         -num.inf if node.start_date is None
+                         else node.start_date)
+                        for node in (network, station, channel)])
+
+                    responses.append(
+                        blobs.add(get_channel_response(channel)))
+
+        nepochs = len(nslcs)
+        header = dict(
+            signature=signature,
+            nslcs=_str_array(nslcs, (nepochs, 4)),
+            spans=num.array(spans, dtype=float).reshape((nepochs, 3, 2)),
+            responses=num.array(responses, dtype=num.int64).reshape(
+                (nepochs, 2)),
+            stations=num.array(
+                blobs.add_all(sx.get_pyrocko_stations()), dtype=num.int64))
+
+        return StationXMLIndex(write_index(path, header, blobs))
+
+    def get_stations(self):
+        if self._stations is None:
+            self._stations = self._file.load_all(
+                self._file.header['stations'])
+
+        return self._stations
+
+    def get_epochs(self, nslc, tmin, tmax):
+        '''
+        Get the channel epochs with a response overlapping a time span.
+
+        Returns a list of epoch identifiers.
+        '''
+
+        iepochs = self._epochs.get(nslc, [])
+        if not iepochs:
+            return []
+
+        # like BaseNode.spans, for network, station and channel
+        spans = self.spans[iepochs]
+        mask = num.all(
+            (spans[:, :, 0] >= tmin) & (tmax >= spans[:, :, 1]), axis=1)
+
+        return [iepoch for (iepoch, m) in zip(iepochs, mask) if m]
+
+    def get_response(self, iepoch, quantity):
+        '''
+        Get the response of a channel epoch, converted to Pyrocko.
+
+        Raises :py:exc:`pyrocko.fdsn.station.StationXMLError` if the
+        response is invalid or cannot be converted.
+        '''
+
+        channel_response = self._file.load(self._response_blobs[iepoch])
+        if channel_response.error is not None:
+            raise fs.StationXMLError(channel_response.error)
+
+        return channel_response.response.get_pyrocko_response(
+            '.'.join(self.nslcs[iepoch]),
+            fake_input_units=quantity_to_unit[quantity],
+            stages=(0, 1)).expect_one()
+
+
+class ChannelResponse(Object):
+    '''
+    StationXML response of a channel epoch, or the reason why it is invalid.
+    '''
+
+    response = fs.Response.T(optional=True)
+    error = String.T(optional=True)
+
+
+def get_channel_response(channel):
+    '''
+    Check a channel response and wrap it in a :py:class:`ChannelResponse`.
+
+    Errors are kept as messages, to be raised when the response is used.
+    '''
+
+    try:
+        resp = channel.response
+        resp.check_sample_rates(channel)
+        resp.check_units()
+        return ChannelResponse(response=resp)
+
+    except Exception as e:
+        return ChannelResponse(error=str(e))
+
+
+class EventCatalog(object):
+    '''
+    Events of a catalog file.
+
+    Names, times, locations and magnitudes are available as arrays. Event
+    objects are read from the index when requested, only the complete list
+    returned by :py:meth:`get_events` is kept in memory.
+    '''
+
+    def __init__(self, index_file):
+        self._file = index_file
+        header = index_file.header
+        self.names = header['names'].tolist()
+        self.times = header['times']
+        self.lats = header['lats']
+        self.lons = header['lons']
+        self.depths = header['depths']
+        self.magnitudes = header['magnitudes']
+        self._blobs = header['events']
+        self._index = None
+        self._events = None
+
+    @staticmethod
+    def build(fn, path):
+        logger.info('building index of event file %s' % fn)
+        signature = get_signature(fn)
+        events = model.load_events(fn)
+        blobs = BlobWriter()
+
+        def array(name):
+            return num.array([
+                num.nan if getattr(ev, name) is None else getattr(ev, name)
+                for ev in events], dtype=float)
+
+        header = dict(
+            signature=signature,
+            names=_str_array([ev.name for ev in events], (len(events),)),
+            times=array('time'),
+            lats=array('lat'),
+            lons=array('lon'),
+            depths=array('depth'),
+            magnitudes=array('magnitude'),
+            events=num.array(
+                [blobs.add(ev) for ev in events],
+                dtype=num.int64).reshape((len(events), 2)))
+
+        return EventCatalog(write_index(path, header, blobs))
+
+    def __len__(self):
+        return len(self.names)
+
+    def get_names(self):
+        return list(self.names)
+
+    def get_event(self, name):
+        '''
+        Get the first event with the given name or ``None``.
+        '''
+
+        if self._index is None:
+            index = {}
+            for ievent, name_ in enumerate(self.names):
+                index.setdefault(name_, ievent)
+
+            self._index = index
+
+        ievent = self._index.get(name)
+        if ievent is None:
+            return None
+
+        return self._file.load(self._blobs[ievent])
+
+    def get_events(self):
+        if self._events is None:
+            self._events = [self._file.load(blob) for blob in self._blobs]
+
+        return self._events
+
+
+def load_index(fn, kind, cls):
+    key = (kind, op.abspath(fn))
+    signature = get_signature(fn)
+    with g_index_cache_lock:
+        entry = g_index_cache.get(key)
+        if entry is not None and num.array_equal(entry[0], signature):
+            return entry[1]
+
+        path = get_index_filename(fn, kind)
+        index_file = read_index(path, signature)
+        if index_file is not None:
+            index = cls(index_file)
+        else:
+            index = cls.build(fn, path)
+
+        g_index_cache.put(
+            key, (signature, index), index._file.get_nbytes())
+
+        return index
+
+
+def load_stationxml_index(fn):
+    '''
+    Get the :py:class:`StationXMLIndex` of a StationXML file.
+    '''
+
+    return load_index(fn, 'stationxml', StationXMLIndex)
+
+
+def load_event_catalog(fn):
+    '''
+    Get the :py:class:`EventCatalog` of an event file.
+    '''
+
+    return load_index(fn, 'events', EventCatalog)
+
+
+__all__ = '''
+    StationXMLIndex
+    EventCatalog
+    load_stationxml_index
+    load_event_catalog
+'''.split()
@@ -1,8 +1,11 @@
 import numpy as num
 from pyrocko import gf, trace
-from pyrocko.guts import Object, Float, StringChoice, List, String
+from pyrocko.guts import Object, Float, StringChoice, List, String, Bool, \
+    Int, Tuple
 from pyrocko.gui import marker
 
+from wafe import meta, dataset, stats as wstats
+
 guts_prefix = 'wafe'
 
 
@@ -57,7 +60,8 @@ class FeatureMethod(StringChoice):
         'peak_component',
         'peak_to_peak_component',
         'peak_absolute_vector',
-        'spectral_average']
+        'spectral_average',
+        'spectral_bands']
 
 
 class Quantity(StringChoice):
@@ -75,6 +79,371 @@ class FeatureMeasurementFailed(Exception):
     pass
 
 
+def _evaluate_phase_many(store, phase_def, source, locations, coords):
+    toks = phase_def.split(':', 1)
+    if len(toks) == 2:
+        provider, phase_id = toks
+    else:
+        provider, phase_id = 'stored', toks[0]
+
+    if provider == 'stored':
+        spt = store.get_stored_phase(phase_id)
+        inside = num.all(num.logical_and(
+            spt.xbounds[:, 0] <= coords,
+            coords <= spt.xbounds[:, 1]), axis=1)
+
+        times = num.full(coords.shape[0], num.nan)
+        if num.any(inside):
+            times[inside] = spt.interpolate_many(coords[inside])
+
+        return times
+
+    else:
+        # other providers are evaluated per location
+        phase = store.get_phase(phase_def)
+        times = []
+        for location in locations:
+            t = phase(store.config.make_indexing_args1(source, location))
+            times.append(t if t is not None else num.nan)
+
+        return num.array(times, dtype=float)
+
+
+def evaluate_timings(store, timings, source, locations):
+    '''
+    Evaluate travel times for many receiver locations at once.
+
+    Times relative to the source origin time are returned as an array of
+    shape ``(len(timings), len(locations))``. Travel times from stored
+    phases are interpolated in a single vectorized call per phase. Where a
+    timing cannot be determined, ``NaN`` is returned.
+    '''
+
+    coords = num.array([
+        store.config.make_indexing_args1(source, location)
+        for location in locations], dtype=float)
+
+    phase_times = {}
+
+    def get_phase_times(phase_def):
+        if phase_def not in phase_times:
+            phase_times[phase_def] = _evaluate_phase_many(
+                store, phase_def, source, locations, coords)
+
+        return phase_times[phase_def]
+
+    times = num.full((len(timings), len(locations)), num.nan)
+    for itiming, timing in enumerate(timings):
+        offset_is = getattr(timing, 'offset_is', None)
+        if offset_is == 'slowness' and timing.offset != 0.0:
+            for ilocation, location in enumerate(locations):
+                t = store.t(timing, source, location)
+                if t is not None:
+                    times[itiming, ilocation] = t
+
+            continue
+
+        if not timing.phase_defs:
+            times[itiming, :] = timing.offset
+            continue
+
+        ts = num.array([
+            get_phase_times(phase_def) for phase_def in timing.phase_defs])
+
+        available = num.isfinite(ts)
+        if timing.select == 'first':
+            ts = num.where(available, ts, num.inf).min(axis=0)
+        elif timing.select == 'last':
+            ts = num.where(available, ts, -num.inf).max(axis=0)
+        else:
+            ts = ts[num.argmax(available, axis=0), num.arange(ts.shape[1])]
+
+        ts[~num.any(available, axis=0)] = num.nan
+
+        if offset_is == 'percent':
+            times[itiming, :] = ts * (1. + timing.offset / 100.)
+        else:
+            times[itiming, :] = ts + timing.offset
+
+    return times
+
+
+def get_time_windows(engine, source, measures, targets):
+    '''
+    Get time windows of all measures for many targets.
+
+    Targets at the same location are evaluated only once. Returns an array
+    of shape ``(len(measures), len(targets), 2)`` with absolute start and
+    end times of the windows, or ``NaN`` where the timing could not be
+    determined.
+    '''
+
+    windows = num.full((len(measures), len(targets), 2), num.nan)
+
+    timing_index = {}
+    timings = []
+    for measure in measures:
+        for timing in (measure.timing_tmin, measure.timing_tmax):
+            if str(timing) not in timing_index:
+                timing_index[str(timing)] = len(timings)
+                timings.append(timing)
+
+    by_store = {}
+    for itarget, target in enumerate(targets):
+        by_store.setdefault(target.store_id, []).append(itarget)
+
+    for store_id, itargets in by_store.items():
+        store = engine.get_store(store_id)
+
+        location_index = {}
+        locations = []
+        ilocations = []
+        for itarget in itargets:
+            target = targets[itarget]
+            k = (target.lat, target.lon, target.north_shift,
+                 target.east_shift, target.depth, target.elevation)
+
+            if k not in location_index:
+                location_index[k] = len(locations)
+                locations.append(target)
+
+            ilocations.append(location_index[k])
+
+        times = evaluate_timings(store, timings, source, locations)
+        times = times[:, ilocations]
+
+        for imeasure, measure in enumerate(measures):
+            windows[imeasure, itargets, 0] = source.time + times[
+                timing_index[str(measure.timing_tmin)]]
+            windows[imeasure, itargets, 1] = source.time + times[
+                timing_index[str(measure.timing_tmax)]]
+
+    return windows
+
+
+def _pad_stack(arrays):
+    '''
+    Stack arrays of different length along a new first axis.
+
+    Shorter arrays are padded with their last sample along the last axis,
+    which leaves maxima, minima and the first index at which they occur
+    unchanged.
+    '''
+
+    nmax = max(a.shape[-1] for a in arrays)
+    stacked = num.empty((len(arrays),) + arrays[0].shape[:-1] + (nmax,))
+    for i, a in enumerate(arrays):
+        n = a.shape[-1]
+        stacked[i, ..., :n] = a
+        stacked[i, ..., n:] = a[..., -1:]
+
+    return stacked
+
+
+def _align_components(trs):
+    '''
+    Cut the component traces of a station to their common sample span.
+
+    Returns the start time of the common span and an array of shape
+    ``(len(trs), nsamples)``.
+    '''
+
+    deltat = trs[0].deltat
+    for tr in trs:
+        if abs(tr.deltat - deltat) > deltat * 1e-4:
+            raise FeatureMeasurementFailed(
+                'components have different sampling rates')
+
+    tmin = min(tr.tmin for tr in trs)
+    offsets = [int(round((tr.tmin - tmin) / deltat)) for tr in trs]
+    istart = max(offsets)
+    iend = min(offset + tr.data_len() for (offset, tr) in zip(offsets, trs))
+    if iend <= istart:
+        raise FeatureMeasurementFailed('components do not overlap in time')
+
+    ys = num.empty((len(trs), iend - istart))
+    for i, (offset, tr) in enumerate(zip(offsets, trs)):
+        ys[i] = tr.ydata[istart-offset:iend-offset]
+
+    return tmin + istart * deltat, ys
+
+
+def peak_component_batch(ys):
+    '''
+    Maximum absolute amplitude over components.
+
+    :param ys: array of shape ``(nstations, ncomponents, nsamples)``
+    :returns: ``(amps, icomponents, isamples)``, arrays of length
+        ``nstations`` with the peak amplitude, the component and the sample
+        index at which it occurs
+    '''
+
+    yabs = num.abs(ys)
+    isamples = num.argmax(yabs, axis=2)
+    amps = num.take_along_axis(yabs, isamples[:, :, num.newaxis], axis=2)[
+        :, :, 0]
+
+    istations = num.arange(ys.shape[0])
+    icomponents = num.argmax(amps, axis=1)
+    return (
+        amps[istations, icomponents],
+        icomponents,
+        isamples[istations, icomponents])
+
+
+def peak_to_peak_component_batch(ys):
+    '''
+    Maximum peak-to-peak amplitude over components.
+
+    :param ys: array of shape ``(nstations, ncomponents, nsamples)``
+    :returns: ``(amps, icomponents, isamples_max, isamples_min)``, arrays of
+        length ``nstations``
+    '''
+
+    isamples_max = num.argmax(ys, axis=2)
+    isamples_min = num.argmin(ys, axis=2)
+    amps = \
+        num.take_along_axis(ys, isamples_max[:, :, num.newaxis], axis=2) - \
+        num.take_along_axis(ys, isamples_min[:, :, num.newaxis], axis=2)
+
+    amps = amps[:, :, 0]
+
+    istations = num.arange(ys.shape[0])
+    icomponents = num.argmax(amps, axis=1)
+    return (
+        amps[istations, icomponents],
+        icomponents,
+        isamples_max[istations, icomponents],
+        isamples_min[istations, icomponents])
+
+
+def peak_absolute_vector_batch(ys):
+    '''
+    Maximum of the vector sum of the components.
+
+    :param ys: array of shape ``(nstations, ncomponents, nsamples)`` with
+        time-aligned components
+    :returns: ``(amps, isamples, yvector)``, where ``yvector`` is the
+        absolute vector sum of shape ``(nstations, nsamples)``
+    '''
+
+    yvector = num.sqrt(num.sum(ys**2, axis=1))
+    isamples = num.argmax(yvector, axis=1)
+    return yvector[num.arange(ys.shape[0]), isamples], isamples, yvector
+
+
+def spectral_average_batch(ys, deltat, fmin, fmax):
+    '''
+    Mean absolute Fourier amplitude in the band ``[fmin, fmax]``.
+
+    :param ys: array of shape ``(ntraces, nsamples)``
+    :returns: array of length ``ntraces``
+    '''
+
+    nsamples = ys.shape[-1]
+    spectra = num.fft.rfft(ys, axis=-1)
+    freqs = num.arange(spectra.shape[-1]) / (nsamples * deltat)
+    iband = num.logical_and(fmin <= freqs, freqs <= fmax)
+    return num.mean(num.abs(spectra[:, iband]), axis=-1)
+
+
+def spectral_bands_batch(ys, deltat, bands, ntrans):
+    '''
+    Mean absolute Fourier amplitudes in several frequency bands.
+
+    All bands are evaluated from a single FFT of length ``ntrans`` per trace.
+
+    :param ys: array of shape ``(ntraces, nsamples)``, zero-padded to
+        ``ntrans`` by the FFT
+    :param bands: list of ``(fmin, fmax)`` tuples
+    :returns: array of shape ``(ntraces, len(bands))``, ``NaN`` for bands
+        which contain no frequency sample
+    '''
+
+    amps = num.abs(num.fft.rfft(ys, n=ntrans, axis=-1))
+    freqs = num.arange(amps.shape[-1]) / (ntrans * deltat)
+
+    weights = num.zeros((freqs.size, len(bands)))
+    for iband, (fmin, fmax) in enumerate(bands):
+        weights[num.logical_and(fmin <= freqs, freqs <= fmax), iband] = 1.0
+
+    counts = num.sum(weights, axis=0)
+    with num.errstate(invalid='ignore', divide='ignore'):
+        return num.dot(amps, weights) / counts
+
+
+def _hash_responses(responses):
+    if not responses:
+        return None
+
+    return dataset.hash_response(trace.MultiplyResponse(responses))
+
+
+def filter_trace(tr, responses, fmin, fmax, tmin, tmax):
+    '''
+    Apply responses and band-pass filter to a copy of a trace and cut it.
+    '''
+
+    tr = tr.copy()
+    if responses:
+        trans = trace.MultiplyResponse(responses)
+        try:
+            tr = dataset.transfer(tr, transfer_function=trans)
+
+        except trace.TraceTooShort:
+            raise FeatureMeasurementFailed(
+                'transfer: trace too short')
+
+    if fmin is not None:
+        tr.highpass(4, fmin, demean=False)
+
+    if fmax is not None:
+        tr.lowpass(4, fmax, demean=False)
+
+    try:
+        tr.chop(tmin, tmax)
+    except trace.NoData:
+        raise FeatureMeasurementFailed('no data in time window')
+
+    return tr
+
+
+class ProcessingGraph(object):
+    '''
+    Share identical processing steps between measures.
+
+    Processing of a target is split into two nodes: fetching the restituted
+    waveform for a time window, and applying responses, filters and cutting
+    to it. Nodes are identified by their parameters, including those of the
+    nodes they depend on, so each unique node is computed only once and its
+    trace is shared by all measures requesting it. Shared traces must not be
+    modified.
+
+    :ivar nrequested: number of node requests
+    :ivar ncomputed: number of nodes actually computed
+    '''
+
+    def __init__(self):
+        self._nodes = {}
+        self.nrequested = 0
+        self.ncomputed = 0
+
+    @property
+    def ndeduplicated(self):
+        return self.nrequested - self.ncomputed
+
+    def get(self, key, make):
+        self.nrequested += 1
+        if key not in self._nodes:
+            self._nodes[key] = make()
+            self.ncomputed += 1
+            wstats.count('processing_nodes.computed')
+        else:
+            wstats.count('processing_nodes.shared')
+
+        return self._nodes[key]
+
+
 class FeatureMeasure(Object):
     name = String.T()
     timing_tmin = gf.Timing.T(default='vel:8')
@@ -86,177 +455,391 @@ class FeatureMeasure(Object):
     components = List.T(Components.T())
     quantity = Quantity.T(default='displacement')
     method = FeatureMethod.T(default='peak_component')
+    bands = List.T(
+        Tuple.T(2, Float.T()),
+        help='frequency bands (fmin, fmax) [Hz] for method spectral_bands')
+    nbands = Int.T(
+        optional=True,
+        help='for method spectral_bands, if no bands are given: number of '
+             'log-spaced bands between fmin and fmax')
+    fused = Bool.T(
+        default=False,
+        help='combine restitution, quantity conversion, responses and '
+             'band-pass filter into a single frequency-domain operation '
+             '(only effective when both fmin and fmax are set)')
+
+    def get_bands(self):
+        if self.bands:
+            return [tuple(band) for band in self.bands]
+
+        if self.nbands is not None \
+                and self.fmin is not None and self.fmax is not None:
+
+            edges = num.exp(num.linspace(
+                num.log(self.fmin), num.log(self.fmax), self.nbands+1))
+
+            return list(zip(edges[:-1], edges[1:]))
+
+        raise meta.WafeError(
+            'measure %s: method spectral_bands needs either bands or nbands, '
+            'fmin and fmax' % self.name)
+
+    def get_value_names(self):
+        '''
+        Get names of the output columns of this measure.
+        '''
+
+        if self.method == 'spectral_bands':
+            # band edges are given with three significant digits, or with
+            # more where needed to tell the bands apart
+            bands = self.get_bands()
+            for ndigits in range(3, 18):
+                names = [
+                    '%s-%.*g-%.*g' % (self.name, ndigits, fmin, ndigits, fmax)
+                    for (fmin, fmax) in bands]
+
+                if len(set(names)) == len(names):
+                    break
+
+            return names
+
+        return [self.name]
+
+    def get_restitution_parameters(self):
+        if self.fmin is not None and self.fmax is not None:
+            freqlimits = (
+                self.fmin/2.,
+                self.fmin,
+                self.fmax,
+                self.fmax*2.)
+            tfade = 1./self.fmin
+
+        else:
+            freqlimits = None
+            tfade = 0.0
+
+        return freqlimits, tfade
+
+    def get_responses(self, target, extra_responses=[]):
+        responses = []
+        responses.extend(extra_responses)
+
+        ndiff = \
+            Quantity.choices.index(self.quantity) - \
+            Quantity.choices.index(target.quantity)
+
+        if ndiff > 0:
+            responses.append(trace.DifferentiationResponse(ndiff))
+
+        if ndiff < 0:
+            responses.append(trace.IntegrationResponse(-ndiff))
+
+        if self.response:
+            responses.append(self.response)
+
+        if self.named_response:
+            responses.append(
+                NamedResponse.map[self.named_response])
+
+        return responses
+
+    def is_fused(self):
+        return self.fused and self.fmin is not None and self.fmax is not None
+
+    def get_waveform_parameters(self, target, extra_responses=[]):
+        freqlimits, tfade = self.get_restitution_parameters()
+        params = dict(
+            quantity=self.quantity,
+            freqlimits=freqlimits,
+            tfade=tfade)
+
+        if self.is_fused():
+            # frequency-domain equivalents of the time-domain Butterworth
+            # filters applied in the unfused chain
+            params['extra_responses'] = \
+                self.get_responses(target, extra_responses) + [
+                    trace.ButterworthResponse(
+                        corner=self.fmin, order=4, type='high'),
+                    trace.ButterworthResponse(
+                        corner=self.fmax, order=4, type='low')]
 
-    def evaluate(
-            self, engine, source, targets, ds,
-            extra_responses=[],
-            debug=False):
+        return params
 
-        trs_processed = []
-        trs_orig = []
-        for target in targets:
-            store = engine.get_store(target.store_id)
-
-            tmin = source.time + store.t(self.timing_tmin, source, target)
-            tmax = source.time + store.t(self.timing_tmax, source, target)
+    def get_time_window(self, engine, source, target):
+        store = engine.get_store(target.store_id)
 
-            if self.fmin is not None and self.fmax is not None:
-                freqlimits = [
-                    self.fmin/2.,
-                    self.fmin,
-                    self.fmax,
-                    self.fmax*2.]
-                tfade = 1./self.fmin
-
-            else:
-                freqlimits = None
-                tfade = 0.0
+        ttmin = store.t(self.timing_tmin, source, target)
+        ttmax = store.t(self.timing_tmax, source, target)
 
-            tr = ds.get_waveform(
-                target.codes,
-                quantity=self.quantity,
-                tmin=tmin,
-                tmax=tmax,
-                freqlimits=freqlimits,
-                tfade=tfade)
+        if ttmin is None or ttmax is None:
+            raise FeatureMeasurementFailed(
+                'timing determination failed (phase unavailable?)')
 
-            trs_orig.append(tr)
+        return source.time + ttmin, source.time + ttmax
 
-            tr = tr.copy()
+    def process(
+            self, engine, source, targets, ds,
+            extra_responses=[],
+            windows=None,
+            graph=None):
 
-            responses = []
-            responses.extend(extra_responses)
+        '''
+        Get the processed waveforms of one station.
 
-            ndiff = \
-                Quantity.choices.index(self.quantity) - \
-                Quantity.choices.index(target.quantity)
+        Returns a tuple ``(trs_orig, trs_processed)`` with one trace per
+        target each. If a :py:class:`ProcessingGraph` is given, processing
+        steps already done for other measures are reused and the returned
+        traces may be shared with them.
+        '''
 
-            if ndiff > 0:
-                responses.append(trace.DifferentiationResponse(ndiff))
+        if graph is None:
+            graph = ProcessingGraph()
 
-            if ndiff < 0:
-                responses.append(trace.IntegrationResponse(-ndiff))
+        trs_processed = []
+        trs_orig = []
+        for itarget, target in enumerate(targets):
+            if windows is not None:
+                tmin, tmax = windows[itarget]
+            else:
+                tmin, tmax = self.get_time_window(engine, source, target)
+
+            params = self.get_waveform_parameters(target, extra_responses)
+
+            def fetch():
+                with wstats.timer('get_waveform'):
+                    try:
+                        return ds.get_waveform(
+                            target.codes,
+                            tmin=tmin,
+                            tmax=tmax,
+                            **params)
+
+                    except trace.InfiniteResponse as e:
+                        raise FeatureMeasurementFailed(
+                            'restitution failed: %s' % e)
+
+            fetch_key = (
+                'waveform', tuple(target.codes), tmin, tmax,
+                params['quantity'], params['freqlimits'], params['tfade'],
+                _hash_responses(params.get('extra_responses')))
+
+            tr_orig = graph.get(fetch_key, fetch)
+            trs_orig.append(tr_orig)
+
+            if self.is_fused():
+                responses = []
+                fmin = fmax = None
+            else:
+                responses = self.get_responses(target, extra_responses)
+                fmin, fmax = self.fmin, self.fmax
 
-            if self.response:
-                responses.append(self.response)
+            def process():
+                with wstats.timer('filtering'):
+                    return filter_trace(
+                        tr_orig, responses, fmin, fmax, tmin, tmax)
 
-            if self.named_response:
-                responses.append(
-                    NamedResponse.map[self.named_response])
+            process_key = (
+                'processed', fetch_key, _hash_responses(responses),
+                fmin, fmax)
 
-            if responses:
-                trans = trace.MultiplyResponse(responses)
-                try:
-                    tr = tr.transfer(transfer_function=trans)
+            trs_processed.append(graph.get(process_key, process))
 
-                except trace.TraceTooShort:
-                    raise FeatureMeasurementFailed(
-                        'transfer: trace too short')
+        return trs_orig, trs_processed
 
-            if self.fmin is not None:
-                tr.highpass(4, self.fmin, demean=False)
+    def process_synthetic(self, targets, trs, windows, extra_responses=[]):
+        '''
+        Process synthetic traces of one station.
 
-            if self.fmax is not None:
-                tr.lowpass(4, self.fmax, demean=False)
+        Like :py:meth:`process`, but for traces as modelled by the engine,
+        which need no restitution. ``windows`` holds the ``(tmin, tmax)``
+        time window of each target.
+        '''
 
-            if tmin is None or tmax is None:
+        trs_processed = []
+        for target, tr, (tmin, tmax) in zip(targets, trs, windows):
+            if not (num.isfinite(tmin) and num.isfinite(tmax)):
                 raise FeatureMeasurementFailed(
                     'timing determination failed (phase unavailable?)')
 
-            tr.chop(tmin, tmax)
-
-            tr.set_location(tr.location + '-' + self.name + '-proc')
-            trs_processed.append(tr)
+            if self.is_fused():
+                responses = self.get_waveform_parameters(
+                    target, extra_responses)['extra_responses']
+                fmin = fmax = None
+            else:
+                responses = self.get_responses(target, extra_responses)
+                fmin, fmax = self.fmin, self.fmax
+
+            trs_processed.append(
+                filter_trace(tr, responses, fmin, fmax, tmin, tmax))
+
+        return trs_processed
+
+    def get_debug_traces(self, trs_orig, trs_processed):
+        '''
+        Get copies of the traces, labeled with the name of the measure.
+        '''
+
+        trs_out = []
+        for trs, suffix in [(trs_orig, ''), (trs_processed, '-proc')]:
+            trs_out.append([])
+            for tr in trs:
+                tr = tr.copy()
+                tr.set_location(tr.location + '-' + self.name + suffix)
+                trs_out[-1].append(tr)
+
+        return tuple(trs_out)
+
+    def check_traces(self, trs):
+        '''
+        Check that the processed traces of one station can be evaluated.
+
+        Raises :py:exc:`FeatureMeasurementFailed` if the station would make
+        :py:meth:`evaluate_batch` fail for all stations of the batch, so
+        that it can be left out.
+        '''
+
+        if self.method == 'peak_absolute_vector':
+            _align_components(trs)
+
+    def evaluate_batch(self, station_traces, debug=False):
+        '''
+        Compute the feature for many stations at once.
+
+        :param station_traces: list with one list of processed traces per
+            station, as returned by :py:meth:`process` and accepted by
+            :py:meth:`check_traces`
+        :returns: tuple ``(values, debug_infos)``, where ``values`` is an
+            array with one value per station (for method ``spectral_bands``
+            one row of band values per station) and ``debug_infos`` is a list
+            with one ``(traces, markers)`` tuple per station, holding
+            additional traces and the markers of the picked amplitudes
+            (empty unless ``debug`` is set)
+        '''
+
+        nstations = len(station_traces)
+        debug_infos = [([], []) for _ in range(nstations)]
+
+        if nstations == 0:
+            return num.zeros(0), debug_infos
 
-        markers = []
-        marker_candidates = []
         if self.method in ['peak_component', 'peak_to_peak_component']:
-            component_amp_maxs = []
-            for tr in trs_processed:
-                y = tr.get_ydata()
-                if self.method == 'peak_component':
-                    yabs = num.abs(y)
-                    i_at_amax = num.argmax(yabs)
-                    amax = yabs[i_at_amax]
-                    if debug:
-                        t_at_amax = tr.tmin + i_at_amax * tr.deltat
-                        mark = marker.Marker(
-                            [tr.nslc_id],
-                            t_at_amax,
-                            t_at_amax,
-                            0)
-
-                        marker_candidates.append(mark)
-
-                    component_amp_maxs.append(amax)
-                else:
-                    i_at_amax = num.argmax(y)
-                    i_at_amin = num.argmin(y)
-                    amax = y[i_at_amax]
-                    amin = y[i_at_amin]
-                    if debug:
-                        t_at_amax = tr.tmin + i_at_amax * tr.deltat
-                        t_at_amin = tr.tmin + i_at_amin * tr.deltat
-                        ts = sorted([t_at_amax, t_at_amin])
-                        mark = marker.Marker(
-                            [tr.nslc_id],
-                            ts[0],
-                            ts[1],
-                            0)
-
-                        marker_candidates.append(mark)
-
-                    component_amp_maxs.append(amax - amin)
-
-            i_at_amax = num.argmax(component_amp_maxs)
-            if debug:
-                markers.append(marker_candidates[i_at_amax])
-            amp_max = component_amp_maxs[i_at_amax]
+            ncomponents = len(station_traces[0])
+            ys = _pad_stack([
+                tr.get_ydata() for trs in station_traces for tr in trs])
 
-        elif self.method == 'peak_absolute_vector':
-            trsum = None
-            for tr in trs_processed:
-                tr.set_ydata(tr.get_ydata()**2)
-                if trsum is None:
-                    trsum = tr
-                else:
-                    trsum.add(tr)
+            ys = ys.reshape((nstations, ncomponents, ys.shape[-1]))
 
-            trsum.set_ydata(num.sqrt(tr.get_ydata))
-            trsum.set_codes(channel='SUM')
+            if self.method == 'peak_component':
+                values, icomponents, isamples = peak_component_batch(ys)
+                isamples_other = isamples
+            else:
+                values, icomponents, isamples, isamples_other = \
+                    peak_to_peak_component_batch(ys)
 
-            yabs = trsum.get_ydata()
+            if debug:
+                for istation, trs in enumerate(station_traces):
+                    tr = trs[icomponents[istation]]
+                    ts = sorted([
+                        tr.tmin + isamples[istation] * tr.deltat,
+                        tr.tmin + isamples_other[istation] * tr.deltat])
 
-            i_at_amax = num.argmax(yabs)
-            amax = yabs[i_at_amax]
-            t_at_amax = tr.tmin + i_at_amax * tr.deltat
-            amp_max = amax
+                    debug_infos[istation][1].append(marker.Marker(
+                        [tr.nslc_id], ts[0], ts[1], 0))
 
-            if debug:
-                markers.append(marker.Marker(
-                    [trsum.nslc_id],
-                    t_at_amax,
-                    t_at_amax,
-                    0))
+        elif self.method == 'peak_absolute_vector':
+            tmins, ys = zip(*[
+                _align_components(trs) for trs in station_traces])
 
-            trs_processed.append(trsum)
+            nsamples = [y.shape[-1] for y in ys]
+            values, isamples, yvectors = peak_absolute_vector_batch(
+                _pad_stack(ys))
+
+            if debug:
+                for istation, trs in enumerate(station_traces):
+                    trsum = trs[0].copy(data=False)
+                    trsum.set_ydata(
+                        yvectors[istation, :nsamples[istation]].copy())
+                    trsum.tmin = tmins[istation]
+                    trsum.set_codes(channel='SUM')
+
+                    t_at_amax = trsum.tmin + isamples[istation] * trsum.deltat
+                    debug_infos[istation][0].append(trsum)
+                    debug_infos[istation][1].append(marker.Marker(
+                        [trsum.nslc_id], t_at_amax, t_at_amax, 0))
 
         elif self.method == 'spectral_average':
-            component_amp_maxs = []
-            for tr in trs_processed:
-                freqs, values = tr.spectrum()
-                component_amp_maxs.append(num.mean(num.abs(values[
-                    num.logical_and(self.fmin <= freqs, freqs <= self.fmax)])))
+            # traces of equal length and sampling rate share one FFT call
+            groups = {}
+            for istation, trs in enumerate(station_traces):
+                for icomponent, tr in enumerate(trs):
+                    k = (tr.deltat, tr.data_len())
+                    groups.setdefault(k, []).append((istation, icomponent))
+
+            component_values = num.zeros(
+                (nstations, len(station_traces[0])))
+
+            for (deltat, _), indices in groups.items():
+                istations, icomponents = num.array(indices).T
+                component_values[istations, icomponents] = \
+                    spectral_average_batch(
+                        num.array([
+                            station_traces[istation][icomponent].get_ydata()
+                            for (istation, icomponent) in indices],
+                            dtype=float),
+                        deltat, self.fmin, self.fmax)
+
+            values = num.mean(component_values, axis=1)
+
+        elif self.method == 'spectral_bands':
+            # one FFT per trace, zero-padded to a power of two, for all bands;
+            # traces with the same FFT length are transformed together
+            bands = self.get_bands()
+            groups = {}
+            for istation, trs in enumerate(station_traces):
+                for icomponent, tr in enumerate(trs):
+                    k = (tr.deltat, trace.nextpow2(tr.data_len()))
+                    groups.setdefault(k, []).append((istation, icomponent))
+
+            component_values = num.zeros(
+                (nstations, len(station_traces[0]), len(bands)))
+
+            for (deltat, ntrans), indices in groups.items():
+                ys = num.zeros((len(indices), ntrans))
+                for i, (istation, icomponent) in enumerate(indices):
+                    y = station_traces[istation][icomponent].get_ydata()
+                    ys[i, :y.size] = y
+
+                istations, icomponents = num.array(indices).T
+                component_values[istations, icomponents, :] = \
+                    spectral_bands_batch(ys, deltat, bands, ntrans)
+
+            values = num.mean(component_values, axis=1)
+
+        return values, debug_infos
+
+    def evaluate(
+            self, engine, source, targets, ds,
+            extra_responses=[],
+            windows=None,
+            debug=False):
 
-            amp_max = num.mean(component_amp_maxs)
+        trs_orig, trs_processed = self.process(
+            engine, source, targets, ds,
+            extra_responses=extra_responses,
+            windows=windows)
 
         if debug:
-            trs_out = []
-            for tr in trs_orig:
-                tr_out = tr.copy()
-                tr_out.set_location(tr_out.location + '-' + self.name)
-                trs_out.append(tr_out)
+            trs_orig, trs_processed = self.get_debug_traces(
+                trs_orig, trs_processed)
 
-            return amp_max, (trs_out + trs_processed, markers)
+        with wstats.timer('measurement'):
+            values, debug_infos = self.evaluate_batch(
+                [trs_processed], debug=debug)
+
+        amp_max = values[0]
+
+        if debug:
+            trs_extra, markers = debug_infos[0]
+            return amp_max, (trs_orig + trs_processed + trs_extra, markers)
 
         return amp_max, None
@@ -43,6 +43,16 @@ def expand_template(template, d):
             'malformed placeholder in template: "%s"' % template)
 
 
+def get_template_placeholders(template):
+    placeholders = set()
+    for m in Template.pattern.finditer(template):
+        name = m.group('named') or m.group('braced')
+        if name is not None:
+            placeholders.add(name)
+
+    return placeholders
+
+
 class HasPaths(Object):
     path_prefix = Path.T(optional=True)
 
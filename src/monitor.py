@@ -0,0 +1,332 @@
+from __future__ import print_function
+import time
+import hashlib
+import logging
+import os.path as op
+
+import numpy as num
+
+from pyrocko import gf, util
+
+from wafe import core, config as wconfig, results as wresults
+
+
+logger = logging.getLogger('wafe.monitor')
+
+
+def get_event_signature(event):
+    return (
+        event.time, event.lat, event.lon, event.north_shift, event.east_shift,
+        event.depth, event.magnitude)
+
+
+def get_event_key(event):
+    '''
+    Get the key of an event in the progress manifest.
+
+    The key includes a digest of the origin, so that each version of an
+    event gets its own key.
+    '''
+
+    digest = hashlib.sha1(
+        repr(get_event_signature(event)).encode('utf8')).hexdigest()
+
+    return '%s@%s' % (event.name, digest[:16])
+
+
+def get_station_key(event_key, station):
+    return '%s/%s' % (event_key, '.'.join(station.nsl()))
+
+
+def split_key(key):
+    '''
+    Get event name and event key of a manifest key.
+
+    Returns ``(None, None)`` for keys without origin digest, as written by
+    :py:func:`wafe.core.run_extract`.
+    '''
+
+    i = key.rfind('@')
+    if i == -1:
+        return None, None
+
+    return key[:i], key[:i+17]
+
+
+def is_covered(traces, tmin, tmax):
+    '''
+    Check that traces cover the time span ``[tmin, tmax]`` without gaps.
+    '''
+
+    t = tmin
+    for tr in sorted(traces, key=lambda tr: tr.tmin):
+        if tr.tmin > t + 0.5 * tr.deltat:
+            return False
+
+        t = max(t, tr.tmax + tr.deltat)
+        if t >= tmax:
+            return True
+
+    return False
+
+
+class PendingEvent(object):
+    '''
+    Processing state of an event waiting for data.
+    '''
+
+    def __init__(self, event, tfirst):
+        self.event = event
+        self.key = get_event_key(event)
+        self.tfirst = tfirst
+        self.done = set()
+
+
+class Monitor(object):
+    '''
+    Extract features of new or updated events as soon as data is available.
+
+    On each :py:meth:`poll`, the events files and waveform paths are checked
+    for changes. A station of a pending event is processed once its
+    waveforms cover the time windows of all measures, including the
+    restitution tapers, and its results are appended to the output right
+    away. An event is complete when all of its stations are done or when
+    ``max_wait`` seconds have passed since it was first seen.
+
+    Progress is recorded per station in the progress manifest of the output
+    directory, so that a restarted monitor continues where it stopped.
+    Manifest keys include a digest of the event origin. When the origin of
+    an event changes, also while the monitor is not running, the results of
+    the previous origin are removed from the output and the event is
+    processed again. Engine, station metadata and responses stay loaded
+    between polls.
+    '''
+
+    def __init__(self, config, max_wait=3600.):
+        self.config = config
+        self.max_wait = max_wait
+        self._pending = {}
+        self._event_keys = {}
+        self._writer = None
+        self._manifest = None
+        self._output_path = None
+
+    def open(self):
+        config = self.config
+        output_path = config.expand_path(config.output_path)
+        self._output_path = output_path
+        util.ensuredir(output_path)
+
+        self._manifest = wresults.ProgressManifest(
+            output_path, config.get_extraction_hash())
+
+        if self._manifest.load():
+            checkpoint = self._manifest.last_checkpoint
+            self._manifest.open(append=True)
+        else:
+            checkpoint = None
+            self._manifest.open()
+
+        wconfig.write_config(config, op.join(output_path, 'config.yaml'))
+
+        # versions of the events with results in the output
+        for key in self._manifest.checkpoints:
+            event_name, event_key = split_key(key)
+            if event_name is not None:
+                self._event_keys[event_name] = event_key
+
+        self._open_writer(checkpoint)
+
+    def _open_writer(self, checkpoint):
+        config = self.config
+        self._writer = wresults.get_results_writer(
+            config.output_format, self._output_path,
+            config.get_value_names(), checkpoint=checkpoint)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+        if self._manifest is not None:
+            self._manifest.close()
+            self._manifest = None
+
+    def _remove_event(self, event_name):
+        '''
+        Remove the results of an event from the output and the manifest.
+        '''
+
+        config = self.config
+        self._writer.close()
+        checkpoint = wresults.remove_results(
+            config.output_format, self._output_path, [event_name],
+            config.get_value_names())
+
+        self._manifest.rewrite(
+            [key for key in self._manifest.checkpoints
+             if split_key(key)[0] != event_name and key != event_name],
+            checkpoint)
+
+        self._open_writer(checkpoint)
+        del self._event_keys[event_name]
+
+    def _update_events(self, now):
+        for event in self.config.get_events():
+            key = get_event_key(event)
+            pending = self._pending.get(event.name)
+            if pending is not None and pending.key == key:
+                continue
+
+            key_old = self._event_keys.get(event.name)
+            if self._manifest.is_done(key) or (
+                    key_old is None and pending is None
+                    and self._manifest.is_done(event.name)):
+
+                continue
+
+            if key_old is not None and key_old != key:
+                logger.info(
+                    'event %s has been updated, removing previous results'
+                    % event.name)
+
+                self._remove_event(event.name)
+                self.config.dataset_config.forget_dataset(event.name)
+
+            elif pending is not None:
+                logger.info('event %s has been updated' % event.name)
+                self.config.dataset_config.forget_dataset(event.name)
+
+            elif key_old is None:
+                logger.info('new event %s' % event.name)
+
+            self._pending[event.name] = PendingEvent(event, now)
+
+    def _is_station_done(self, pending, station):
+        key = get_station_key(pending.key, station)
+        return key in pending.done or self._manifest.is_done(key)
+
+    def _has_data(self, ds, station, tmin, tmax):
+        index = ds.get_waveform_index()
+        nsl = station.nsl()
+        channels = index.get_channels(nsl, tmin, tmax)
+        return bool(channels) and all(
+            is_covered(index.relevant(nsl + (cha,), tmin, tmax), tmin, tmax)
+            for cha in channels)
+
+    def _get_ready_stations(self, ds, source, stations):
+        windows = core.get_station_windows(self.config, source, stations)
+
+        tfades = num.array([
+            measure.get_restitution_parameters()[1]
+            for measure in self.config.measures])
+
+        tmins = num.min(windows[:, :, 0] - tfades[:, num.newaxis], axis=0)
+        tmaxs = num.max(windows[:, :, 1] + tfades[:, num.newaxis], axis=0)
+
+        iready = []
+        for istation, station in enumerate(stations):
+            # stations without valid time windows are passed on, so that
+            # the failure is reported by the extraction
+            if not (num.isfinite(tmins[istation])
+                    and num.isfinite(tmaxs[istation])) \
+                    or self._has_data(
+                        ds, station, tmins[istation], tmaxs[istation]):
+
+                iready.append(istation)
+
+        return windows, iready
+
+    def _process(self, pending, now):
+        config = self.config
+        event_name = pending.event.name
+        try:
+            ds = config.get_dataset(event_name)
+        except OSError as e:
+            logger.warn(
+                'could not get dataset for event %s: %s' % (event_name, e))
+            return 0
+
+        ds.update_waveforms()
+
+        event = ds.get_event()
+        source = gf.DCSource.from_pyrocko_event(event)
+        stations = [
+            station for station in ds.get_stations()
+            if not self._is_station_done(pending, station)]
+
+        rows = []
+        iready = []
+        if stations:
+            windows, iready = self._get_ready_stations(ds, source, stations)
+
+        if iready:
+            rows = core.extract_stations(
+                config, ds, event, [stations[i] for i in iready],
+                station_windows=windows[:, iready])
+
+            for event, station, values in rows:
+                self._writer.write(event, station, values)
+
+            checkpoint = self._writer.commit()
+            for istation in iready:
+                key = get_station_key(pending.key, stations[istation])
+                self._manifest.mark_done(key, checkpoint)
+                pending.done.add(key)
+
+            self._event_keys[event_name] = pending.key
+
+        nwaiting = len(stations) - len(iready)
+        if nwaiting == 0 or now - pending.tfirst > self.max_wait:
+            if nwaiting:
+                logger.warn(
+                    'giving up waiting for data of %i stations for event %s'
+                    % (nwaiting, event_name))
+
+            self._manifest.mark_done(pending.key, self._writer.commit())
+            self._event_keys[event_name] = pending.key
+            del self._pending[event_name]
+            config.dataset_config.forget_dataset(event_name)
+            logger.info('event %s complete' % event_name)
+
+        return len(rows)
+
+    def poll(self):
+        '''
+        Check for new events and data and process what is ready.
+
+        Returns the number of result rows written.
+        '''
+
+        now = time.time()
+        self._update_events(now)
+
+        nrows = 0
+        for event_name in sorted(self._pending):
+            nrows += self._process(self._pending[event_name], now)
+
+        return nrows
+
+    def run(self, interval=10.):
+        logger.info(
+            'monitoring events and waveforms every %g s' % interval)
+
+        while True:
+            nrows = self.poll()
+            if nrows:
+                logger.info('%i new results written' % nrows)
+
+            time.sleep(interval)
+
+
+def run_monitor(config, interval=10., max_wait=3600.):
+    monitor = Monitor(config, max_wait=max_wait)
+    monitor.open()
+    try:
+        monitor.run(interval=interval)
+
+    except KeyboardInterrupt:
+        logger.info('monitor stopped')
+
+    finally:
+        monitor.close()
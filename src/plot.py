@@ -7,7 +7,7 @@ import numpy as num
 
 from pyrocko import util
 
-from wafe import config as wconfig
+from wafe import config as wconfig, results as wresults
 
 
 km = 1000.
@@ -22,39 +22,10 @@ def run_plot(
         nbins_dist=20):
 
     config = wconfig.read_config(op.join(results_path, 'config.yaml'))
+    results = wresults.load_results(results_path, config=config)
 
-    dists = []
-    mags = []
-    measures = []
-    old_event_name = None
-    with open(op.join(results_path, 'measures.txt'), 'r') as f:
-        for line in f:
-
-            if line.strip().startswith('#'):
-                continue
-
-            toks = line.split()
-            event_name, station_codes = toks[:2]
-            measures_this = list(map(float, toks[2:]))
-
-            if event_name != old_event_name:
-                ds = config.get_dataset(event_name)
-
-            old_event_name = event_name
-
-            station = ds.get_station(tuple(station_codes.split('.')))
-
-            event = ds.get_event()
-            dist = station.distance_to(event)
-            mag = event.magnitude
-
-            dists.append(dist)
-            mags.append(mag)
-            measures.append(measures_this)
-
-    dists = num.array(dists, dtype=num.float)
-    mags = num.array(mags, dtype=num.float)
-    measures = num.array(measures, dtype=num.float)
+    dists = num.asarray(results.distance, dtype=float)
+    mags = num.asarray(results.magnitude, dtype=float)
 
     from matplotlib import pyplot as plt
     from pyrocko import plot
@@ -73,8 +44,7 @@ def run_plot(
     dist_bins = num.linspace(dist_min, dist_max, nbins_dist+1)
     # dist_centers = 0.5*(dist_bins[:-1] + dist_bins[1:])
 
-    measure_names = [m.name for m in config.measures]
-    for imeasure, measure_name in enumerate(measure_names):
+    for measure_name in results.measure_names:
         fontsize = 9.0
         fig = plt.figure(figsize=plot.mpl_papersize('a5', 'landscape'))
         labelpos = plot.mpl_margins(fig, w=7, h=5., units=fontsize)
@@ -88,12 +58,12 @@ def run_plot(
         fig.suptitle(measure_name)
 
         medians, _, _, _ = binned_statistic_2d(
-            dists, mags, measures[:, imeasure],
+            dists, mags, results.get_values(measure_name),
             statistic='median',
             bins=[dist_bins, mag_bins])
 
         counts, _, _, _ = binned_statistic_2d(
-            dists, mags, measures[:, imeasure],
+            dists, mags, results.get_values(measure_name),
             statistic='count',
             bins=[dist_bins, mag_bins])
 
@@ -116,3 +86,5 @@ def run_plot(
 
             fig.savefig(plot_path)
             logger.info('plot saved: %s' % plot_path)
+
+        plt.close(fig)
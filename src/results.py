@@ -0,0 +1,806 @@
+import os
+import os.path as op
+import logging
+import tempfile
+
+import numpy as num
+
+from pyrocko import util
+from pyrocko.guts import Object, String, List, load, dump
+
+from wafe import meta, config as wconfig
+
+guts_prefix = 'wafe'
+logger = logging.getLogger('wafe.results')
+
+
+class ResultsHeader(Object):
+    measure_names = List.T(String.T())
+
+
+class ResultsWriter(object):
+    '''
+    Base class for writers of extraction results.
+
+    Each row holds the feature values of one event-station pair.
+    '''
+
+    def __init__(self, path, measure_names):
+        self.path = path
+        self.measure_names = list(measure_names)
+
+    def write(self, event, station, values):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def commit(self):
+        '''
+        Flush and sync written rows to disk and return a checkpoint token.
+
+        A writer created with the returned token continues after the rows
+        committed so far, discarding any rows written after the commit.
+        '''
+
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _read_lines(fn):
+    with open(fn, 'r') as f:
+        return [line.rstrip('\n') for line in f]
+
+
+def _sync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+class TextResultsWriter(ResultsWriter):
+    '''
+    Writes results as whitespace-separated text to ``measures.txt``.
+    '''
+
+    def __init__(self, path, measure_names, checkpoint=None):
+        ResultsWriter.__init__(self, path, measure_names)
+        fn = op.join(path, 'measures.txt')
+        if checkpoint is None:
+            self._file = open(fn, 'w', encoding='utf8')
+            self._file.write('# event station %s\n' % ' '.join(
+                self.measure_names))
+        else:
+            self._file = open(fn, 'r+', encoding='utf8')
+            self._file.seek(int(checkpoint))
+            self._file.truncate()
+
+    def write(self, event, station, values):
+        self._file.write('%s %s %s\n' % (
+            event.name,
+            '.'.join(x for x in station.nsl()),
+            ' '.join('%g' % value for value in values)))
+
+    def flush(self):
+        self._file.flush()
+
+    def commit(self):
+        _sync(self._file)
+        return '%i' % self._file.tell()
+
+    def close(self):
+        self._file.close()
+
+
+binary_dirname = 'measures'
+
+binary_dtypes = dict(
+    ievent='<i4',
+    istation='<i4',
+    distance='<f8',
+    azimuth='<f8',
+    magnitude='<f8')
+
+
+def binary_column_filename(path, name):
+    return op.join(path, binary_dirname, name + '.bin')
+
+
+def binary_measure_column_name(imeasure):
+    return 'measure-%i' % imeasure
+
+
+class BinaryResultsWriter(ResultsWriter):
+    '''
+    Writes results in columnar binary format.
+
+    Results are stored in the directory ``measures`` with one raw
+    little-endian array file per column. Event names and station codes are
+    dictionary-encoded: the ``ievent`` and ``istation`` columns hold indices
+    into the lines of ``events.txt`` and ``stations.txt``. Distance [m],
+    azimuth [deg] from event to station and event magnitude are stored
+    alongside the feature values, which get one float64 column per measure.
+    The measure names are kept in ``header.yaml``.
+
+    Rows are buffered in memory and written column by column on
+    :py:meth:`flush` and :py:meth:`commit`. The rows of an event must be
+    written consecutively; an event name gets a new line in ``events.txt``
+    whenever it differs from the one of the previous row, so that memory use
+    does not grow with the number of events, e.g. the windows of a
+    continuous run.
+    '''
+
+    def __init__(self, path, measure_names, checkpoint=None):
+        ResultsWriter.__init__(self, path, measure_names)
+        dirpath = op.join(path, binary_dirname)
+        util.ensuredir(dirpath)
+
+        self._column_names = list(binary_dtypes.keys()) + [
+            binary_measure_column_name(imeasure)
+            for imeasure in range(len(self.measure_names))]
+
+        events_fn = op.join(dirpath, 'events.txt')
+        stations_fn = op.join(dirpath, 'stations.txt')
+
+        if checkpoint is None:
+            dump(
+                ResultsHeader(measure_names=self.measure_names),
+                filename=op.join(dirpath, 'header.yaml'))
+
+            self._nrows = 0
+            self._files = dict(
+                (name, open(binary_column_filename(path, name), 'wb'))
+                for name in self._column_names)
+
+            event_names = []
+            station_codes = []
+
+        else:
+            self._nrows, nevents, nstations = map(int, checkpoint.split(','))
+            self._files = {}
+            for name in self._column_names:
+                f = open(binary_column_filename(path, name), 'r+b')
+                f.truncate(
+                    self._nrows * num.dtype(
+                        binary_dtypes.get(name, '<f8')).itemsize)
+                f.seek(0, os.SEEK_END)
+                self._files[name] = f
+
+            event_names = _read_lines(events_fn)[:nevents]
+            station_codes = _read_lines(stations_fn)[:nstations]
+
+        self._buffers = dict((name, []) for name in self._column_names)
+
+        self._nevents = len(event_names)
+        self._event_last = event_names[-1] if event_names else None
+        self._station_index = dict(
+            (codes, i) for (i, codes) in enumerate(station_codes))
+
+        self._events_file = open(events_fn, 'w')
+        self._events_file.writelines(name + '\n' for name in event_names)
+        self._stations_file = open(stations_fn, 'w')
+        self._stations_file.writelines(
+            codes + '\n' for codes in station_codes)
+
+    def _get_index(self, index, f, key):
+        if key not in index:
+            index[key] = len(index)
+            f.write(key + '\n')
+
+        return index[key]
+
+    def write(self, event, station, values):
+        if event.name != self._event_last:
+            self._events_file.write(event.name + '\n')
+            self._event_last = event.name
+            self._nevents += 1
+
+        ievent = self._nevents - 1
+
+        istation = self._get_index(
+            self._station_index, self._stations_file,
+            '.'.join(x for x in station.nsl()))
+
+        if event.magnitude is not None:
+            magnitude = event.magnitude
+        else:
+            magnitude = num.nan
+
+        row = [
+            ievent,
+            istation,
+            station.distance_to(event),
+            event.azibazi_to(station)[0],
+            magnitude] + list(values)
+
+        for name, value in zip(self._column_names, row):
+            self._buffers[name].append(value)
+
+        self._nrows += 1
+
+    def _write_buffers(self):
+        for name in self._column_names:
+            buffer = self._buffers[name]
+            if buffer:
+                self._files[name].write(num.array(
+                    buffer, dtype=binary_dtypes.get(name, '<f8')).tobytes())
+
+                del buffer[:]
+
+    def flush(self):
+        self._write_buffers()
+        for f in self._files.values():
+            f.flush()
+
+        self._events_file.flush()
+        self._stations_file.flush()
+
+    def commit(self):
+        self._write_buffers()
+        for f in self._files.values():
+            _sync(f)
+
+        _sync(self._events_file)
+        _sync(self._stations_file)
+
+        return '%i,%i,%i' % (
+            self._nrows, self._nevents, len(self._station_index))
+
+    def close(self):
+        self._write_buffers()
+        for f in self._files.values():
+            f.close()
+
+        self._events_file.close()
+        self._stations_file.close()
+
+
+def get_results_writer(output_format, path, measure_names, checkpoint=None):
+    if output_format == 'text':
+        return TextResultsWriter(path, measure_names, checkpoint=checkpoint)
+    elif output_format == 'binary':
+        return BinaryResultsWriter(path, measure_names, checkpoint=checkpoint)
+    else:
+        raise meta.WafeError('unknown output format: %s' % output_format)
+
+
+class ProgressManifest(object):
+    '''
+    Record of events completed in an extraction run.
+
+    The manifest file ``progress.txt`` starts with the hash of the effective
+    configuration, followed by one line per completed event with the event
+    name and the writer checkpoint taken after its results were committed.
+    '''
+
+    def __init__(self, path, config_hash):
+        self.path = path
+        self.config_hash = config_hash
+        self.checkpoints = {}
+        self.last_checkpoint = None
+        self._file = None
+
+    @property
+    def filename(self):
+        return op.join(self.path, 'progress.txt')
+
+    def load(self):
+        '''
+        Read an existing manifest.
+
+        Returns ``False`` if there is no manifest. Raises
+        :py:exc:`wafe.meta.WafeError` if it was written for a different
+        configuration.
+        '''
+
+        if not op.exists(self.filename):
+            return False
+
+        with open(self.filename, 'r') as f:
+            # a partially written last line is ignored
+            lines = [line.split() for line in f if line.endswith('\n')]
+
+        if not lines or lines[0][:2] != ['#', 'config_hash']:
+            raise meta.WafeError(
+                'invalid progress manifest: %s' % self.filename)
+
+        if lines[0][2] != self.config_hash:
+            raise meta.WafeError(
+                'configuration has changed since the previous run, cannot '
+                'resume from %s' % self.filename)
+
+        for event_name, checkpoint in lines[1:]:
+            self.checkpoints[event_name] = checkpoint
+            self.last_checkpoint = checkpoint
+
+        return True
+
+    def open(self, append=False):
+        if append:
+            self._file = open(self.filename, 'a')
+        else:
+            self._file = open(self.filename, 'w')
+            self._file.write('# config_hash %s\n' % self.config_hash)
+            _sync(self._file)
+
+    def is_done(self, event_name):
+        return event_name in self.checkpoints
+
+    def mark_done(self, event_name, checkpoint):
+        self._file.write('%s %s\n' % (event_name, checkpoint))
+        _sync(self._file)
+        self.checkpoints[event_name] = checkpoint
+        self.last_checkpoint = checkpoint
+
+    def rewrite(self, keys, checkpoint):
+        '''
+        Replace the manifest by one listing only the given keys.
+
+        All keys are recorded with ``checkpoint``. Used after results have
+        been removed from the output, which invalidates the checkpoints.
+        '''
+
+        self.close()
+        _write_file_atomic(self.filename, ''.join(
+            ['# config_hash %s\n' % self.config_hash]
+            + ['%s %s\n' % (key, checkpoint) for key in keys]))
+
+        self.checkpoints = dict((key, checkpoint) for key in keys)
+        self.last_checkpoint = checkpoint
+        self.open(append=True)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _write_file_atomic(fn, data):
+    fd, fn_temp = tempfile.mkstemp(dir=op.dirname(fn) or '.')
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(data, bytes) else 'w') as f:
+            f.write(data)
+            _sync(f)
+
+        os.replace(fn_temp, fn)
+
+    except BaseException:
+        os.unlink(fn_temp)
+        raise
+
+
+class Results(object):
+    '''
+    Extraction results held as columns.
+
+    :ivar event_names: array with the distinct event names
+    :ivar station_codes: array with the distinct station codes
+    :ivar ievent: per row index into ``event_names``
+    :ivar istation: per row index into ``station_codes``
+    :ivar distance: per row event-station distance [m]
+    :ivar azimuth: per row azimuth from event to station [deg]
+    :ivar magnitude: per row event magnitude
+    :ivar measure_names: names of the measures
+    '''
+
+    def __init__(
+            self, measure_names, event_names, station_codes, ievent,
+            istation, distance, azimuth, magnitude, measure_values):
+
+        self.measure_names = measure_names
+        self.event_names = event_names
+        self.station_codes = station_codes
+        self.ievent = ievent
+        self.istation = istation
+        self.distance = distance
+        self.azimuth = azimuth
+        self.magnitude = magnitude
+        self._measure_values = measure_values
+
+    @property
+    def nrows(self):
+        return self.ievent.size
+
+    def get_values(self, measure_name):
+        '''
+        Get values of a single measure as a 1-D array.
+        '''
+
+        try:
+            imeasure = self.measure_names.index(measure_name)
+        except ValueError:
+            raise meta.WafeError('no such measure: %s' % measure_name)
+
+        return self._measure_values[imeasure]
+
+    def get_value_matrix(self):
+        '''
+        Get values of all measures as a 2-D array of shape
+        ``(nrows, nmeasures)``.
+        '''
+
+        return num.column_stack(self._measure_values)
+
+
+def load_results_binary(results_path):
+    '''
+    Load binary results, memory-mapping the column files.
+    '''
+
+    dirpath = op.join(results_path, binary_dirname)
+    header = load(filename=op.join(dirpath, 'header.yaml'))
+
+    def mmap(name):
+        fn = binary_column_filename(results_path, name)
+        dtype = num.dtype(binary_dtypes.get(name, '<f8'))
+        if os.stat(fn).st_size == 0:
+            return num.zeros(0, dtype=dtype)
+
+        return num.memmap(fn, dtype=dtype, mode='r')
+
+    columns = dict(
+        (name, mmap(name)) for name in binary_dtypes.keys())
+
+    measure_values = [
+        mmap(binary_measure_column_name(imeasure))
+        for imeasure in range(len(header.measure_names))]
+
+    # rows may be incomplete if a writer was interrupted
+    nrows = min(
+        column.size for column in list(columns.values()) + measure_values)
+
+    for name in columns:
+        columns[name] = columns[name][:nrows]
+
+    measure_values = [column[:nrows] for column in measure_values]
+
+    return Results(
+        measure_names=header.measure_names,
+        event_names=num.array(_read_lines(op.join(dirpath, 'events.txt'))),
+        station_codes=num.array(
+            _read_lines(op.join(dirpath, 'stations.txt'))),
+        measure_values=measure_values,
+        **columns)
+
+
+def load_results_text(results_path, config):
+    '''
+    Load text results, parsing ``measures.txt``.
+
+    Distances, azimuths and magnitudes are looked up in the datasets of the
+    given configuration.
+    '''
+
+    event_index = {}
+    station_index = {}
+    rows = []
+    values = []
+    old_event_name = None
+    with open(op.join(results_path, 'measures.txt'), 'r') as f:
+        for line in f:
+
+            if line.strip().startswith('#'):
+                continue
+
+            toks = line.split()
+            event_name, station_codes = toks[:2]
+            values.append(list(map(float, toks[2:])))
+
+            if event_name != old_event_name:
+                ds = config.get_dataset(event_name)
+                event = ds.get_event()
+
+            old_event_name = event_name
+
+            station = ds.get_station(tuple(station_codes.split('.')))
+
+            if event_name not in event_index:
+                event_index[event_name] = len(event_index)
+
+            if station_codes not in station_index:
+                station_index[station_codes] = len(station_index)
+
+            rows.append((
+                event_index[event_name],
+                station_index[station_codes],
+                station.distance_to(event),
+                event.azibazi_to(station)[0],
+                event.magnitude if event.magnitude is not None else num.nan))
+
+    measure_names = config.get_value_names()
+    nmeasures = len(measure_names)
+    values = num.array(values, dtype=float).reshape((len(rows), nmeasures))
+    rows = num.array(rows, dtype=float).reshape((len(rows), 5))
+
+    def names(index):
+        return num.array(sorted(index, key=lambda k: index[k]))
+
+    return Results(
+        measure_names=measure_names,
+        event_names=names(event_index),
+        station_codes=names(station_index),
+        ievent=rows[:, 0].astype(num.int32),
+        istation=rows[:, 1].astype(num.int32),
+        distance=rows[:, 2],
+        azimuth=rows[:, 3],
+        magnitude=rows[:, 4],
+        measure_values=[values[:, i] for i in range(nmeasures)])
+
+
+def load_results(results_path, config=None):
+    '''
+    Load extraction results from a results directory.
+
+    The format is that of the configuration the results were written with,
+    which is read from the results directory if not given. Without a
+    configuration, binary results are loaded if available.
+    '''
+
+    config_path = op.join(results_path, 'config.yaml')
+    if config is None and op.exists(config_path):
+        config = wconfig.read_config(config_path)
+
+    if config is not None:
+        output_format = config.output_format
+    elif op.exists(op.join(results_path, binary_dirname, 'header.yaml')):
+        output_format = 'binary'
+    else:
+        raise meta.WafeError(
+            'no configuration found in results directory %s' % results_path)
+
+    if output_format == 'binary':
+        return load_results_binary(results_path)
+
+    return load_results_text(results_path, config)
+
+
+def merge_results_text(shards, event_order, path, measure_names):
+    '''
+    Merge text results of several partial runs into ``measures.txt``.
+
+    :param shards: list of ``(path, checkpoint)`` tuples, one per partial
+        run, where ``checkpoint`` is the writer checkpoint of its last
+        completed event
+    :param event_order: list of ``(event_name, ishard)`` tuples giving the
+        order of events in the merged output and the partial run holding
+        each of them
+    :returns: list with the writer checkpoint after each event
+    '''
+
+    header = '# event station %s\n' % ' '.join(measure_names)
+
+    event_lines = []
+    for shard_path, checkpoint in shards:
+        event_lines.append({})
+        if checkpoint is None:
+            continue
+
+        with open(op.join(shard_path, 'measures.txt'), 'rb') as f:
+            # rows written after the last checkpoint are discarded; the
+            # checkpoint is a byte offset
+            lines = f.read(int(checkpoint)).decode('utf8').splitlines(True)
+
+        if not lines or lines[0] != header:
+            raise meta.WafeError(
+                'measure names of partial results in %s do not match'
+                % shard_path)
+
+        for line in lines[1:]:
+            event_lines[-1].setdefault(line.split(None, 1)[0], []).append(
+                line)
+
+    checkpoints = []
+    with open(op.join(path, 'measures.txt'), 'w', encoding='utf8') as f:
+        f.write(header)
+        for event_name, ishard in event_order:
+            f.writelines(event_lines[ishard].get(event_name, []))
+            checkpoints.append('%i' % f.tell())
+
+        _sync(f)
+
+    return checkpoints
+
+
+def merge_results_binary(shards, event_order, path, measure_names):
+    '''
+    Merge binary results of several partial runs.
+
+    Arguments and return value are as for :py:func:`merge_results_text`.
+    '''
+
+    column_names = list(binary_dtypes.keys()) + [
+        binary_measure_column_name(imeasure)
+        for imeasure in range(len(measure_names))]
+
+    shard_results = []
+    for shard_path, checkpoint in shards:
+        if checkpoint is None:
+            shard_results.append(None)
+            continue
+
+        results = load_results_binary(shard_path)
+        if results.measure_names != list(measure_names):
+            raise meta.WafeError(
+                'measure names of partial results in %s do not match'
+                % shard_path)
+
+        nrows = int(checkpoint.split(',')[0])
+        if results.nrows < nrows:
+            raise meta.WafeError(
+                'partial results in %s are incomplete' % shard_path)
+
+        columns = dict(
+            (name, getattr(results, name)[:nrows])
+            for name in binary_dtypes.keys())
+
+        for imeasure, measure_name in enumerate(measure_names):
+            columns[binary_measure_column_name(imeasure)] = \
+                results.get_values(measure_name)[:nrows]
+
+        event_rows = {}
+        for irow, ievent in enumerate(columns['ievent']):
+            event_rows.setdefault(
+                results.event_names[ievent], []).append(irow)
+
+        shard_results.append((results, columns, event_rows))
+
+    dirpath = op.join(path, binary_dirname)
+    util.ensuredir(dirpath)
+    dump(
+        ResultsHeader(measure_names=list(measure_names)),
+        filename=op.join(dirpath, 'header.yaml'))
+
+    files = dict(
+        (name, open(binary_column_filename(path, name), 'wb'))
+        for name in column_names)
+
+    event_names = []
+    station_index = {}
+    nrows = 0
+    checkpoints = []
+    try:
+        for event_name, ishard in event_order:
+            irows = []
+            if shard_results[ishard] is not None:
+                results, columns, event_rows = shard_results[ishard]
+                irows = num.array(event_rows.get(event_name, []), dtype=int)
+
+            if len(irows) != 0:
+                station_codes = results.station_codes[
+                    columns['istation'][irows]]
+
+                istations = []
+                for codes in station_codes:
+                    if codes not in station_index:
+                        station_index[codes] = len(station_index)
+
+                    istations.append(station_index[codes])
+
+                row_columns = dict(
+                    (name, columns[name][irows]) for name in column_names)
+
+                row_columns['ievent'] = num.full(
+                    irows.size, len(event_names))
+                row_columns['istation'] = num.array(istations)
+                event_names.append(event_name)
+
+                for name in column_names:
+                    files[name].write(row_columns[name].astype(
+                        binary_dtypes.get(name, '<f8')).tobytes())
+
+                nrows += irows.size
+
+            checkpoints.append('%i,%i,%i' % (
+                nrows, len(event_names), len(station_index)))
+
+        for f in files.values():
+            _sync(f)
+
+    finally:
+        for f in files.values():
+            f.close()
+
+    for fn, names in [
+            ('events.txt', event_names),
+            ('stations.txt', sorted(
+                station_index, key=lambda k: station_index[k]))]:
+
+        with open(op.join(dirpath, fn), 'w') as f:
+            f.writelines(name + '\n' for name in names)
+            _sync(f)
+
+    return checkpoints
+
+
+def remove_results_text(path, event_names):
+    fn = op.join(path, 'measures.txt')
+    with open(fn, 'r') as f:
+        lines = [
+            line for line in f
+            if line.startswith('#') or line.split(None, 1)[0]
+            not in event_names]
+
+    data = ''.join(lines)
+    _write_file_atomic(fn, data)
+    return '%i' % len(data.encode('utf8'))
+
+
+def remove_results_binary(path, event_names, measure_names):
+    dirpath = op.join(path, binary_dirname)
+    events = _read_lines(op.join(dirpath, 'events.txt'))
+    stations = _read_lines(op.join(dirpath, 'stations.txt'))
+    ievents_remove = [
+        ievent for (ievent, event_name) in enumerate(events)
+        if event_name in event_names]
+
+    column_names = list(binary_dtypes.keys()) + [
+        binary_measure_column_name(imeasure)
+        for imeasure in range(len(measure_names))]
+
+    columns = dict(
+        (name, num.fromfile(
+            binary_column_filename(path, name),
+            dtype=binary_dtypes.get(name, '<f8')))
+        for name in column_names)
+
+    # rows may be incomplete if a writer was interrupted
+    nrows = min(column.size for column in columns.values())
+    keep = num.logical_not(
+        num.isin(columns['ievent'][:nrows], ievents_remove))
+
+    for name, column in columns.items():
+        _write_file_atomic(
+            binary_column_filename(path, name),
+            column[:nrows][keep].tobytes())
+
+    return '%i,%i,%i' % (num.sum(keep), len(events), len(stations))
+
+
+def remove_results(output_format, path, event_names, measure_names):
+    '''
+    Remove the rows of the given events from the results in ``path``.
+
+    Returns a checkpoint token for a writer continuing after the remaining
+    rows.
+    '''
+
+    if output_format == 'text':
+        return remove_results_text(path, event_names)
+    elif output_format == 'binary':
+        return remove_results_binary(path, event_names, measure_names)
+    else:
+        raise meta.WafeError('unknown output format: %s' % output_format)
+
+
+def merge_results(output_format, shards, event_order, path, measure_names):
+    if output_format == 'text':
+        return merge_results_text(shards, event_order, path, measure_names)
+    elif output_format == 'binary':
+        return merge_results_binary(shards, event_order, path, measure_names)
+    else:
+        raise meta.WafeError('unknown output format: %s' % output_format)
+
+
+__all__ = '''
+    ResultsHeader
+    ResultsWriter
+    TextResultsWriter
+    BinaryResultsWriter
+    get_results_writer
+    ProgressManifest
+    Results
+    load_results
+    load_results_binary
+    load_results_text
+    merge_results
+    merge_results_text
+    merge_results_binary
+    remove_results
+'''.split()
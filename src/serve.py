@@ -0,0 +1,384 @@
+'''
+Extraction daemon answering requests over HTTP on localhost.
+
+The configuration, the engine with its GF stores, station metadata,
+responses and waveform indexes stay loaded between requests, so that a
+request only pays for the processing of its own waveforms.
+
+Requests are JSON objects posted to ``/extract``::
+
+    {"event_name": "ev0001", "stations": ["GE.APE.", "GE.ARG"]}
+
+    {"event": {"name": "alert1", "time": "2020-01-01 12:00:00.0",
+               "lat": 37.9, "lon": 23.5, "depth": 10000., "magnitude": 4.2}}
+
+With ``event_name``, the event is looked up in the events of the
+configuration, otherwise it is given by ``event``. ``stations`` optionally
+restricts the extraction to stations matching the given ``STA``,
+``NET.STA`` or ``NET.STA.LOC`` codes. The response holds one entry per
+station, with the values of all measures, ``null`` where not finite.
+``GET /status`` returns the value names and request counts.
+
+New and modified waveform files are picked up by a background thread every
+``update_interval`` seconds. Updates of a dataset wait until running
+extractions on it have finished, and extractions wait for running updates.
+'''
+
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as num
+
+from pyrocko import model, util
+
+from wafe import core, meta as wmeta
+
+logger = logging.getLogger('wafe.serve')
+
+
+class BadRequest(Exception):
+    pass
+
+
+def get_event(request):
+    try:
+        ev = request['event']
+        t = ev['time']
+        if not isinstance(t, (int, float)):
+            t = util.str_to_time(t)
+
+        return model.Event(
+            name=ev.get('name', util.time_to_str(t)),
+            time=t,
+            lat=float(ev['lat']),
+            lon=float(ev['lon']),
+            depth=float(ev.get('depth', 0.0)),
+            magnitude=ev.get('magnitude'))
+
+    except (KeyError, TypeError, ValueError, util.TimeStrError) as e:
+        raise BadRequest('invalid event parameters: %s' % e)
+
+
+def match_station(station, patterns):
+    codes = [
+        station.station,
+        '.'.join(station.nsl()[:2]),
+        '.'.join(station.nsl())]
+
+    return any(pattern in codes for pattern in patterns)
+
+
+def finite_or_none(value):
+    return float(value) if num.isfinite(value) else None
+
+
+class ReadWriteLock(object):
+    '''
+    Lock which is held either by any number of readers or by one writer.
+
+    Waiting writers take precedence over new readers.
+    '''
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._nreaders = 0
+        self._nwriters_waiting = 0
+        self._writing = False
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writing or self._nwriters_waiting:
+                self._cond.wait()
+
+            self._nreaders += 1
+
+        try:
+            yield
+
+        finally:
+            with self._cond:
+                self._nreaders -= 1
+                if self._nreaders == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._nwriters_waiting += 1
+            while self._writing or self._nreaders:
+                self._cond.wait()
+
+            self._nwriters_waiting -= 1
+            self._writing = True
+
+        try:
+            yield
+
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+
+class ResidentDataset(object):
+    '''
+    Dataset held by the daemon, with the lock guarding its waveform data.
+    '''
+
+    def __init__(self, ds):
+        self.ds = ds
+        self.lock = ReadWriteLock()
+        self._prepared = False
+
+    def prepare(self):
+        '''
+        Load stations and index the waveform files, before any extraction.
+        '''
+
+        if not self._prepared:
+            with self.lock.write():
+                if not self._prepared:
+                    self.ds.get_stations()
+                    self.ds.get_waveform_index()
+                    self._prepared = True
+
+    def update(self):
+        with self.lock.write():
+            return self.ds.update_waveforms()
+
+
+class Server(object):
+    '''
+    Resident state of the daemon and handling of extraction requests.
+
+    Datasets of the most recently requested events are kept, up to
+    ``ndatasets_max``. With a waveform archive shared by all events, a single
+    dataset serves all requests. If ``update`` is set, new waveform files are
+    looked for every ``update_interval`` seconds.
+    '''
+
+    def __init__(
+            self, config, nworkers=4, ndatasets_max=8, update=True,
+            update_interval=10.):
+
+        self.config = config
+        self.update = update
+        self.update_interval = update_interval
+        self.ndatasets_max = ndatasets_max
+        self.nrequests = 0
+        self.nfailed = 0
+        self._executor = ThreadPoolExecutor(max_workers=nworkers)
+        self._lock = threading.Lock()
+        self._datasets = OrderedDict()
+        self._stop_event = threading.Event()
+        self._updater = None
+        if update:
+            self._updater = threading.Thread(
+                target=self._run_updates, daemon=True)
+            self._updater.start()
+
+    def _get_dataset_name(self, event_name):
+        if self.config.dataset_config.has_event_waveform_paths():
+            return event_name
+        else:
+            return None
+
+    def get_dataset(self, event_name):
+        '''
+        Get the :py:class:`ResidentDataset` of an event, setting it up if
+        needed.
+        '''
+
+        name = self._get_dataset_name(event_name)
+        with self._lock:
+            if name not in self._datasets:
+                self._datasets[name] = ResidentDataset(
+                    self.config.get_dataset(name))
+
+            self._datasets.move_to_end(name)
+            while len(self._datasets) > self.ndatasets_max:
+                name_old, _ = self._datasets.popitem(last=False)
+                self.config.dataset_config.forget_dataset(name_old)
+
+            resident = self._datasets[name]
+
+        resident.prepare()
+        return resident
+
+    def _run_updates(self):
+        while not self._stop_event.wait(self.update_interval):
+            with self._lock:
+                residents = list(self._datasets.values())
+
+            for resident in residents:
+                try:
+                    if resident.update():
+                        logger.info('new waveform data found')
+
+                except Exception:
+                    logger.exception('update of waveform data failed')
+
+    def warm_up(self):
+        '''
+        Load engine, GF store, station metadata and waveform index.
+        '''
+
+        t0 = time.time()
+        self.config.get_engine().get_store(self.config.store_id)
+        if self.config.dataset_config.has_event_waveform_paths():
+            # station metadata and responses are cached process-wide, so
+            # setting up the dataset of any event loads them
+            names = self.config.get_event_names()[-1:]
+        else:
+            names = [None]
+
+        for name in names:
+            self.get_dataset(name)
+
+        logger.info('warm-up completed in %.2f s' % (time.time() - t0))
+
+    def extract(self, request):
+        t0 = time.time()
+        if 'event_name' in request:
+            event_name = str(request['event_name'])
+            event = self.config.get_event(event_name)
+            if event is None:
+                raise BadRequest('no such event: %s' % event_name)
+
+            resident = self.get_dataset(event_name)
+
+        elif 'event' in request:
+            event = get_event(request)
+            resident = self.get_dataset(event.name)
+
+        else:
+            raise BadRequest('either event_name or event is required')
+
+        ds = resident.ds
+        stations = ds.get_stations()
+        if request.get('stations') is not None:
+            stations = [
+                station for station in stations
+                if match_station(station, request['stations'])]
+
+        with resident.lock.read():
+            rows = core.extract_stations(self.config, ds, event, stations)
+
+        return dict(
+            event=event.name,
+            value_names=self.config.get_value_names(),
+            results=[
+                dict(
+                    station='.'.join(station.nsl()),
+                    distance=station.distance_to(event),
+                    values=[finite_or_none(value) for value in values])
+                for (_, station, values) in rows],
+            nstations=len(stations),
+            duration=time.time() - t0)
+
+    def submit(self, request):
+        with self._lock:
+            self.nrequests += 1
+
+        return self._executor.submit(self.extract, request).result()
+
+    def get_status(self):
+        return dict(
+            value_names=self.config.get_value_names(),
+            nrequests=self.nrequests,
+            nfailed=self.nfailed,
+            ndatasets=len(self._datasets),
+            caches=self.config.dataset_config.get_cache_report())
+
+    def close(self):
+        self._stop_event.set()
+        if self._updater is not None:
+            self._updater.join()
+
+        self._executor.shutdown(wait=True)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+
+    def _send(self, code, obj):
+        data = json.dumps(obj).encode('utf8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self._send(200, self.server.wafe_server.get_status())
+        else:
+            self._send(404, dict(error='not found'))
+
+    def do_POST(self):
+        if self.path != '/extract':
+            self._send(404, dict(error='not found'))
+            return
+
+        server = self.server.wafe_server
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                request = json.loads(self.rfile.read(length))
+            except ValueError as e:
+                raise BadRequest('invalid JSON: %s' % e)
+
+            if not isinstance(request, dict):
+                raise BadRequest('request must be a JSON object')
+
+            self._send(200, server.submit(request))
+
+        except BadRequest as e:
+            server.nfailed += 1
+            self._send(400, dict(error=str(e)))
+
+        except Exception as e:
+            server.nfailed += 1
+            logger.exception('request failed')
+            self._send(500, dict(error=str(e)))
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def run_serve(
+        config, host='127.0.0.1', port=8765, nworkers=4, update=True,
+        update_interval=10.):
+
+    '''
+    Serve extraction requests until interrupted.
+    '''
+
+    server = Server(
+        config, nworkers=nworkers, update=update,
+        update_interval=update_interval)
+    server.warm_up()
+
+    try:
+        httpd = ThreadingHTTPServer((host, port), RequestHandler)
+    except OSError as e:
+        raise wmeta.WafeError(
+            'cannot listen on %s:%i: %s' % (host, port, e))
+
+    httpd.wafe_server = server
+    logger.info('serving on http://%s:%i' % (host, port))
+    try:
+        httpd.serve_forever()
+
+    except KeyboardInterrupt:
+        logger.info('server stopped')
+
+    finally:
+        httpd.server_close()
+        server.close()
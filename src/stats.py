@@ -0,0 +1,223 @@
+'''
+Run-time statistics of extraction runs.
+
+Stages of the processing are timed with :py:func:`timer` and events like
+cache hits are counted with :py:func:`count`. Both are no-ops unless
+statistics are enabled with :py:func:`enable`. Stage times are inclusive,
+i.e. the time of a stage includes the time of any stages nested in it.
+
+Statistics may be collected from several threads, e.g. when data is
+prefetched in the background. The CPU time of a stage is that of the thread
+running it, so that work done by other threads in the meantime is not
+attributed to it.
+'''
+
+import time
+import json
+import logging
+import threading
+from contextlib import contextmanager
+from collections import defaultdict
+
+
+logger = logging.getLogger('wafe.stats')
+
+
+class Stats(object):
+    '''
+    Accumulator for stage timings and counters.
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._reset()
+
+    def _reset(self):
+        # stage name -> [number of calls, wall time, cpu time]
+        self.stages = defaultdict(lambda: [0, 0.0, 0.0])
+        self.counters = defaultdict(int)
+
+    @contextmanager
+    def timer(self, stage):
+        if not self.enabled:
+            yield
+            return
+
+        twall = time.time()
+        tcpu = time.thread_time()
+        try:
+            yield
+        finally:
+            dwall = time.time() - twall
+            dcpu = time.thread_time() - tcpu
+            with self._lock:
+                entry = self.stages[stage]
+                entry[0] += 1
+                entry[1] += dwall
+                entry[2] += dcpu
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] += n
+
+    def snapshot(self):
+        with self._lock:
+            return self._snapshot()
+
+    def _snapshot(self):
+        return dict(
+            stages=dict((k, list(v)) for (k, v) in self.stages.items()),
+            counters=dict(self.counters))
+
+    def pop(self):
+        '''
+        Get a snapshot of the statistics and reset them.
+        '''
+
+        with self._lock:
+            snapshot = self._snapshot()
+            self._reset()
+
+        return snapshot
+
+    def merge(self, snapshot):
+        '''
+        Add statistics from a snapshot, e.g. one taken in a worker process.
+        '''
+
+        with self._lock:
+            for k, (ncalls, twall, tcpu) in snapshot['stages'].items():
+                entry = self.stages[k]
+                entry[0] += ncalls
+                entry[1] += twall
+                entry[2] += tcpu
+
+            for k, n in snapshot['counters'].items():
+                self.counters[k] += n
+
+    def get_report(self):
+        snapshot = self.snapshot()
+        return dict(
+            stages=dict(
+                (k, dict(count=ncalls, wall=twall, cpu=tcpu))
+                for (k, (ncalls, twall, tcpu))
+                in sorted(snapshot['stages'].items())),
+            counters=dict(sorted(snapshot['counters'].items())))
+
+
+g_stats = Stats()
+
+
+def enable(enabled=True):
+    g_stats.enabled = enabled
+
+
+def is_enabled():
+    return g_stats.enabled
+
+
+def timer(stage):
+    return g_stats.timer(stage)
+
+
+def count(name, n=1):
+    g_stats.count(name, n)
+
+
+class Progress(object):
+    '''
+    Periodic progress and ETA reports of an extraction run.
+    '''
+
+    def __init__(self, nevents, interval=10.):
+        self.nevents = nevents
+        self.interval = interval
+        self.ievent = 0
+        self.nstations = 0
+        self.tstart = time.time()
+        self._tlast = self.tstart
+
+    def update(self, nstations):
+        self.ievent += 1
+        self.nstations += nstations
+        now = time.time()
+        if now - self._tlast >= self.interval or self.ievent == self.nevents:
+            self._tlast = now
+            logger.info(self.get_status(now))
+
+    def get_rates(self, now=None):
+        if now is None:
+            now = time.time()
+
+        duration = max(now - self.tstart, 1e-6)
+        return self.ievent / duration, self.nstations / duration
+
+    def get_status(self, now):
+        events_rate, stations_rate = self.get_rates(now)
+        if events_rate > 0.0:
+            eta = '%.0f s' % ((self.nevents - self.ievent) / events_rate)
+        else:
+            eta = 'unknown'
+
+        return 'progress: %i/%i events, %.2f events/s, %.2f stations/s, ' \
+            'ETA %s' % (
+                self.ievent, self.nevents, events_rate, stations_rate, eta)
+
+    def get_report(self):
+        events_rate, stations_rate = self.get_rates()
+        return dict(
+            nevents=self.ievent,
+            nstations=self.nstations,
+            wall=time.time() - self.tstart,
+            events_per_second=events_rate,
+            stations_per_second=stations_rate)
+
+
+def write_report(path, progress, caches=None):
+    report = g_stats.get_report()
+    report.update(progress.get_report())
+    if caches is not None:
+        report['caches'] = caches
+
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def merge_reports(reports):
+    '''
+    Combine reports of runs which were executed side by side.
+
+    Stage timings, counters and numbers of events and stations are summed,
+    the wall time is that of the longest run.
+    '''
+
+    merged = Stats()
+    nevents = nstations = 0
+    wall = 0.0
+    for report in reports:
+        merged.merge(dict(
+            stages=dict(
+                (k, (v['count'], v['wall'], v['cpu']))
+                for (k, v) in report['stages'].items()),
+            counters=report['counters']))
+
+        nevents += report['nevents']
+        nstations += report['nstations']
+        wall = max(wall, report['wall'])
+
+    report = merged.get_report()
+    duration = max(wall, 1e-6)
+    report.update(
+        nevents=nevents,
+        nstations=nstations,
+        wall=wall,
+        events_per_second=nevents / duration,
+        stations_per_second=nstations / duration)
+
+    return report
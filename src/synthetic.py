@@ -1,13 +1,306 @@
 import copy
 import math
+import itertools
+import logging
+import multiprocessing
+
 import numpy as num
 from pyrocko import gf, moment_tensor as pmt, trace
 from pyrocko import plot
 
 from wafe import measure as wmeasure
 
+logger = logging.getLogger('wafe.synthetic')
+
 km = 1000.
 
+d2r = math.pi / 180.
+
+g_worker_setup = None
+
+
+def get_column_names(measures):
+    '''
+    Get names of the columns of the arrays produced by :py:func:`model`.
+    '''
+
+    names = ['magnitude', 'duration', 'depth', 'distance']
+    for measure in measures:
+        names.extend(measure.get_value_names())
+
+    return names
+
+
+def load_model(path, measures):
+    '''
+    Load results written by :py:func:`model` as a memory-mapped array.
+    '''
+
+    ncolumns = len(get_column_names(measures))
+    return num.memmap(path, dtype=num.float64, mode='r').reshape(
+        (-1, ncolumns))
+
+
+def get_duration(magnitude, stress_drop, rupture_velocity):
+    '''
+    Get source duration from magnitude, stress drop and rupture velocity.
+    '''
+
+    radius = (pmt.magnitude_to_moment(magnitude) * 7./16. /
+              stress_drop)**(1./3.)
+
+    return 1.5 * radius / rupture_velocity
+
+
+def get_source(
+        mt, depth, duration, apply_source_response_via_spectra=True):
+
+    '''
+    Get source and extra responses to be applied to its synthetics.
+    '''
+
+    if apply_source_response_via_spectra:
+        source = gf.MTSource(
+            m6=mt.m6(),
+            depth=depth)
+
+        extra_responses = [
+            wmeasure.BruneResponse(duration=duration)]
+    else:
+        source = gf.MTSource(
+            m6=mt.m6(),
+            depth=depth,
+            stf=gf.HalfSinusoidSTF(effective_duration=duration))
+
+        extra_responses = []
+
+    return source, extra_responses
+
+
+def get_components(measures):
+    components = set()
+    for measure in measures:
+        components.update(measure.components)
+
+    return sorted(components)
+
+
+def evaluate_synthetics(
+        engine, store_id, measures, sources, source_responses, receivers,
+        isource_offset=0, shared_receivers=True, debug=False):
+
+    '''
+    Model and evaluate features for all combinations of sources and receivers.
+
+    ``receivers`` is a list of ``(north_shift, east_shift)`` tuples. If
+    ``shared_receivers`` is ``True``, all sources are recorded at these
+    receivers and the synthetic traces are computed with a single call to
+    ``engine.process``. Otherwise, ``receivers`` holds one such list per
+    source, all of the same length, and ``engine.process`` is called once
+    per source. In both cases, features are evaluated for all pairs at once.
+
+    Returns a tuple ``(values, nerrors, traces_debug, markers_debug)``, where
+    ``values`` is an array with one row per source and receiver and one
+    column per value name of the measures, ``NaN`` where the measurement
+    failed.
+    '''
+
+    components = get_components(measures)
+    nsources = len(sources)
+
+    if shared_receivers:
+        groups = [(list(range(nsources)), receivers)]
+        nreceivers = len(receivers)
+    else:
+        groups = [
+            ([isource], receivers[isource]) for isource in range(nsources)]
+        nreceivers = len(receivers[0]) if receivers else 0
+
+    # synthetic traces, targets and time windows indexed by [source, target]
+    trs = [None] * nsources
+    source_targets = [None] * nsources
+    windows = [None] * nsources
+    for isources, receivers_group in groups:
+        targets = []
+        for ireceiver, (north_shift, east_shift) in enumerate(
+                receivers_group):
+
+            for comp in components:
+                targets.append(gf.Target(
+                    quantity='displacement',
+                    codes=('', 'R%i' % ireceiver, '', comp),
+                    north_shift=north_shift,
+                    east_shift=east_shift,
+                    depth=0.,
+                    store_id=store_id))
+
+        resp = engine.process([sources[i] for i in isources], targets)
+
+        for isource, results in zip(isources, resp.results_list):
+            trs[isource] = []
+            for result in results:
+                if isinstance(result, gf.SeismosizerError):
+                    trs[isource].append(None)
+                else:
+                    tr = result.trace.pyrocko_trace()
+                    tr.set_station(
+                        '%i_%s' % (isource_offset + isource, tr.station))
+                    trs[isource].append(tr)
+
+            source_targets[isource] = targets
+            windows[isource] = wmeasure.get_time_windows(
+                engine, sources[isource], measures, targets)
+
+    values = num.full(
+        (nsources * nreceivers, len(get_column_names(measures)) - 4), num.nan)
+
+    nerrors = 0
+    traces_debug = []
+    markers_debug = []
+    icolumn = 0
+    for imeasure, measure in enumerate(measures):
+        ncolumns = len(measure.get_value_names())
+        station_traces = []
+        ipairs = []
+        for isource in range(nsources):
+            for ireceiver in range(nreceivers):
+                itargets = [
+                    ireceiver * len(components) + components.index(comp)
+                    for comp in measure.components]
+
+                trs_pair = [trs[isource][itarget] for itarget in itargets]
+                try:
+                    if any(tr is None for tr in trs_pair):
+                        raise wmeasure.FeatureMeasurementFailed(
+                            'modelling failed')
+
+                    trs_processed = measure.process_synthetic(
+                        [source_targets[isource][itarget]
+                         for itarget in itargets],
+                        trs_pair,
+                        windows[isource][imeasure, itargets],
+                        source_responses[isource])
+
+                    measure.check_traces(trs_processed)
+
+                except wmeasure.FeatureMeasurementFailed:
+                    nerrors += 1
+                    continue
+
+                if debug:
+                    trs_pair, trs_processed = measure.get_debug_traces(
+                        trs_pair, trs_processed)
+                    traces_debug.extend(trs_pair + trs_processed)
+
+                station_traces.append(trs_processed)
+                ipairs.append(isource * nreceivers + ireceiver)
+
+        measure_values, debug_infos = measure.evaluate_batch(
+            station_traces, debug=debug)
+
+        if ipairs:
+            values[ipairs, icolumn:icolumn+ncolumns] = num.reshape(
+                measure_values, (len(ipairs), ncolumns))
+
+        for trs_extra, markers in debug_infos:
+            traces_debug.extend(trs_extra)
+            markers_debug.extend(markers)
+
+        icolumn += ncolumns
+
+    return values, nerrors, traces_debug, markers_debug
+
+
+def model_chunk(setup, seed, isource_offset, nsources):
+    '''
+    Model features for one chunk of random sources.
+
+    Each source is recorded at its own ``nreceivers`` random receiver
+    positions or, if ``shared_receivers`` is set up, all sources of the
+    chunk at the same ones. The features of all sources of the chunk are
+    evaluated at once. Random numbers are drawn from a generator initialized
+    with ``seed``, so the result does not depend on which process handles
+    the chunk.
+
+    Returns a tuple ``(data, nerrors, traces_debug, markers_debug)``.
+    '''
+
+    s = setup
+    nreceivers = s['nreceivers']
+
+    rng = num.random.default_rng(seed)
+
+    def get_receivers():
+        angles = rng.uniform(0., 360., size=nreceivers)
+        distances = num.exp(rng.uniform(
+            math.log(s['distance_min']), math.log(s['distance_max']),
+            size=nreceivers))
+
+        return distances, list(zip(
+            distances*num.cos(d2r*angles), distances*num.sin(d2r*angles)))
+
+    if s['shared_receivers']:
+        distances, receivers = get_receivers()
+
+    sources = []
+    source_responses = []
+    source_receivers = []
+    data = num.full(
+        (nsources * nreceivers, len(get_column_names(s['measures']))),
+        num.nan)
+
+    for isource in range(nsources):
+        magnitude = rng.uniform(s['magnitude_min'], s['magnitude_max'])
+        stress_drop = rng.uniform(s['stress_drop_min'], s['stress_drop_max'])
+        rupture_velocity = rng.uniform(
+            s['rupture_velocity_min'], s['rupture_velocity_max'])
+
+        duration = get_duration(magnitude, stress_drop, rupture_velocity)
+
+        if s['moment_tensor'] is None:
+            mt = pmt.MomentTensor.random_dc(
+                x=rng.uniform(size=3), magnitude=magnitude)
+        else:
+            mt = copy.deepcopy(s['moment_tensor'])
+            mt.magnitude = magnitude
+
+        depth = rng.uniform(s['depth_min'], s['depth_max'])
+        source, extra_responses = get_source(
+            mt, depth, duration, s['apply_source_response_via_spectra'])
+
+        if not s['shared_receivers']:
+            distances, receivers = get_receivers()
+
+        sources.append(source)
+        source_responses.append(extra_responses)
+        source_receivers.append(receivers)
+
+        irows = slice(isource*nreceivers, (isource+1)*nreceivers)
+        data[irows, :3] = magnitude, duration, depth
+        data[irows, 3] = distances
+
+    if s['shared_receivers']:
+        source_receivers = receivers
+
+    data[:, 4:], nerrors, traces_debug, markers_debug = evaluate_synthetics(
+        s['engine'], s['store_id'], s['measures'], sources, source_responses,
+        source_receivers, isource_offset=isource_offset,
+        shared_receivers=s['shared_receivers'], debug=s['debug'])
+
+    return data, nerrors, traces_debug, markers_debug
+
+
+def _init_worker(store_superdirs, store_dirs, setup):
+    global g_worker_setup
+    g_worker_setup = dict(setup)
+    g_worker_setup['engine'] = gf.LocalEngine(
+        store_superdirs=store_superdirs,
+        store_dirs=store_dirs)
+
+
+def _model_chunk_worker(args):
+    return model_chunk(g_worker_setup, *args)
+
 
 def model(
         engine,
@@ -22,108 +315,464 @@ def model(
         nsources=400,
         nreceivers=1,
         apply_source_response_via_spectra=True,
-        debug=True):
+        nsources_chunk=20,
+        nparallel=1,
+        seed=None,
+        path=None,
+        shared_receivers=False,
+        debug=False):
+
+    '''
+    Model features of random sources at random receiver positions.
+
+    Sources are processed in chunks of ``nsources_chunk``, see
+    :py:func:`model_chunk`, which are spread over ``nparallel`` worker
+    processes. Each chunk gets its own seed derived from ``seed``, so for a
+    given seed and chunk size, the results do not depend on ``nparallel``.
+    With ``nparallel > 1``, ``engine`` must be a
+    :py:class:`pyrocko.gf.LocalEngine`.
+
+    By default, each source is recorded at its own random receivers, so the
+    synthetic traces are computed with one call to ``engine.process`` per
+    source and only the feature evaluation is batched over the chunk. With
+    ``shared_receivers``, all sources of a chunk are recorded at the same
+    ``nreceivers`` random receivers and their traces are computed with a
+    single call to ``engine.process``, which is faster, but samples only
+    ``nreceivers`` receiver positions per chunk.
+
+    Returns an array with one row per source and receiver, with columns as
+    given by :py:func:`get_column_names`. Failed measurements are ``NaN``.
+    If ``path`` is given, rows are appended to that file as the chunks are
+    completed, and the file is returned as a memory-mapped array (see
+    :py:func:`load_model`).
+    '''
 
-    d2r = math.pi / 180.
-
-    components = set()
     for measure in measures:
         if not measure.components:
             raise Exception('no components given in measurement rule')
 
-        for component in measure.components:
-            components.add(component)
+    setup = dict(
+        engine=engine,
+        store_id=store_id,
+        magnitude_min=magnitude_min,
+        magnitude_max=magnitude_max,
+        moment_tensor=moment_tensor,
+        stress_drop_min=stress_drop_min,
+        stress_drop_max=stress_drop_max,
+        rupture_velocity_min=rupture_velocity_min,
+        rupture_velocity_max=rupture_velocity_max,
+        depth_min=depth_min,
+        depth_max=depth_max,
+        distance_min=distance_min,
+        distance_max=distance_max,
+        measures=measures,
+        nreceivers=nreceivers,
+        apply_source_response_via_spectra=apply_source_response_via_spectra,
+        shared_receivers=shared_receivers,
+        debug=debug)
+
+    isource_offsets = list(range(0, nsources, nsources_chunk))
+    seeds = num.random.SeedSequence(seed).spawn(len(isource_offsets))
+    chunks = [
+        (chunk_seed, isource_offset,
+         min(nsources_chunk, nsources - isource_offset))
+        for (chunk_seed, isource_offset) in zip(seeds, isource_offsets)]
+
+    if path is not None:
+        f = open(path, 'wb')
+    else:
+        f = None
+        datas = []
 
-    components = list(components)
-
-    data = []
     nerrors = 0
     traces_debug = []
     markers_debug = []
-    for isource in xrange(nsources):
-        magnitude = num.random.uniform(
-            magnitude_min, magnitude_max)
-        stress_drop = num.random.uniform(
-            stress_drop_min, stress_drop_max)
-        rupture_velocity = num.random.uniform(
-            rupture_velocity_min, rupture_velocity_max)
 
-        radius = (pmt.magnitude_to_moment(magnitude) * 7./16. /
-                  stress_drop)**(1./3.)
+    def collect(ichunk, result):
+        data, nerrors_chunk, traces_chunk, markers_chunk = result
+        if f is not None:
+            f.write(data.astype(num.float64).tobytes())
+            f.flush()
+        else:
+            datas.append(data)
 
-        duration = 1.5 * radius / rupture_velocity
+        traces_debug.extend(traces_chunk)
+        markers_debug.extend(markers_chunk)
+
+        logger.info('modelled chunk %i of %i' % (ichunk+1, len(chunks)))
+        return nerrors_chunk
+
+    try:
+        if nparallel > 1:
+            setup_worker = dict(setup)
+            del setup_worker['engine']
+            pool = multiprocessing.Pool(
+                nparallel,
+                initializer=_init_worker,
+                initargs=(
+                    engine.store_superdirs, engine.store_dirs, setup_worker))
+
+            try:
+                for ichunk, result in enumerate(
+                        pool.imap(_model_chunk_worker, chunks)):
+
+                    nerrors += collect(ichunk, result)
+
+                pool.close()
+            except BaseException:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
 
-        if moment_tensor is None:
-            mt = pmt.MomentTensor.random_dc(magnitude=magnitude)
         else:
-            mt = copy.deepcopy(moment_tensor)
-            mt.magnitude = magnitude
+            for ichunk, chunk in enumerate(chunks):
+                nerrors += collect(ichunk, model_chunk(setup, *chunk))
+
+    finally:
+        if f is not None:
+            f.close()
+
+    if nerrors:
+        logger.warn('%i measurements failed' % nerrors)
 
-        depth = num.random.uniform(depth_min, depth_max)
-        if apply_source_response_via_spectra:
-            source = gf.MTSource(
-                m6=mt.m6(),
-                depth=depth)
+    if debug:
+        trace.snuffle(traces_debug, markers=markers_debug)
 
-            extra_responses = [
-                wmeasure.BruneResponse(duration=duration)]
+    if path is not None:
+        return load_model(path, measures)
+
+    if datas:
+        return num.concatenate(datas)
+    else:
+        return num.zeros((0, len(get_column_names(measures))))
+
+
+mechanism_classes = [
+    ('strike-slip', (0., 90., 0.)),
+    ('normal', (0., 45., -90.)),
+    ('thrust', (0., 45., 90.))]
+
+
+class FeatureTable(object):
+    '''
+    Synthetic features tabulated on a regular grid.
+
+    Holds the decadic logarithm of each feature value as a function of
+    mechanism class, magnitude, source depth, epicentral distance and
+    receiver azimuth. Source durations follow from magnitude with the
+    ``stress_drop`` and ``rupture_velocity`` used for the table. Use
+    :py:func:`make_table` to compute a table and :py:meth:`interpolate` to
+    look up features of arbitrary source-receiver configurations.
+    '''
+
+    def __init__(
+            self, names, mechanisms, magnitudes, depths, distances, azimuths,
+            log_values, stress_drop, rupture_velocity):
+
+        self.names = list(names)
+        self.mechanisms = list(mechanisms)
+        self.magnitudes = num.asarray(magnitudes, dtype=float)
+        self.depths = num.asarray(depths, dtype=float)
+        self.distances = num.asarray(distances, dtype=float)
+        self.azimuths = num.asarray(azimuths, dtype=float)
+        self.log_values = num.asarray(log_values, dtype=num.float32)
+        self.stress_drop = stress_drop
+        self.rupture_velocity = rupture_velocity
+
+        assert self.log_values.shape == (
+            len(self.mechanisms), self.magnitudes.size, self.depths.size,
+            self.distances.size, self.azimuths.size, len(self.names))
+
+        # azimuth is periodic: the first azimuth is repeated at the end
+        if self.azimuths.size > 1:
+            self._azimuths_wrap = num.concatenate(
+                (self.azimuths, self.azimuths[:1] + 360.))
+            self._log_values_wrap = num.concatenate(
+                (self.log_values, self.log_values[:, :, :, :, :1]), axis=4)
         else:
-            source = gf.MTSource(
-                m6=mt.m6(),
-                depth=depth,
-                stf=gf.HalfSinusoidSTF(effective_duration=duration))
+            self._azimuths_wrap = self.azimuths
+            self._log_values_wrap = self.log_values
+
+    def save(self, path):
+        '''
+        Save table to a binary (NumPy ``.npz``) file.
+        '''
+
+        with open(path, 'wb') as f:
+            num.savez(
+                f,
+                names=num.array(self.names),
+                mechanisms=num.array(self.mechanisms),
+                magnitudes=self.magnitudes,
+                depths=self.depths,
+                distances=self.distances,
+                azimuths=self.azimuths,
+                log_values=self.log_values,
+                stress_drop=self.stress_drop,
+                rupture_velocity=self.rupture_velocity)
+
+    def get_imechanism(self, mechanism):
+        return self.mechanisms.index(mechanism)
+
+    def interpolate(
+            self, imechanisms, magnitudes, depths, distances, azimuths):
+
+        '''
+        Look up features for many source-receiver configurations.
+
+        Values are interpolated multi-linearly in log-feature, with distance
+        on a logarithmic scale. Arguments are arrays (or scalars) of equal
+        length. Returns an array with one row per configuration and one
+        column per feature. Configurations outside of the table give
+        ``NaN``. Where the table has a single magnitude, depth, distance or
+        azimuth, features are taken as independent of it.
+        '''
+
+        imechanisms, magnitudes, depths, distances, azimuths = \
+            num.broadcast_arrays(*[
+                num.atleast_1d(x) for x in (
+                    imechanisms, magnitudes, depths, distances, azimuths)])
+
+        azimuths = self.azimuths[0] + (azimuths - self.azimuths[0]) % 360.
+
+        log_values = interpolate_regular(
+            [self.magnitudes, self.depths, num.log(self.distances),
+             self._azimuths_wrap],
+            self._log_values_wrap,
+            imechanisms.astype(int),
+            [magnitudes, depths, num.log(distances), azimuths])
+
+        return 10.0**log_values
+
+
+def load_table(path):
+    '''
+    Load a :py:class:`FeatureTable` saved with :py:meth:`FeatureTable.save`.
+    '''
+
+    with num.load(path) as d:
+        return FeatureTable(
+            names=[str(name) for name in d['names']],
+            mechanisms=[str(mechanism) for mechanism in d['mechanisms']],
+            magnitudes=d['magnitudes'],
+            depths=d['depths'],
+            distances=d['distances'],
+            azimuths=d['azimuths'],
+            log_values=d['log_values'],
+            stress_drop=float(d['stress_drop']),
+            rupture_velocity=float(d['rupture_velocity']))
+
+
+def interpolate_regular(axes, values, indices, coords):
+    '''
+    Multi-linear interpolation on a rectilinear grid.
+
+    ``values`` has shape ``(n,) + tuple(axis.size for axis in axes) +
+    (nvalues,)``. For each point, the first dimension is selected with
+    ``indices`` and the remaining ones are interpolated at ``coords``.
+    Axes with a single node are taken as constant, i.e. the values do not
+    depend on the corresponding coordinate. Points outside of the other axes
+    give ``NaN``.
+    '''
+
+    npoints = indices.size
+    iaxes = []
+    weights = []
+    outside = num.zeros(npoints, dtype=bool)
+    for axis, x in zip(axes, coords):
+        x = num.asarray(x, dtype=float)
+        if axis.size == 1:
+            iaxes.append(num.zeros(npoints, dtype=int))
+            weights.append(num.zeros(npoints))
+        else:
+            outside |= ~((axis[0] <= x) & (x <= axis[-1]))
+            i = num.clip(
+                num.searchsorted(axis, x, side='right') - 1, 0, axis.size - 2)
+            iaxes.append(i)
+            weights.append((x - axis[i]) / (axis[i+1] - axis[i]))
 
-            extra_responses = []
+    result = num.zeros((npoints, values.shape[-1]))
+    for corner in itertools.product((0, 1), repeat=len(axes)):
+        weight = num.ones(npoints)
+        index = [indices]
+        for axis, i, w, c in zip(axes, iaxes, weights, corner):
+            weight *= w if c else 1.0 - w
+            index.append(num.minimum(i + c, axis.size - 1))
 
-        for ireceiver in xrange(nreceivers):
-            angle = num.random.uniform(0., 360.)
-            distance = num.exp(num.random.uniform(
-                math.log(distance_min), math.log(distance_max)))
+        # skip corners without weight, so that NaN entries of neighbouring
+        # grid nodes do not spread
+        used = weight > 0.0
+        result[used] += weight[used, num.newaxis] \
+            * values[tuple(ii[used] for ii in index)]
 
-            targets = []
-            for comp in components:
-                targets.append(gf.Target(
-                    quantity='displacement',
-                    codes=('', '%i_%i' % (isource, ireceiver), '', comp),
-                    north_shift=distance*math.cos(d2r*angle),
-                    east_shift=distance*math.sin(d2r*angle),
-                    depth=0.,
-                    store_id=store_id))
+    result[outside] = num.nan
+    return result
 
-            resp = engine.process(source, targets)
-            amps = []
-            for measure in measures:
-                comp_to_tt = {}
-                for (source, target, tr) in resp.iter_results():
-                    comp_to_tt[target.codes[-1]] = (target, tr)
 
-                targets, trs = zip(*(
-                    comp_to_tt[c] for c in measure.components))
+def make_table_chunk(setup, imechanism, magnitude):
+    '''
+    Compute the table entries of one mechanism class and magnitude.
+    '''
 
-                try:
-                    result = wmeasure.evaluate(
-                        engine, source, targets, trs,
-                        extra_responses,
-                        debug=debug)
-
-                    if not debug:
-                        amps.append(result)
-                    else:
-                        amp, trs, marker = result
-                        amps.append(amp)
-                        traces_debug.extend(trs)
-                        markers_debug.append(marker)
-
-                except wmeasure.AmplitudeMeasurementFailed:
-                    nerrors += 1
-                    amps.append(None)
+    s = setup
+    strike, dip, rake = dict(mechanism_classes)[s['mechanisms'][imechanism]]
+    mt = pmt.MomentTensor(
+        strike=strike, dip=dip, rake=rake, magnitude=magnitude)
 
-            data.append([magnitude, duration, depth, distance] + amps)
+    duration = get_duration(magnitude, s['stress_drop'], s['rupture_velocity'])
 
-    if debug:
-        trace.snuffle(traces_debug, markers=markers_debug)
+    sources = []
+    source_responses = []
+    for depth in s['depths']:
+        source, extra_responses = get_source(
+            mt, depth, duration, s['apply_source_response_via_spectra'])
+
+        sources.append(source)
+        source_responses.append(extra_responses)
+
+    receivers = [
+        (distance*math.cos(d2r*azimuth), distance*math.sin(d2r*azimuth))
+        for distance in s['distances']
+        for azimuth in s['azimuths']]
+
+    values, nerrors, _, _ = evaluate_synthetics(
+        s['engine'], s['store_id'], s['measures'], sources, source_responses,
+        receivers)
+
+    with num.errstate(divide='ignore', invalid='ignore'):
+        log_values = num.log10(values)
+
+    return log_values.reshape((
+        len(s['depths']), len(s['distances']), len(s['azimuths']), -1)), \
+        nerrors
+
+
+def _make_table_chunk_worker(args):
+    return make_table_chunk(g_worker_setup, *args)
+
+
+def make_table(
+        engine,
+        store_id,
+        measures,
+        magnitudes,
+        depths,
+        distances,
+        azimuths,
+        mechanisms=None,
+        stress_drop=3.0e6,
+        rupture_velocity=2700.,
+        apply_source_response_via_spectra=True,
+        nparallel=1):
+
+    '''
+    Tabulate synthetic features on a regular grid.
+
+    The measures are evaluated once for each combination of mechanism class
+    (names from :py:data:`mechanism_classes`, by default all of them),
+    magnitude, depth, distance and azimuth. The synthetics of each
+    mechanism class and magnitude are computed with a single call to
+    ``engine.process``; these are spread over ``nparallel`` worker
+    processes. Returns a :py:class:`FeatureTable`.
+    '''
+
+    for measure in measures:
+        if not measure.components:
+            raise Exception('no components given in measurement rule')
+
+    if mechanisms is None:
+        mechanisms = [name for (name, _) in mechanism_classes]
+
+    setup = dict(
+        engine=engine,
+        store_id=store_id,
+        measures=measures,
+        mechanisms=mechanisms,
+        depths=list(depths),
+        distances=list(distances),
+        azimuths=list(azimuths),
+        stress_drop=stress_drop,
+        rupture_velocity=rupture_velocity,
+        apply_source_response_via_spectra=apply_source_response_via_spectra)
+
+    chunks = [
+        (imechanism, magnitude)
+        for imechanism in range(len(mechanisms))
+        for magnitude in magnitudes]
+
+    if nparallel > 1:
+        setup_worker = dict(setup)
+        del setup_worker['engine']
+        pool = multiprocessing.Pool(
+            nparallel,
+            initializer=_init_worker,
+            initargs=(
+                engine.store_superdirs, engine.store_dirs, setup_worker))
+
+        try:
+            results = pool.map(_make_table_chunk_worker, chunks)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    else:
+        results = [make_table_chunk(setup, *chunk) for chunk in chunks]
+
+    nerrors = sum(nerrors_chunk for (_, nerrors_chunk) in results)
+    if nerrors:
+        logger.warn('%i measurements failed' % nerrors)
+
+    log_values = num.array([log_values for (log_values, _) in results])
+    log_values = log_values.reshape(
+        (len(mechanisms), len(magnitudes)) + log_values.shape[1:])
+
+    return FeatureTable(
+        names=get_column_names(measures)[4:],
+        mechanisms=mechanisms,
+        magnitudes=magnitudes,
+        depths=depths,
+        distances=distances,
+        azimuths=azimuths,
+        log_values=log_values,
+        stress_drop=stress_drop,
+        rupture_velocity=rupture_velocity)
+
+
+def sample_table(
+        table,
+        magnitude_min, magnitude_max,
+        depth_min, depth_max,
+        distance_min, distance_max,
+        nsamples=100000,
+        seed=None):
+
+    '''
+    Draw random synthetic features from a :py:class:`FeatureTable`.
+
+    Magnitude, depth and azimuth are drawn uniformly, distance
+    log-uniformly and the mechanism class uniformly from the classes of the
+    table. Returns an array with the same columns as :py:func:`model`.
+    '''
+
+    rng = num.random.default_rng(seed)
+    magnitudes = rng.uniform(magnitude_min, magnitude_max, size=nsamples)
+    depths = rng.uniform(depth_min, depth_max, size=nsamples)
+    distances = num.exp(rng.uniform(
+        math.log(distance_min), math.log(distance_max), size=nsamples))
+    azimuths = rng.uniform(0., 360., size=nsamples)
+    imechanisms = rng.integers(len(table.mechanisms), size=nsamples)
+
+    values = table.interpolate(
+        imechanisms, magnitudes, depths, distances, azimuths)
+
+    durations = get_duration(
+        magnitudes, table.stress_drop, table.rupture_velocity)
 
-    return num.array(data, dtype=num.float)
+    return num.column_stack((magnitudes, durations, depths, distances, values))
 
 
 if __name__ == '__main__':
@@ -137,7 +786,8 @@ if __name__ == '__main__':
     depth_min, depth_max = 1.*km, 30.*km
     distance_min, distance_max = 100*km, 100*km
 
-    measure_ML = wmeasure.AmplitudeMeasure(
+    measure_ML = wmeasure.FeatureMeasure(
+        name='ML',
         timing_tmin=gf.Timing('vel:8'),
         timing_tmax=gf.Timing('vel:2'),
         fmin=None,
@@ -145,7 +795,7 @@ if __name__ == '__main__':
         response=wmeasure.response_wa,
         components=['N', 'E'],
         quantity='velocity',
-        maximum_method='peak_component')
+        method='peak_component')
 
     data = model(
         engine, store_id,
@@ -157,7 +807,8 @@ if __name__ == '__main__':
         distance_min, distance_max,
         measures=[measure_ML],
         apply_source_response_via_spectra=False,
-        debug=True)
+        nparallel=multiprocessing.cpu_count(),
+        debug=False)
 
     plt = plot.mpl_init(fontsize=9.)
     plt.switch_backend('Qt5Agg')
@@ -0,0 +1,426 @@
+'''
+Work queue for extraction runs spread over many processes and hosts.
+
+The queue is a SQLite database holding one task per event. Any number of
+workers, sharing the database file and the dataset through a common file
+system, claim events one by one, process them and store the results in the
+database. A claim is a lease which has to be renewed by the worker, so that
+events of a worker which died are taken over by others once the lease has
+expired. The worker completing the last event exports the results to the
+regular output directory of the configuration.
+'''
+
+import os
+import time
+import pickle
+import socket
+import sqlite3
+import logging
+import threading
+import os.path as op
+
+from pyrocko import util
+
+from wafe import core, config as wconfig, meta as wmeta, \
+    results as wresults
+
+logger = logging.getLogger('wafe.workqueue')
+
+
+class WorkQueue(object):
+    '''
+    Event tasks of an extraction run, stored in a SQLite database.
+
+    Tasks are ``pending``, ``claimed``, ``done`` or ``failed``.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=60., isolation_level=None)
+
+    def close(self):
+        self._conn.close()
+
+    def _execute(self, *args):
+        return self._conn.execute(*args)
+
+    def _transaction(self, f, *args):
+        # BEGIN IMMEDIATE takes the write lock right away, so that claims
+        # of concurrent workers are serialized
+        self._execute('BEGIN IMMEDIATE')
+        try:
+            result = f(*args)
+            self._execute('COMMIT')
+            return result
+
+        except BaseException:
+            self._execute('ROLLBACK')
+            raise
+
+    def create(self):
+        self._execute('''
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT)''')
+
+        self._execute('''
+            CREATE TABLE IF NOT EXISTS tasks (
+                event_name TEXT PRIMARY KEY,
+                iorder INTEGER,
+                state TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                rows BLOB)''')
+
+    def get_meta(self, key):
+        row = self._execute(
+            'SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        self._execute(
+            'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+            (key, value))
+
+    def enqueue(self, config_path, config_hash, event_names):
+        '''
+        Add events to the queue.
+
+        Events already in the queue are kept, except for failed ones, which
+        are retried. Returns the number of events added or reset.
+        '''
+
+        def enqueue():
+            config_hash_old = self.get_meta('config_hash')
+            if config_hash_old not in (None, config_hash):
+                raise wmeta.WafeError(
+                    'queue %s has been set up with a different '
+                    'configuration' % self.path)
+
+            self._set_meta('config_path', config_path)
+            self._set_meta('config_hash', config_hash)
+
+            nadded = 0
+            for iorder, event_name in enumerate(event_names):
+                nadded += self._execute(
+                    'INSERT OR IGNORE INTO tasks (event_name, iorder) '
+                    'VALUES (?, ?)', (event_name, iorder)).rowcount
+
+                nadded += self._execute(
+                    "UPDATE tasks SET state = 'pending', attempts = 0, "
+                    "error = NULL WHERE event_name = ? AND state = 'failed'",
+                    (event_name,)).rowcount
+
+            if nadded:
+                self._set_meta('exported', '0')
+
+            return nadded
+
+        return self._transaction(enqueue)
+
+    def claim(self, worker, lease, max_attempts):
+        '''
+        Claim the next pending event or an event with an expired lease.
+
+        Events whose lease has expired ``max_attempts`` times are marked as
+        failed. Returns the event name or ``None`` if there is nothing to
+        claim.
+        '''
+
+        def claim():
+            now = time.time()
+            self._execute(
+                "UPDATE tasks SET state = 'failed', lease_until = NULL, "
+                "error = 'lease expired' WHERE state = 'claimed' "
+                "AND lease_until < ? AND attempts >= ?", (now, max_attempts))
+
+            row = self._execute(
+                "SELECT event_name FROM tasks WHERE state = 'pending' "
+                "OR (state = 'claimed' AND lease_until < ?) "
+                "ORDER BY iorder LIMIT 1", (now,)).fetchone()
+
+            if row is None:
+                return None
+
+            self._execute(
+                "UPDATE tasks SET state = 'claimed', worker = ?, "
+                "lease_until = ?, attempts = attempts + 1 "
+                "WHERE event_name = ?", (worker, now + lease, row[0]))
+
+            return row[0]
+
+        return self._transaction(claim)
+
+    def renew(self, event_name, worker, lease):
+        '''
+        Extend a lease. Returns ``False`` if the claim has been lost.
+        '''
+
+        return self._execute(
+            "UPDATE tasks SET lease_until = ? WHERE event_name = ? "
+            "AND worker = ? AND state = 'claimed'",
+            (time.time() + lease, event_name, worker)).rowcount == 1
+
+    def complete(self, event_name, worker, rows):
+        '''
+        Store the results of a claimed event.
+
+        Returns ``False`` if the claim has been lost, in which case the
+        results are discarded.
+        '''
+
+        return self._execute(
+            "UPDATE tasks SET state = 'done', lease_until = NULL, "
+            "error = NULL, rows = ? WHERE event_name = ? AND worker = ? "
+            "AND state = 'claimed'",
+            (pickle.dumps(rows), event_name, worker)).rowcount == 1
+
+    def fail(self, event_name, worker, error, max_attempts):
+        '''
+        Give back a claimed event after an error.
+
+        The event is marked as failed once it has been tried
+        ``max_attempts`` times, otherwise it is pending again.
+        '''
+
+        self._execute(
+            "UPDATE tasks SET state = CASE WHEN attempts >= ? "
+            "THEN 'failed' ELSE 'pending' END, lease_until = NULL, "
+            "error = ? WHERE event_name = ? AND worker = ? "
+            "AND state = 'claimed'",
+            (max_attempts, error, event_name, worker))
+
+    def get_counts(self):
+        counts = dict(pending=0, claimed=0, done=0, failed=0)
+        counts.update(self._execute(
+            'SELECT state, COUNT(*) FROM tasks GROUP BY state').fetchall())
+
+        return counts
+
+    def get_failed(self):
+        return self._execute(
+            "SELECT event_name, error FROM tasks WHERE state = 'failed' "
+            "ORDER BY iorder").fetchall()
+
+    def claim_export(self):
+        '''
+        Take the right to export the results once all events are finished.
+
+        Returns ``True`` for exactly one caller.
+        '''
+
+        def claim_export():
+            counts = self.get_counts()
+            if counts['pending'] or counts['claimed'] \
+                    or self.get_meta('exported') == '1':
+                return False
+
+            self._set_meta('exported', '1')
+            return True
+
+        return self._transaction(claim_export)
+
+    def reset_export(self):
+        self._set_meta('exported', '0')
+
+    def iter_results(self):
+        '''
+        Iterate over ``(event_name, rows)`` of finished events in order.
+        '''
+
+        for event_name, rows in self._execute(
+                "SELECT event_name, rows FROM tasks WHERE state = 'done' "
+                "ORDER BY iorder"):
+
+            yield event_name, pickle.loads(rows)
+
+
+def open_queue(path, create=False):
+    if not create and not op.exists(path):
+        raise wmeta.WafeError('no such queue: %s' % path)
+
+    queue = WorkQueue(path)
+    if create:
+        queue.create()
+
+    return queue
+
+
+class LeaseKeeper(threading.Thread):
+    '''
+    Renew the lease of a claimed event in the background.
+    '''
+
+    def __init__(self, queue_path, event_name, worker, lease):
+        threading.Thread.__init__(self, daemon=True)
+        self.queue_path = queue_path
+        self.event_name = event_name
+        self.worker = worker
+        self.lease = lease
+        self.lost = False
+        self._stop_event = threading.Event()
+
+    def run(self):
+        # sqlite connections cannot be shared between threads
+        queue = WorkQueue(self.queue_path)
+        try:
+            while not self._stop_event.wait(self.lease / 4.):
+                if not queue.renew(self.event_name, self.worker, self.lease):
+                    self.lost = True
+                    logger.warn(
+                        'lost claim on event %s' % self.event_name)
+                    break
+
+        finally:
+            queue.close()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def get_worker_id():
+    return '%s:%i' % (socket.gethostname(), os.getpid())
+
+
+def get_queue_config(queue):
+    config = wconfig.read_config(queue.get_meta('config_path'))
+    if config.get_extraction_hash() != queue.get_meta('config_hash'):
+        raise wmeta.WafeError(
+            'configuration %s has changed since the events were queued'
+            % queue.get_meta('config_path'))
+
+    return config
+
+
+def export_results(queue, config):
+    '''
+    Write the results of all finished events to the output directory.
+
+    The output looks like that of :py:func:`wafe.core.run_extract`,
+    including the progress manifest.
+    '''
+
+    output_path = config.expand_path(config.output_path)
+    util.ensuredir(output_path)
+    manifest = wresults.ProgressManifest(
+        output_path, config.get_extraction_hash())
+
+    wconfig.write_config(config, op.join(output_path, 'config.yaml'))
+    manifest.open()
+    try:
+        with wresults.get_results_writer(
+                config.output_format, output_path,
+                config.get_value_names()) as writer:
+
+            nevents = 0
+            for event_name, rows in queue.iter_results():
+                for event, station, values in rows:
+                    writer.write(event, station, values)
+
+                manifest.mark_done(event_name, writer.commit())
+                nevents += 1
+
+    finally:
+        manifest.close()
+
+    failed = queue.get_failed()
+    for event_name, error in failed:
+        logger.warn('event %s failed: %s' % (event_name, error))
+
+    logger.info(
+        'exported results of %i events to %s (%i failed)'
+        % (nevents, output_path, len(failed)))
+
+
+def run_enqueue(queue_path, config_path):
+    '''
+    Set up a queue with the events of a configuration.
+    '''
+
+    config = wconfig.read_config(config_path)
+    queue = open_queue(queue_path, create=True)
+    try:
+        nadded = queue.enqueue(
+            op.abspath(config_path),
+            config.get_extraction_hash(),
+            config.get_event_names())
+
+        counts = queue.get_counts()
+        logger.info(
+            '%i events added to queue %s (%s)' % (
+                nadded, queue_path, ', '.join(
+                    '%s: %i' % kv for kv in sorted(counts.items()))))
+
+    finally:
+        queue.close()
+
+
+def run_worker(queue_path, lease=600., max_attempts=3, interval=10.):
+    '''
+    Process events from a queue until all are finished.
+
+    While no event can be claimed but others are still being processed,
+    the worker waits, so that it can take over events of workers which
+    died.
+    '''
+
+    queue = open_queue(queue_path)
+    try:
+        config = get_queue_config(queue)
+        worker = get_worker_id()
+        logger.info('worker %s started' % worker)
+
+        while True:
+            event_name = queue.claim(worker, lease, max_attempts)
+            if event_name is None:
+                if queue.get_counts()['claimed']:
+                    time.sleep(interval)
+                    continue
+
+                break
+
+            logger.info('processing event %s' % event_name)
+            keeper = LeaseKeeper(queue_path, event_name, worker, lease)
+            keeper.start()
+            try:
+                rows = core.extract_event(config, event_name)
+
+            except Exception as e:
+                logger.error(
+                    'processing of event %s failed: %s' % (event_name, e))
+                queue.fail(event_name, worker, str(e), max_attempts)
+                continue
+
+            finally:
+                keeper.stop()
+                config.dataset_config.forget_dataset(event_name)
+
+            if not queue.complete(event_name, worker, rows):
+                logger.warn(
+                    'results of event %s discarded, it has been claimed by '
+                    'another worker' % event_name)
+
+        if queue.claim_export():
+            try:
+                export_results(queue, config)
+            except BaseException:
+                queue.reset_export()
+                raise
+
+        logger.info('worker %s finished' % worker)
+
+    finally:
+        queue.close()
+
+
+__all__ = '''
+    WorkQueue
+    open_queue
+    export_results
+    run_enqueue
+    run_worker
+'''.split()
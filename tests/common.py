@@ -0,0 +1,59 @@
+import sys
+import atexit
+import shutil
+import tempfile
+import os.path as op
+
+sys.path.insert(
+    0, op.join(op.dirname(op.abspath(__file__)), '..', 'benchmarks'))
+
+import archive  # noqa
+
+g_dataset_path = None
+
+
+def get_dataset_path():
+    '''
+    Get the directory of a small synthetic event dataset with a GF store.
+
+    The dataset is written on first use and removed at exit.
+    '''
+
+    global g_dataset_path
+    if g_dataset_path is None:
+        path = tempfile.mkdtemp(prefix='wafe-test-')
+        atexit.register(shutil.rmtree, path, True)
+        archive.make_gf_store(path)
+        archive.make_event_dataset(
+            path, nevents=2, nstations=4, duration=60.)
+
+        g_dataset_path = path
+
+    return g_dataset_path
+
+
+def get_config(measures=None, output_format='text', path=None):
+    '''
+    Get a configuration for the test dataset, writing output to ``path``.
+    '''
+
+    if measures is None:
+        measures = archive.make_measures(6)
+
+    config = archive.make_config(
+        get_dataset_path(), measures, output_format=output_format)
+
+    if path is not None:
+        config.output_path = op.join(path, 'output')
+
+    return config
+
+
+def get_temp_dir(test_case):
+    '''
+    Get a temporary directory, removed when the test case has finished.
+    '''
+
+    path = tempfile.mkdtemp(prefix='wafe-test-')
+    test_case.addCleanup(shutil.rmtree, path, True)
+    return path
@@ -0,0 +1,65 @@
+import unittest
+
+import numpy as num
+
+from wafe import core
+
+import common
+
+
+def extract(config, event_name):
+    ds = config.get_dataset(event_name)
+    rows = core.extract_stations(config, ds, ds.get_event(), ds.get_stations())
+    return dict(
+        (station.nsl(), values) for (_, station, values) in rows)
+
+
+class CoreTestCase(unittest.TestCase):
+
+    def testMeasuresIndependent(self):
+        # restitution is shared between measures only where requests are
+        # identical, so the values of a measure do not depend on the others
+        config = common.get_config()
+        event_name = config.get_event_names()[0]
+        values_all = extract(config, event_name)
+        self.assertTrue(values_all)
+
+        icolumn = 0
+        for measure in config.measures:
+            config_single = common.get_config(measures=[measure])
+            values_single = extract(config_single, event_name)
+            ncolumns = len(measure.get_value_names())
+            self.assertEqual(set(values_single), set(values_all))
+            for nsl, values in values_single.items():
+                num.testing.assert_array_equal(
+                    values, values_all[nsl][icolumn:icolumn+ncolumns],
+                    err_msg=measure.name)
+
+            icolumn += ncolumns
+
+    def testPlannerReleasesData(self):
+        config = common.get_config()
+        ds = config.get_dataset(config.get_event_names()[0])
+        station = ds.get_stations()[0]
+        event = ds.get_event()
+        planner = core.StationWindowPlanner(ds)
+        codes = station.nsl() + ('Z',)
+        params = dict(
+            quantity='velocity', freqlimits=(0.5, 1., 10., 20.), tfade=1.)
+
+        planner.plan(codes, event.time, event.time + 10., **params)
+        planner.get_waveform(
+            codes, tmin=event.time, tmax=event.time + 10., **params)
+
+        files = [
+            tr.file for tr in ds.get_waveform_index().relevant(
+                station.nsl() + ('HHZ',), event.time, event.time + 10.)]
+
+        self.assertTrue(files)
+        self.assertTrue(all(file.data_loaded for file in files))
+        planner.release()
+        self.assertFalse(any(file.data_loaded for file in files))
+
+
+if __name__ == '__main__':
+    unittest.main()
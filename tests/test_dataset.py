@@ -0,0 +1,189 @@
+import os
+import os.path as op
+import unittest
+
+import numpy as num
+
+from pyrocko import trace
+
+from wafe import dataset, cache as wcache
+
+import common
+from test_core import extract
+
+
+class DatasetTestCase(unittest.TestCase):
+
+    def testWaveformIndex(self):
+        config = common.get_config()
+        ds = config.get_dataset(config.get_event_names()[0])
+        p = ds.get_pile()
+        index = ds.get_waveform_index()
+        traces = list(p.iter_traces(load_data=False))
+        nslcs = sorted(set(tr.nslc_id for tr in traces))
+        self.assertTrue(nslcs)
+
+        nsl = nslcs[0][:3]
+        self.assertEqual(
+            index.get_channels(nsl),
+            sorted(nslc[3] for nslc in nslcs if nslc[:3] == nsl))
+
+        self.assertEqual(index.get_channels(('', 'NONE', '')), [])
+
+        rstate = num.random.RandomState(23)
+        ntraces = 0
+        for _ in range(20):
+            nslc = nslcs[rstate.randint(len(nslcs))]
+            tmin = rstate.uniform(p.tmin - 10., p.tmax)
+            tmax = tmin + rstate.uniform(0., 30.)
+
+            expect = [
+                tr for tr in traces
+                if tr.nslc_id == nslc and tr.is_relevant(tmin, tmax)]
+
+            self.assertEqual(
+                set(map(id, index.relevant(nslc, tmin, tmax))),
+                set(map(id, expect)))
+
+            trs = index.get_traces(nslc, tmin, tmax, tpad=1.)
+            trs_pile = p.all(
+                tmin=tmin, tmax=tmax, tpad=1.,
+                trace_selector=lambda tr: tr.nslc_id == nslc)
+
+            self.assertEqual(len(trs), len(trs_pile))
+            ntraces += len(trs)
+            for tr, tr_pile in zip(trs, trs_pile):
+                self.assertEqual(tr.nslc_id, tr_pile.nslc_id)
+                self.assertAlmostEqual(tr.tmin, tr_pile.tmin)
+                num.testing.assert_array_equal(
+                    tr.get_ydata(), tr_pile.get_ydata())
+
+        self.assertTrue(ntraces > 0)
+        self.assertFalse(any(file.data_loaded for file in p.iter_files()))
+
+    def testTraceDiskCache(self):
+        path = common.get_temp_dir(self)
+        cache = dataset.TraceDiskCache(path)
+        tr = trace.Trace(
+            'XX', 'STA', '', 'HHZ', deltat=0.01, ydata=num.arange(1000.))
+
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', tr)
+        self.assertEqual(cache.get('a').get_ydata().tolist(),
+                         tr.get_ydata().tolist())
+        self.assertEqual((cache.nhits, cache.nmisses), (1, 1))
+
+        # rewriting an entry does not change the accounted size
+        size = cache._size
+        cache.put('a', tr)
+        self.assertEqual(cache._size, size)
+        self.assertEqual(cache._get_entries_size(), size)
+
+        cache.put('b', tr)
+        os.utime(cache._entry_path('a'), (0., 0.))
+        cache.size_max = size * 2.5
+        cache.put('c', tr)
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertEqual(cache._size, cache._get_entries_size())
+
+        # the size of existing entries is picked up on reopening
+        cache = dataset.TraceDiskCache(path)
+        self.assertEqual(cache._size, 2*size)
+
+    def testTraceCacheExtraction(self):
+        config = common.get_config()
+        event_name = config.get_event_names()[0]
+        values_uncached = extract(config, event_name)
+
+        path = common.get_temp_dir(self)
+        for _ in range(2):
+            config = common.get_config()
+            config.dataset_config.trace_cache_path = op.join(path, 'cache')
+            values = extract(config, event_name)
+            self.assertEqual(set(values), set(values_uncached))
+            for nsl in values:
+                num.testing.assert_array_equal(
+                    values[nsl], values_uncached[nsl])
+
+        cache = config.dataset_config.get_trace_cache()
+        self.assertTrue(cache.nhits > 0)
+        self.assertEqual(cache.nmisses, 0)
+
+        # the key changes when the waveform file is modified
+        ds = config.get_dataset(event_name)
+        p = ds.get_pile()
+        nslc = sorted(p.nslc_ids.keys())[0]
+        tr_file = ds.get_waveform_index().relevant(nslc, p.tmin, p.tmax)[0]
+        tr = ds.get_waveform_index().get_traces(
+            nslc, tr_file.tmin, tr_file.tmax)[0]
+
+        def get_key():
+            return ds._get_trace_cache_key(
+                tr, 'velocity', ds.get_response(tr), 1., None, 0., False)
+
+        key = get_key()
+        self.assertEqual(get_key(), key)
+        st = os.stat(tr_file.file.abspath)
+        os.utime(tr_file.file.abspath, (st.st_atime, st.st_mtime - 10.))
+        try:
+            self.assertNotEqual(get_key(), key)
+        finally:
+            os.utime(tr_file.file.abspath, (st.st_atime, st.st_mtime))
+
+    def testTransferCache(self):
+        pyrocko_cache = trace.g_tapered_coeffs_cache
+        self.assertIsNot(pyrocko_cache, dataset.g_tapered_coeffs_cache)
+        npyrocko = len(pyrocko_cache)
+
+        tr = trace.Trace(
+            'XX', 'STA', '', 'HHZ', deltat=0.01,
+            ydata=num.random.normal(size=1000))
+
+        resp = trace.PoleZeroResponse(
+            zeros=[0j], poles=[-1.0+1.0j, -1.0-1.0j], constant=1.0)
+
+        dataset.g_tapered_coeffs_cache.clear()
+        tr_a = dataset.transfer(
+            tr, freqlimits=(0.5, 1., 10., 20.), transfer_function=resp,
+            invert=True)
+
+        self.assertEqual(len(dataset.g_tapered_coeffs_cache), 1)
+        self.assertIs(trace.g_tapered_coeffs_cache, pyrocko_cache)
+        self.assertEqual(len(pyrocko_cache), npyrocko)
+
+        tr_b = tr.transfer(
+            freqlimits=(0.5, 1., 10., 20.), transfer_function=resp,
+            invert=True)
+
+        num.testing.assert_array_equal(tr_a.ydata, tr_b.ydata)
+
+    def testMemoryCacheLimit(self):
+        ncaches = len(wcache.g_memory_caches)
+        self.assertTrue(ncaches >= 4)
+        try:
+            wcache.set_memory_cache_size_max(4000.)
+            for memory_cache in wcache.g_memory_caches:
+                self.assertEqual(memory_cache.nbytes_max, 4000. / ncaches)
+
+        finally:
+            wcache.set_memory_cache_size_max(
+                wcache.memory_cache_size_max_default)
+
+        memory_cache = wcache.MemoryCache('test', 100)
+        memory_cache.put('a', 1, 60)
+        memory_cache.put('b', 2, 30)
+        self.assertEqual(memory_cache.get('a'), 1)
+        memory_cache.put('c', 3, 30)
+        self.assertIsNone(memory_cache.get('b'))
+        self.assertEqual(memory_cache.get_nbytes(), 90)
+
+        # an entry exceeding the limit is kept until the next one comes in
+        memory_cache.put('d', 4, 200)
+        self.assertEqual(len(memory_cache), 1)
+        self.assertEqual(memory_cache.get('d'), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
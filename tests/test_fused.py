@@ -0,0 +1,74 @@
+import copy
+import unittest
+
+import numpy as num
+
+from pyrocko import gf, trace
+
+from wafe import dataset
+
+import common
+
+
+def get_values(config, measure, event_name):
+    engine = config.get_engine()
+    ds = config.get_dataset(event_name)
+    source = gf.DCSource.from_pyrocko_event(ds.get_event())
+    station_traces = []
+    for station in ds.get_stations():
+        targets = [
+            gf.Target(
+                quantity='velocity',
+                codes=station.nsl() + (component,),
+                store_id=config.store_id,
+                lat=station.lat,
+                lon=station.lon)
+
+            for component in measure.components]
+
+        _, trs_processed = measure.process(engine, source, targets, ds)
+        station_traces.append(trs_processed)
+
+    values, _ = measure.evaluate_batch(station_traces)
+    return values
+
+
+class FusedTestCase(unittest.TestCase):
+
+    def testFusedMatchesUnfused(self):
+        config = common.get_config()
+        event_name = config.get_event_names()[0]
+        measure_template = config.measures[0]
+        for method in ['peak_component', 'peak_to_peak_component',
+                       'spectral_average']:
+            for quantity in ['displacement', 'velocity', 'acceleration']:
+                values = []
+                for fused in [False, True]:
+                    measure = copy.deepcopy(measure_template)
+                    measure.method = method
+                    measure.quantity = quantity
+                    measure.fused = fused
+                    values.append(get_values(config, measure, event_name))
+
+                self.assertTrue(num.all(num.isfinite(values[0])))
+                num.testing.assert_allclose(
+                    values[1], values[0], rtol=0.03,
+                    err_msg='%s, %s' % (method, quantity))
+
+    def testFusedNotInvertible(self):
+        resp = dataset.FusedResponse(
+            instrument=trace.PoleZeroResponse(
+                zeros=[0j, 0j],
+                poles=[-1.0+1.0j, -1.0-1.0j],
+                constant=1e9),
+            responses=[])
+
+        freqs = num.array([0.0, 1.0, 2.0])
+        with self.assertRaises(trace.InfiniteResponse):
+            resp.evaluate(freqs)
+
+        resp.evaluate(freqs[1:])
+
+
+if __name__ == '__main__':
+    unittest.main()
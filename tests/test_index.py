@@ -0,0 +1,96 @@
+import io
+import struct
+import os.path as op
+import unittest
+
+import numpy as num
+
+from pyrocko import model
+from pyrocko.guts import dump
+from pyrocko.fdsn import station as fs
+
+from wafe import index as windex
+
+import common
+
+
+class IndexTestCase(unittest.TestCase):
+
+    def check_header(self, path):
+        # the header is read without pickle
+        with open(path, 'rb') as f:
+            nheader, = struct.unpack('<Q', f.read(8))
+            num.load(io.BytesIO(f.read(nheader)), allow_pickle=False)
+
+    def testStationXMLIndex(self):
+        fn = op.join(common.get_dataset_path(), 'stations.xml')
+        tmin = model.load_events(
+            op.join(common.get_dataset_path(), 'events.pf'))[0].time
+
+        sx = fs.load_xml(filename=fn)
+        channel = sx.network_list[0].station_list[0].channel_list[0]
+        channel.response.instrument_sensitivity.input_units.name = 'BOGUS'
+        fn_bad = op.join(common.get_temp_dir(self), 'stations.xml')
+        sx.dump_xml(filename=fn_bad)
+
+        path = op.join(common.get_temp_dir(self), 'index')
+        windex.StationXMLIndex.build(fn_bad, path)
+        self.check_header(path)
+
+        sx_index = windex.StationXMLIndex(
+            windex.read_index(path, windex.get_signature(fn_bad)))
+
+        self.assertEqual(
+            [station.nsl() for station in sx_index.get_stations()],
+            [station.nsl() for station in sx.get_pyrocko_stations()])
+
+        ntested = 0
+        for nslc in sx.nslc_code_list:
+            if nslc == sx_index.nslcs[0]:
+                continue
+
+            iepochs = sx_index.get_epochs(nslc, tmin, tmin)
+            self.assertEqual(len(iepochs), 1)
+            for quantity in ['displacement', 'velocity']:
+                resp = sx.get_pyrocko_response(
+                    nslc, timespan=(tmin, tmin),
+                    fake_input_units=windex.quantity_to_unit[quantity])
+
+                self.assertEqual(
+                    dump(sx_index.get_response(iepochs[0], quantity)),
+                    dump(resp))
+
+                ntested += 1
+
+        self.assertTrue(ntested > 0)
+
+        # conversion errors are raised when the response is used
+        with self.assertRaises(fs.StationXMLError):
+            sx_index.get_response(0, 'velocity')
+
+        # an outdated index is not used
+        self.assertIsNone(windex.read_index(path, windex.get_signature(fn)))
+
+    def testEventCatalog(self):
+        fn = op.join(common.get_dataset_path(), 'events.pf')
+        events = model.load_events(fn)
+        path = op.join(common.get_temp_dir(self), 'index')
+        windex.EventCatalog.build(fn, path)
+        self.check_header(path)
+
+        catalog = windex.EventCatalog(
+            windex.read_index(path, windex.get_signature(fn)))
+
+        self.assertEqual(catalog.get_names(), [ev.name for ev in events])
+        num.testing.assert_array_equal(
+            catalog.times, [ev.time for ev in events])
+        self.assertEqual(
+            dump(catalog.get_event(events[1].name)), dump(events[1]))
+        self.assertIsNone(catalog.get_event('unknown'))
+        self.assertEqual(
+            [dump(ev) for ev in catalog.get_events()],
+            [dump(ev) for ev in events])
+
+
+if __name__ == '__main__':
+    unittest.main()
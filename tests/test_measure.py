@@ -0,0 +1,132 @@
+import unittest
+
+import numpy as num
+
+from pyrocko import trace
+
+from wafe import measure as wmeasure
+
+
+def make_station_traces(nstations, deltat=0.01, seed=17):
+    '''
+    Random three-component traces with varying lengths and start times.
+    '''
+
+    rstate = num.random.RandomState(seed)
+    station_traces = []
+    for istation in range(nstations):
+        trs = []
+        tmin = rstate.randint(0, 100) * deltat
+        for component in 'ZNE':
+            nsamples = rstate.randint(300, 600)
+            trs.append(trace.Trace(
+                'XX', 'S%03i' % istation, '', 'HH' + component,
+                tmin=tmin + rstate.randint(0, 20) * deltat,
+                deltat=deltat,
+                ydata=rstate.normal(size=nsamples)))
+
+        station_traces.append(trs)
+
+    return station_traces
+
+
+def spectral_average(y, deltat, fmin, fmax, ntrans=None):
+    if ntrans is None:
+        ntrans = y.size
+
+    freqs = num.arange(ntrans // 2 + 1) / (ntrans * deltat)
+    amps = num.abs(num.fft.rfft(y, n=ntrans))
+    iband = num.logical_and(fmin <= freqs, freqs <= fmax)
+    if not num.any(iband):
+        return num.nan
+
+    return num.mean(amps[iband])
+
+
+def reference_value(method, trs, fmin, fmax, bands):
+    # per-station evaluation of the features, one trace at a time
+    if method == 'peak_component':
+        return max(num.max(num.abs(tr.ydata)) for tr in trs)
+
+    elif method == 'peak_to_peak_component':
+        return max(num.max(tr.ydata) - num.min(tr.ydata) for tr in trs)
+
+    elif method == 'peak_absolute_vector':
+        tmin = max(tr.tmin for tr in trs)
+        tmax = min(tr.tmax for tr in trs)
+        ys = [tr.chop(tmin, tmax, inplace=False).ydata for tr in trs]
+        return num.max(num.sqrt(sum(y**2 for y in ys)))
+
+    elif method == 'spectral_average':
+        return num.mean([
+            spectral_average(tr.ydata, tr.deltat, fmin, fmax) for tr in trs])
+
+    elif method == 'spectral_bands':
+        return num.mean([
+            [spectral_average(
+                tr.ydata, tr.deltat, band_fmin, band_fmax,
+                ntrans=trace.nextpow2(tr.data_len()))
+             for (band_fmin, band_fmax) in bands]
+            for tr in trs], axis=0)
+
+
+class MeasureTestCase(unittest.TestCase):
+
+    def testEvaluateBatch(self):
+        station_traces = make_station_traces(5)
+        for method in wmeasure.FeatureMethod.choices:
+            measure = wmeasure.FeatureMeasure(
+                name='M',
+                fmin=1.,
+                fmax=10.,
+                nbands=4,
+                components=['Z', 'N', 'E'],
+                method=method)
+
+            values, _ = measure.evaluate_batch(
+                [[tr.copy() for tr in trs] for trs in station_traces],
+                debug=True)
+
+            for istation, trs in enumerate(station_traces):
+                num.testing.assert_allclose(
+                    values[istation],
+                    reference_value(
+                        method, trs, measure.fmin, measure.fmax,
+                        measure.get_bands()),
+                    rtol=1e-10, err_msg=method)
+
+    def testSpectralBandsBatch(self):
+        rstate = num.random.RandomState(5)
+        deltat, ntrans = 0.01, 1024
+        ys = rstate.normal(size=(4, 700))
+        bands = [(1., 2.), (2., 5.), (5., 50.), (3.01, 3.02)]
+        values = wmeasure.spectral_bands_batch(ys, deltat, bands, ntrans)
+        self.assertEqual(values.shape, (4, len(bands)))
+
+        ys_padded = num.zeros((4, ntrans))
+        ys_padded[:, :700] = ys
+        for iband, (fmin, fmax) in enumerate(bands[:-1]):
+            num.testing.assert_allclose(
+                values[:, iband],
+                wmeasure.spectral_average_batch(
+                    ys_padded, deltat, fmin, fmax))
+
+        # no frequency sample in the last band
+        self.assertTrue(num.all(num.isnan(values[:, -1])))
+
+    def testSpectralBandNamesUnique(self):
+        measure = wmeasure.FeatureMeasure(
+            name='B', fmin=1., fmax=1.01, nbands=8, method='spectral_bands')
+
+        names = measure.get_value_names()
+        self.assertEqual(len(names), 8)
+        self.assertEqual(len(set(names)), 8)
+
+        measure = wmeasure.FeatureMeasure(
+            name='B', bands=[(1., 2.), (2., 4.)], method='spectral_bands')
+
+        self.assertEqual(measure.get_value_names(), ['B-1-2', 'B-2-4'])
+
+
+if __name__ == '__main__':
+    unittest.main()
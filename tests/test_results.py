@@ -0,0 +1,77 @@
+import os
+import os.path as op
+import unittest
+
+from pyrocko import model
+
+from wafe import core, results as wresults
+
+import common
+
+
+def write_shard(path, event_names, station, junk=None):
+    os.mkdir(path)
+    with wresults.TextResultsWriter(path, ['A', 'B']) as writer:
+        for event_name in event_names:
+            writer.write(model.Event(name=event_name), station, [1., 2.])
+
+        checkpoint = writer.commit()
+        if junk is not None:
+            # uncommitted rows
+            writer.write(model.Event(name=junk), station, [3., 4.])
+
+    return checkpoint
+
+
+class ResultsTestCase(unittest.TestCase):
+
+    def testMergeText(self):
+        path = common.get_temp_dir(self)
+        station = model.Station('XX', 'ÄÖÜ', '')
+        names = ['%s-%i' % ('é' * 16, i) for i in range(3)]
+        paths = [op.join(path, 'shard-%i' % ishard) for ishard in range(2)]
+
+        # checkpoints are byte offsets, larger than the number of characters
+        shards = [
+            (paths[0], write_shard(
+                paths[0], names[0::2], station, junk=names[2])),
+            (paths[1], write_shard(paths[1], names[1:2], station))]
+
+        event_order = [(names[0], 0), (names[1], 1), (names[2], 0)]
+        checkpoints = wresults.merge_results_text(
+            shards, event_order, path, ['A', 'B'])
+
+        with open(op.join(path, 'measures.txt'), 'rb') as f:
+            data = f.read()
+
+        self.assertEqual(
+            data.decode('utf8').splitlines(),
+            ['# event station A B']
+            + ['%s XX.ÄÖÜ. 1 2' % name for name in names])
+
+        self.assertEqual(int(checkpoints[-1]), len(data))
+        self.assertEqual(
+            data[:int(checkpoints[0])].decode('utf8').splitlines()[-1],
+            '%s XX.ÄÖÜ. 1 2' % names[0])
+
+    def testMergeShards(self):
+        path_full = common.get_temp_dir(self)
+        core.run_extract(common.get_config(path=path_full))
+
+        path = common.get_temp_dir(self)
+        config = common.get_config(path=path)
+        for ishard in range(2):
+            core.run_extract(config, shard=(ishard, 2))
+
+        core.run_merge(config)
+
+        for fn in ['measures.txt', 'progress.txt']:
+            with open(op.join(path_full, 'output', fn), 'rb') as f:
+                data_full = f.read()
+
+            with open(op.join(path, 'output', fn), 'rb') as f:
+                self.assertEqual(f.read(), data_full)
+
+
+if __name__ == '__main__':
+    unittest.main()
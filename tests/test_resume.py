@@ -0,0 +1,59 @@
+import os.path as op
+import unittest
+
+from wafe import core, meta
+
+import common
+
+
+def read(path, fn):
+    with open(op.join(path, 'output', fn), 'rb') as f:
+        return f.read()
+
+
+class ResumeTestCase(unittest.TestCase):
+
+    def interrupt(self, path):
+        # keep only the first event in the manifest and leave an incomplete
+        # row behind its checkpoint, as after a crash
+        fn = op.join(path, 'output', 'progress.txt')
+        with open(fn, 'r') as f:
+            lines = f.readlines()
+
+        with open(fn, 'w') as f:
+            f.writelines(lines[:2])
+
+        with open(op.join(path, 'output', 'measures.txt'), 'a') as f:
+            f.write('ev0001 XX.STA.')
+
+    def testResume(self):
+        path_full = common.get_temp_dir(self)
+        core.run_extract(common.get_config(path=path_full))
+        measures_full = read(path_full, 'measures.txt')
+
+        path = common.get_temp_dir(self)
+        core.run_extract(common.get_config(path=path))
+        self.interrupt(path)
+
+        config = common.get_config(path=path)
+        # cache settings do not affect the results
+        config.dataset_config.trace_cache_path = op.join(path, 'cache')
+        config.dataset_config.memory_cache_size_max = 1024**2
+        core.run_extract(config, resume=True)
+
+        self.assertEqual(read(path, 'measures.txt'), measures_full)
+        self.assertEqual(
+            read(path, 'progress.txt'), read(path_full, 'progress.txt'))
+
+    def testResumeChangedConfig(self):
+        path = common.get_temp_dir(self)
+        core.run_extract(common.get_config(path=path))
+
+        config = common.get_config(path=path)
+        config.measures[0].fmax *= 2.
+        with self.assertRaises(meta.WafeError):
+            core.run_extract(config, resume=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import time
+import threading
+import unittest
+
+from wafe import stats as wstats
+
+
+class StatsTestCase(unittest.TestCase):
+
+    def testThreads(self):
+        stats = wstats.Stats()
+        stats.enabled = True
+
+        def work():
+            for _ in range(10000):
+                stats.count('n')
+
+            with stats.timer('sleep'):
+                time.sleep(0.2)
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+
+        # keep the CPU busy while the other threads sleep
+        tstart = time.time()
+        while time.time() - tstart < 0.2:
+            pass
+
+        for thread in threads:
+            thread.join()
+
+        report = stats.get_report()
+        self.assertEqual(report['counters'], dict(n=40000))
+        stage = report['stages']['sleep']
+        self.assertEqual(stage['count'], 4)
+        self.assertTrue(stage['wall'] >= 0.8)
+        self.assertTrue(stage['cpu'] < 0.1)
+
+        snapshot = stats.pop()
+        self.assertEqual(snapshot['counters'], dict(n=40000))
+        self.assertEqual(stats.get_report()['counters'], {})
+
+        stats.merge(snapshot)
+        stats.merge(snapshot)
+        self.assertEqual(stats.get_report()['counters'], dict(n=80000))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import unittest
+
+import numpy as num
+
+from wafe import synthetic
+
+
+def make_table(magnitudes, depths, distances, azimuths):
+    shape = (1, len(magnitudes), len(depths), len(distances), len(azimuths))
+    log_values = num.zeros(shape + (1,))
+    # log-feature linear in magnitude and log-distance
+    log_values[..., 0] = \
+        num.array(magnitudes)[:, None, None, None] \
+        - num.log10(distances)[None, None, :, None]
+
+    return synthetic.FeatureTable(
+        names=['A'],
+        mechanisms=['strike-slip'],
+        magnitudes=magnitudes,
+        depths=depths,
+        distances=distances,
+        azimuths=azimuths,
+        log_values=log_values,
+        stress_drop=1e6,
+        rupture_velocity=3000.)
+
+
+class SyntheticTestCase(unittest.TestCase):
+
+    def testInterpolate(self):
+        table = make_table(
+            [2., 3., 4.], [1000., 5000.], [1e3, 1e4, 1e5], [0., 90., 180.])
+
+        values = table.interpolate(
+            0, [2.5, 3.5, 5.0], [2000., 3000., 2000.], [3e3, 3e4, 1e4],
+            [45., 300., 0.])
+
+        num.testing.assert_allclose(
+            values[:2, 0], 10**num.array([2.5, 3.5]) / [3e3, 3e4], rtol=1e-5)
+
+        # magnitude outside of the table
+        self.assertTrue(num.isnan(values[2, 0]))
+
+    def testSingleNodeAxes(self):
+        table = make_table([2., 4.], [5000.], [1e4], [0.])
+        values = table.interpolate(
+            0, [3., 3., 5.], [1000., 30000., 5000.], [1e3, 1e5, 1e4],
+            [90., 270., 0.])
+
+        num.testing.assert_allclose(values[:2, 0], 10**3 / 1e4, rtol=1e-5)
+        self.assertTrue(num.isnan(values[2, 0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
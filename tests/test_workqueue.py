@@ -0,0 +1,96 @@
+import os.path as op
+import unittest
+
+from wafe import core, config as wconfig, meta as wmeta, workqueue
+
+import common
+
+
+class WorkQueueTestCase(unittest.TestCase):
+
+    def get_queue(self, event_names=['ev0', 'ev1', 'ev2']):
+        path = op.join(common.get_temp_dir(self), 'queue.sqlite')
+        queue = workqueue.open_queue(path, create=True)
+        self.addCleanup(queue.close)
+        self.assertEqual(queue.enqueue('config.yaml', 'h', event_names), 3)
+        return queue
+
+    def testClaim(self):
+        queue = self.get_queue()
+        self.assertEqual(queue.claim('a', 60., 3), 'ev0')
+        self.assertEqual(queue.claim('b', 60., 3), 'ev1')
+        self.assertTrue(queue.renew('ev0', 'a', 60.))
+        self.assertFalse(queue.renew('ev0', 'b', 60.))
+        self.assertFalse(queue.complete('ev0', 'b', []))
+        self.assertTrue(queue.complete('ev0', 'a', ['row']))
+        self.assertFalse(queue.claim_export())
+
+        queue.fail('ev1', 'b', 'error', 3)
+        self.assertEqual(queue.claim('b', 60., 3), 'ev1')
+        self.assertEqual(queue.claim('a', 60., 3), 'ev2')
+        self.assertIsNone(queue.claim('c', 60., 3))
+        self.assertEqual(
+            queue.get_counts(), dict(pending=0, claimed=2, done=1, failed=0))
+
+        self.assertTrue(queue.complete('ev1', 'b', []))
+        self.assertTrue(queue.complete('ev2', 'a', []))
+        self.assertEqual(
+            list(queue.iter_results()),
+            [('ev0', ['row']), ('ev1', []), ('ev2', [])])
+
+        self.assertTrue(queue.claim_export())
+        self.assertFalse(queue.claim_export())
+
+        with self.assertRaises(wmeta.WafeError):
+            queue.enqueue('config.yaml', 'other', ['ev0'])
+
+    def testLeaseExpiry(self):
+        queue = self.get_queue()
+        max_attempts = 2
+
+        # a lease in the past has expired immediately
+        self.assertEqual(queue.claim('a', -1., max_attempts), 'ev0')
+        self.assertEqual(queue.claim('b', -1., max_attempts), 'ev0')
+
+        # the claim of the first worker has been lost
+        self.assertFalse(queue.renew('ev0', 'a', 60.))
+        self.assertFalse(queue.complete('ev0', 'a', []))
+
+        # after max_attempts expired leases the event has failed
+        self.assertEqual(queue.claim('c', 60., max_attempts), 'ev1')
+        self.assertEqual(queue.get_failed(), [('ev0', 'lease expired')])
+
+        # failed events are retried when enqueued again
+        self.assertEqual(queue.enqueue('config.yaml', 'h', ['ev0']), 1)
+        self.assertEqual(queue.claim('c', 60., max_attempts), 'ev0')
+
+    def testFailAttempts(self):
+        queue = self.get_queue()
+        for attempt in range(2):
+            self.assertEqual(queue.claim('a', 60., 2), 'ev0')
+            queue.fail('ev0', 'a', 'error %i' % attempt, 2)
+
+        self.assertEqual(queue.get_failed(), [('ev0', 'error 1')])
+        self.assertEqual(queue.claim('a', 60., 2), 'ev1')
+
+    def testWorker(self):
+        path_full = common.get_temp_dir(self)
+        core.run_extract(common.get_config(path=path_full))
+
+        path = common.get_temp_dir(self)
+        config_path = op.join(path, 'config.yaml')
+        wconfig.write_config(common.get_config(path=path), config_path)
+        queue_path = op.join(path, 'queue.sqlite')
+        workqueue.run_enqueue(queue_path, config_path)
+        workqueue.run_worker(queue_path)
+
+        for fn in ['measures.txt', 'progress.txt']:
+            with open(op.join(path_full, 'output', fn), 'rb') as f:
+                data_full = f.read()
+
+            with open(op.join(path, 'output', fn), 'rb') as f:
+                self.assertEqual(f.read(), data_full)
+
+
+if __name__ == '__main__':
+    unittest.main()